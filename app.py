@@ -1,11 +1,51 @@
-from flask import Flask, render_template, request, jsonify, Response
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context, g
 from openai import OpenAI
+import click
+import contextlib
+import contextvars
+import functools
 import json
 import os
+from datetime import datetime
+import queue
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import httpx
 import firebase_admin
 from firebase_admin import credentials, firestore, auth
+from llm_cache import create_response_cache, make_cache_key
+from llm_scheduler import create_scheduler, estimate_tokens
+from single_flight import SingleFlight
+from insight_prefetch import create_insight_prefetcher
+from instrumentation import (
+    current_route, RequestTimer, UpstreamMetrics, observe_cache, log_event, render_metrics, prompt_cache_report,
+    PROMETHEUS_CONTENT_TYPE
+)
+from streaming import sse_event, sse_comment, heartbeats, TopLevelJSONStreamParser
+from structured_outputs import (
+    LESSON_OUTPUT, HELPER_OUTPUT, INSIGHT_OUTPUT, RELATED_TAGS_OUTPUT, StructuredOutputError
+)
+from prompts import (
+    HELPER_SYSTEM_PROMPT,
+    INSIGHT_SYSTEM_PROMPT,
+    INLINE_GENERATION_PROMPT,
+    TAG_GENERATION_PROMPT,
+    PROMPT_HASHES,
+    build_lesson_system_prompt,
+    lesson_user_message,
+    build_section_system_prompt,
+    section_user_message,
+    helper_user_message,
+    insight_user_message,
+    build_inline_user_message,
+    build_related_tags_user_message,
+    build_chat_messages,
+    build_chat_summary_messages,
+)
+from chat_history import create_history_manager
+from auth_cache import create_token_cache
+from conversations import create_conversation_store, merge_context, new_conversation_id, UnknownConversationError
+from lesson_store import LessonStore, LessonNotFoundError, LessonAccessError, LessonConflictError, LessonVersionConflictError
 
 # Load environment variables
 load_dotenv()
@@ -33,580 +73,201 @@ except Exception as e:
     print(f"Error initializing Firebase Admin SDK: {e}")
 
 db = firestore.client()
+lesson_store = LessonStore(db)
 
 app = Flask(__name__)
 
+@app.before_request
+def start_request_timer():
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    # Upstream calls made while serving this request are attributed to its route
+    current_route.set(route)
+    g.request_timer = RequestTimer(route, request.method, request.content_length)
+
+@app.after_request
+def record_request(response):
+    timer = g.get('request_timer')
+    if timer is None:
+        return response
+    status = response.status_code
+    if response.is_streamed and not response.direct_passthrough:
+        # Streamed bodies are timed and counted as they are sent
+        response.response = timer.meter(response.response)
+        response.call_on_close(lambda: timer.finish(status))
+    else:
+        response.call_on_close(lambda: timer.finish(status, response.content_length))
+    return response
+
+# OPENAI_BASE_URL lets the app run against a local OpenAI-compatible server (see benchmarks/)
+OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL', 'https://api.openai.com/v1')
+
 # Initialize OpenAI client with API key from environment variable and custom HTTP client
 http_client = httpx.Client(
-    base_url="https://api.openai.com/v1",
+    base_url=OPENAI_BASE_URL,
     follow_redirects=True
 )
 
+# Retries are left to llm_scheduler, which also knows about the other requests in flight
 client = OpenAI(
     api_key=os.getenv('OPENAI_API_KEY'),
-    http_client=http_client
+    base_url=OPENAI_BASE_URL,
+    http_client=http_client,
+    max_retries=0
 )
 
-# Base system prompt
-CLIL_BASE_PROMPT = """You are a CLIL (Content and Language Integrated Learning) activity designer.
-Ensure responses contain more detailed explanations, longer lists, and richer descriptions.
-Keep the JSON structure exactly as defined but provide more extensive content in each field
-You must respond with a valid JSON object using exactly these fields:
-{
-    "content_objectives": [
-        "Objective 1",
-        "Objective 2",
-        ...
-    ],
-    "language_objectives": {
-        "key_vocabulary": ["word1", "word2", ...],
-        "language_structures": ["structure1", "structure2", ...],
-        "example_phrases": ["phrase1", "phrase2", ...]
-    },
-    "learning_tasks": [
-        {
-            "title": "Activity Title",
-            "description": "A clear and complete description of the activity, including its purpose and expected outcomes.",
-            "duration": "Estimated time to complete the activity",
-            "step_1_requirements": {
-                "name": "What You Need",
-                "description": "Everything needed to prepare for this activity.",
-                "elements": [
-                    {
-                        "name": "Materials & Tools",
-                        "details": [
-                            "A full list of necessary materials, tools, or resources.",
-                            "If text-based content (e.g., student handouts, story prompts, quiz questions), the **full text must be included**.",
-                            "If a list is referenced (e.g., 'list of historical events'), the **list must be fully provided**."
-                        ]
-                    },
-                    {
-                        "name": "Student Handouts / Reading Texts",
-                        "details": [
-                            "**Full delivery of any required text** (not just 'prepare a text' but the actual text)."
-                        ]
-                    },
-                    {
-                        "name": "Pre-Generated Content",
-                        "details": [
-                            "If applicable, provide at least **one** real example (e.g., a math problem, science hypothesis, story excerpt, discussion prompt)."
-                        ]
-                    }
-                ]
-            },
-            "step_2_execution": {
-                "name": "How to Run the Activity",
-                "description": "Step-by-step instructions on how to execute the activity.",
-                "elements": [
-                    {
-                        "name": "Process",
-                        "details": [
-                            "Detailed instructions on what to do at each stage.",
-                            "Clear guidance for students and facilitators."
-                        ]
-                    },
-                    {
-                        "name": "Potential Problems",
-                        "details": [
-                            "Common mistakes or difficulties that might arise.",
-                            "Ways to troubleshoot or adapt the activity."
-                        ]
-                    }
-                ]
-            },
-            "step_3_wrap_up": {
-                "name": "Wrap-Up & Reflection",
-                "description": "Final review, discussion, and follow-up tasks.",
-                "elements": [
-                    {
-                        "name": "Review Checklist",
-                        "details": [
-                            "A structured checklist to verify completion."
-                        ]
-                    },
-                    {
-                        "name": "Discussion Questions",
-                        "details": [
-                            "At least **three fully written** discussion questions."
-                        ]
-                    },
-                    {
-                        "name": "Next Steps",
-                        "details": [
-                            "Concrete suggestions for extending learning."
-                        ]
-                    }
-                ]
-            }
-        },
-        ...
-    ],
-    "assessment_criteria": [
-        {
-            "criterion": "What is being assessed",
-            "method": "How it will be assessed"
-        },
-        ...
-    ],
-    "text_deep_learning_input": {
-        "pareto_printable": {
-            "title": "Key Information About the Subject",
-            "points": [
-                {
-                    "point": "Point 1 about the subject",
-                    "explanation": "1-2 sentence explanation of this point"
-                },
-                // 9 more similar points for a total of 10
-            ]
-        },
-        "socratic_questions": {
-            "question_types": ["Analytical", "Comparative", "Reflective", "Cause & Effect", "Hypothetical", "Ethical"],
-            "example_questions": [
-                "(EXAMPLE) What is the main argument presented in the text?",
-                "(EXAMPLE) How does this idea relate to similar concepts in other subjects?",
-                "(EXAMPLE) What assumptions does the author make?",
-                "(EXAMPLE) What would happen if this idea were applied in a different context?",
-                "(EXAMPLE) How does this topic influence modern thinking or practice?",
-                "(EXAMPLE) What counterarguments could challenge the ideas in the text?"
-            ]
-        },
-        "extended_writing_exercises": {
-            "writing_types": ["Analytical Essay", "Creative Application", "Comparative Essay", "Reflective Writing", "Persuasive Writing"],
-            "example_tasks": [
-                {
-                    "task": "(EXAMPLE) Analysis & Argumentation",
-                    "description": "(EXAMPLE) Write a structured response analyzing the key argument of the text, using supporting evidence."
-                },
-                {
-                    "task": "(EXAMPLE) Creative Application",
-                    "description": "(EXAMPLE) Reimagine the concept in a different historical or futuristic setting and write a narrative incorporating the key ideas."
-                },
-                {
-                    "task": "(EXAMPLE) Comparison Essay",
-                    "description": "(EXAMPLE) Compare and contrast this topic with another related idea, explaining similarities and differences in a structured essay."
-                }
-            ]
-        }
-    }
-}"""
-
-# Prompt modifiers
-ACTIVITY_TYPES = {
-    "superhero": """Transform the activity using superhero themes:
-- Use superhero characters and powers as examples
-- Include superhero-themed vocabulary and scenarios
-- Reference popular superheroes in examples
-- Use superhero missions as learning challenges
-- Make students feel like heroes in training""",
-
-    "space": """Make the activity space-themed:
-- Use astronomy and space exploration examples
-- Include planets, stars, and space missions
-- Reference space technology and discoveries
-- Use space travel scenarios
-- Connect learning to space exploration""",
-
-    "mystery": """Turn the activity into a detective investigation:
-- Structure tasks as clues to solve
-- Include mysteries and puzzles
-- Use detective vocabulary and scenarios
-- Make students act as investigators
-- Create suspense and discovery moments""",
-
-    "music": """Integrate music throughout the activity:
-- Use songs and rhythm in learning
-- Include musical instruments as examples
-- Connect concepts to musical terms
-- Add singing and musical activities
-- Use music-based metaphors""",
-
-    "custom_theme_template": "Incorporate the following custom theme into the activity: '{custom_theme}'. Make all aspects of the activity (vocabulary, scenarios, examples, tone) reflect this custom theme.",
-
-    "station_rotation": {
-        "name": "Station Rotation",
-        "description": """Learning style where students rotate through different stations, each focusing on a specific aspect of the content:
-- Typically 3-5 stations with different learning objectives
-- Students work in small groups
-- Each station has a different learning approach (hands-on, digital, written, etc.)
-- Timed rotations (usually 15-20 minutes per station)
-- Can include teacher-led, independent, and collaborative stations"""
-    },
-    "think_pair_share": {
-        "name": "Think-Pair-Share",
-        "description": """Three-step collaborative learning structure:
-- Individual thinking time for concept processing
-- Pairing with a partner to discuss ideas
-- Sharing insights with the larger group
-- Emphasizes both individual reflection and collaborative learning
-- Builds speaking and listening skills"""
-    },
-    "project_based": {
-        "name": "Project Based",
-        "description": """Extended learning experience centered around a real-world project:
-- Focuses on creating a final product or presentation
-- Involves research, planning, and execution phases
-- Integrates multiple skills and subject areas
-- Emphasizes student autonomy and decision-making
-- Includes regular progress checks and feedback"""
-    },
-    "interactive_presentation": {
-        "name": "Interactive Presentation",
-        "description": """Engaging presentation format with active audience participation:
-- Combines direct instruction with student interaction
-- Includes regular check-ins and audience response moments
-- Uses multimedia elements
-- Incorporates quick activities and discussions
-- Balances teacher guidance with student participation"""
-    },
-    "debate_format": {
-        "name": "Debate Format",
-        "description": """Structured discussion format focusing on different viewpoints:
-- Clear positions or arguments to be defended
-- Research and preparation phase
-- Formal presentation of arguments
-- Rebuttal and counter-argument practice
-- Emphasis on evidence-based reasoning"""
-    },
-    "jigsaw_learning": {
-        "name": "Jigsaw Learning",
-        "description": """Cooperative learning strategy where students become experts in one area:
-- Students split into 'expert' groups for specific topics
-- Deep learning of assigned content
-- Regrouping to teach others their expertise
-- Everyone learns all parts from the experts
-- Builds teaching and communication skills"""
-    },
-    "lab_investigation": {
-        "name": "Lab Investigation",
-        "description": """Hands-on experimental learning approach:
-- Clear hypothesis or question to investigate
-- Step-by-step experimental procedure
-- Data collection and analysis
-- Drawing conclusions from evidence
-- Connecting findings to larger concepts"""
-    },
-    "research_present": {
-        "name": "Research & Present",
-        "description": """Independent research project with presentation component:
-- Topic selection and research question development
-- Information gathering from multiple sources
-- Analysis and synthesis of findings
-- Creation of presentation materials
-- Formal sharing of learning with peers"""
-    },
-    "game_based": {
-        "name": "Game Based Learning",
-        "description": """Learning through structured game activities:
-- Clear learning objectives within game format
-- Competitive or cooperative elements
-- Point systems or progress tracking
-- Immediate feedback and rewards
-- Fun and engaging interaction"""
-    },
-    "digital_story": {
-        "name": "Digital Story Creation",
-        "description": """Creating narrative content using digital tools:
-- Story planning and storyboarding
-- Digital media creation or selection
-- Narrative development
-- Technical production skills
-- Sharing and presenting final stories"""
-    },
-    "peer_teaching": {
-        "name": "Peer Teaching",
-        "description": """Students teaching other students:
-- Preparation of teaching materials
-- Clear explanation of concepts
-- Answering peer questions
-- Checking for understanding
-- Building teaching and leadership skills"""
-    },
-    "role_play": {
-        "name": "Role Play",
-        "description": """Learning through acting out scenarios:
-- Character/role assignment
-- Scenario preparation
-- Acting out situations
-- Reflection and discussion
-- Real-world application practice"""
-    },
-    "case_study": {
-        "name": "Case Study",
-        "description": """Analysis of specific real or simulated situations:
-- Detailed case information
-- Problem identification
-- Analysis of factors
-- Solution development
-- Application of learning to similar cases"""
-    },
-    
+# Concurrency limit, rate limits and retries for every OpenAI call (configured through LLM_* env vars).
+# Each finished call is recorded on /metrics and in the JSON log.
+llm_scheduler = create_scheduler(observer=UpstreamMetrics())
+
+# Worker threads for routes that fan out several upstream calls per request
+generation_pool = ThreadPoolExecutor(max_workers=int(os.getenv('GENERATION_POOL_SIZE', 16)))
+
+# Background insight generation for the tags of new helper cards (configured through INSIGHT_PREFETCH_* env vars).
+# Prefetches wait at background priority, so they get their own threads instead of blocking generation_pool.
+insight_prefetcher = create_insight_prefetcher()
+prefetch_pool = ThreadPoolExecutor(max_workers=int(os.getenv('INSIGHT_PREFETCH_WORKERS', 4)))
+
+# Headers that stop proxies from buffering server-sent events
+SSE_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+# Seconds of silence on a stream before a heartbeat comment is sent
+SSE_HEARTBEAT_SECONDS = float(os.getenv('SSE_HEARTBEAT_SECONDS', 15))
+
+# Shared response cache for repeated prompts (configured through LLM_CACHE_* env vars)
+response_cache = create_response_cache()
+
+# Identical prompts in flight at the same time share one upstream call, keyed like the response cache
+llm_flights = SingleFlight()
 
-}
+# Repair requests made for a JSON output that does not match its schema before the request fails
+STRUCTURED_OUTPUT_REPAIRS = int(os.getenv('STRUCTURED_OUTPUT_REPAIRS', 1))
 
-# Section-specific system prompts for customization
-SECTION_PROMPTS = {
-    "1": """You are a CLIL activity modifier focusing on Content Objectives.
-Current full activity context:
-{current_activity}
+def parse_structured(output, messages, content, complete):
+    """Validate content against output's schema, asking the model for targeted repairs when it does not match.
 
-You are being asked to modify the Content Objectives section.
-Customization request: {customization}
-
-Present the content objectives naturally and clearly. Structure your response in whatever way you think will be most helpful and clear for teachers.""",
-
-    "2": """You are a CLIL activity modifier focusing on Language Objectives.
-Current full activity context:
-{current_activity}
-
-You are being asked to modify the Language Objectives section.
-Customization request: {customization}
-
-Present the language objectives naturally and clearly. Include vocabulary, structures, and examples in whatever way makes most sense for this content.""",
-
-    "3": """You are a CLIL activity modifier focusing on Learning Tasks.
-Current full activity context:
-{current_activity}
-
-You are being asked to modify the Learning Tasks section.
-Customization request: {customization}
-
-Present the learning tasks naturally and clearly. Organize the activities in whatever way will be most useful for teachers implementing this lesson. 
-
-Each learning task should include:
-1. A clear title, description, and duration
-2. A structured sequence of three steps:
-   - Step 1: Requirements (What You Need)
-   - Step 2: Execution (How to Run the Activity)
-   - Step 3: Wrap-Up & Reflection
-
-For each step, include the specific elements as follows:
-
-Step 1 Requirements should include:
-- Materials & Tools: Provide a FULL list of all necessary materials, tools, or resources
-- Student Handouts / Reading Texts: Include the COMPLETE text of any handouts or readings
-- Pre-Generated Content: Provide at least one REAL example of content needed
-
-Step 2 Execution should include:
-- Process: Detailed instructions for each stage of the activity
-- Potential Problems: Common issues and how to address them
-
-Step 3 Wrap-Up should include:
-- Review Checklist: A structured list to verify completion
-- Discussion Questions: At least THREE fully written discussion questions
-- Next Steps: Concrete suggestions for extending learning
-
-IMPORTANT: For any materials, texts, or content mentioned, you MUST provide the FULL content, not just a description. If you mention a list, include the complete list. If you mention a text, provide the actual text.
-
-Avoid vague descriptions—provide real, practical examples and specific details that teachers can immediately use.""",
-
-    "4": """You are a CLIL activity modifier focusing on Assessment Criteria.
-Current full activity context:
-{current_activity}
-
-You are being asked to modify the Assessment Criteria section.
-Customization request: {customization}
-
-Present the assessment criteria naturally and clearly. Structure the evaluation methods in whatever way best explains how to assess student learning.""",
-
-    "5": """You are a CLIL activity modifier focusing on Text Deep Learning.
-Current full activity context:
-{current_activity}
-
-You are being asked to modify the Text Deep Learning section.
-Customization request: {customization}
-
-Your response should maintain the structure of a deep learning text analysis, including:
-1. A main reading passage or text guidelines
-2. An 80/20 Pareto summary of key points
-3. Socratic questions for discussion and analysis
-4. Extended writing exercises
-
-Consider these aspects when modifying:
-- Language complexity and accessibility
-- Critical thinking development
-- Cultural relevance and perspectives
-- Integration of content and language learning
-- Opportunities for active engagement and discussion
-
-Present your response in a clear, well-structured format that helps teachers implement deep learning strategies effectively."""
-}
-
-# Add helper system prompt
-HELPER_SYSTEM_PROMPT = """You are a CLIL teaching assistant providing contextual help for lesson planning.
-For any given topic, create a valid JSON object with these sections:
-
-{
-    "topic_overview": {
-        "title": "Topic Overview",
-        "description": "Brief overview of the main topic",
-        "key_concepts": ["concept1", "concept2", ...]
-    },
-    "teaching_aspects": [
-        {
-            "title": "Core Concepts",
-            "description": "Key concepts to cover in the lesson",
-            "tags": ["tag1", "tag2", ...]
-        },
-        {
-            "title": "Teaching Approaches",
-            "description": "Effective methods for this topic",
-            "tags": ["approach1", "approach2", ...]
-        },
-        {
-            "title": "Common Challenges",
-            "description": "Typical difficulties and solutions",
-            "tags": ["challenge1", "challenge2", ...]
-        }
-    ],
-    "suggested_resources": [
-        {
-            "type": "Resource type",
-            "description": "How to use this resource",
-            "examples": ["example1", "example2", ...]
-        }
+    complete(messages) runs one more completion and returns its text.
+    """
+    for attempt in range(STRUCTURED_OUTPUT_REPAIRS + 1):
+        try:
+            return output.parse(content)
+        except StructuredOutputError as e:
+            if attempt == STRUCTURED_OUTPUT_REPAIRS:
+                raise
+            log_event('structured_output_repair', schema=output.name, problems=e.problems[:5])
+            content = complete(output.repair_messages(messages, content, e))
+
+def cached_completion(system_prompt, user_message, response_format=None, model="gpt-4o-mini", use_cache=True,
+                      priority='normal', output=None):
+    """Run a single system + user completion, serving identical requests from the response cache.
+
+    With use_cache=False the cache lookup is skipped but the fresh result still replaces the stored one.
+    priority is the llm_scheduler queue the call waits in when the upstream is busy.
+    An identical completion already in flight is joined instead of repeated.
+    With output (a structured_outputs.StructuredOutput) the completion is constrained to its schema and
+    the validated object is returned; only valid JSON is cached.
+    """
+    if output is not None:
+        response_format = output.response_format
+    cache_key = make_cache_key(model, system_prompt, user_message, response_format)
+    if response_cache is not None and use_cache:
+        cached_content = response_cache.get(cache_key)
+        observe_cache(cached_content is not None)
+        if cached_content is not None:
+            if output is None:
+                return cached_content
+            try:
+                return output.parse(cached_content)
+            except StructuredOutputError:
+                pass
+
+    extra_args = {}
+    if response_format:
+        extra_args['response_format'] = response_format
+
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_message}
     ]
-}
-
-Make the content specific to the topic and useful for CLIL lesson customization.
-Remember to respond with a valid JSON object."""
-
-# Add insight generation prompt
-INSIGHT_PROMPT = """You are an expert CLIL teaching advisor within our educational app. A teacher has just received the following helper content about their lesson:
-
-{helper_context}
-
-The teacher clicked on the tag "{concept}" to learn more about this specific aspect. This indicates they want to understand this concept better and how it applies to their CLIL teaching.
-
-Provide a focused, practical explanation that builds upon the context above. Your response must be a valid JSON object using exactly this structure:
-
-{{
-    "title": "Brief title for {concept}",
-    "summary": "2-3 sentence overview connecting this concept to the context above",
-    "practical_tips": [
-        "Specific actionable tip that builds on the context",
-        "Another practical tip considering the teaching scenario",
-        "A third tip that helps implement this in CLIL"
-    ],
-    "example": {{
-        "scenario": "A real-world example that relates to the original helper content",
-        "application": "How to apply this in class, considering the full context"
-    }}
-}}
-
-Keep the explanation focused and actionable. Teachers should be able to use this information immediately in their CLIL context.
-Remember to respond with a valid JSON object."""
-
-# Add new system prompt for inline generation
-INLINE_GENERATION_PROMPT = """You are an AI assistant helping to generate inline content in a document editor.
-
-You will receive:
-1. Text that appears before the cursor position
-2. A command from the user about what to add/modify
-
-Your task is follow the user request and generate text that continues naturally from the above context.
-
-Respond ONLY with the text to be inserted, no explanations or markdown."""
-
-# Add chat system prompt
-CHAT_SYSTEM_PROMPT = """You are a friendly CLIL activity designer's assistant. Your mission is clear: gather the essential information needed to create a perfectly tailored CLIL activity. Think of yourself as a friendly guide who's helping teachers build the foundation for their perfect activity.
-
-Start conversations with enthusiasm about creating activities, like:
-"I'm excited to help you create a CLIL activity! To make it perfect for your class, let me learn a bit about your teaching context."
-"Let's design an activity that really works for your students! Tell me about your class setup."
-
-MISSION CHECKLIST (track what you know and what you still need):
-
-ESSENTIAL INFO (must have):
-✓ Student count
-✓ Grade/age level
-✓ Language proficiency
-✓ Lesson duration
-✓ Main topic/subject
-
-HELPFUL INFO (good to have):
-✓ Available technology
-✓ Classroom setup
-✓ Learning preferences
-✓ Cultural background
-✓ Previous knowledge
-
-Current class context:
-{class_context}
-
-ACTIVITY TYPE PREFERENCES:
-The teacher has indicated interest in the following activity types:
-{activity_types}
-
-INFORMATION GATHERING RULES:
-1. ALWAYS check what you already know from:
-   - Class context variables above
-   - Previous messages
-   - Indirect mentions
-2. NEVER ask about known information
-3. Keep track of what you've learned
-4. When you have enough info, say something like:
-   "Great! I think I have a good picture of your teaching context now. Would you like me to help create an activity that..."
-
-CONVERSATION STYLE:
-- always remeber about {class_context} and {activity_types}
-- Connect questions to activity creation ("This will help us choose the right group activities...")
-- Show how each piece of information will help
-- When activity types are selected, reference their specific features and benefits
-- Suggest activity types that complement the teacher's preferences
-
-READY TO CREATE CHECK:
-When you have gathered enough information (at least all ESSENTIAL INFO), say:
-"I think we have enough context to create a great activity now! Would you like me to help you design an activity that [summarize key points and include selected activity types]?"
-
-FINAL RESPONSE FORMAT:
-When you have gathered enough information and are ready to suggest an activity, ALWAYS structure your response exactly like this:
-
-"📋 ACTIVITY PARAMETERS:
-• Number of Students: [from class_context]
-• Grade/Age Level: [from class_context]
-• Language Skills: [from class_context]
-• Technical Vocabulary Density: [from class_context]%
-• Grammar Complexity Level: [from class_context]/5
-• Content vs Language Balance: [from class_context]% content focus
-• Selected Activity Types: [from activity_types]
-• Additional Context Gathered: [list any other relevant information collected during chat]
-
-🎯 SUGGESTED ACTIVITY:
-[Your detailed activity description here, incorporating all parameters above]"
-
-RESPONSE RULES:
-1. NEVER skip any parameters in the final response
-2. ALWAYS include ALL settings from class_context
-3. ALWAYS list ALL selected activity types
-4. If any essential parameter is missing, ask for it
-5. Use EXACTLY the format above for final activity suggestions
-6. Make sure the activity description clearly reflects all parameters
-
-Remember: Every question should clearly connect to creating a better-tailored activity. Keep the focus on gathering what we need to create something perfect for their specific context When delivering final response make sure to inslude avery piece of information that was gathered including all the is avaiable in the class_contect and the activity types variables that are avaiable to you.
-"""
-
-# Add tag generation prompt
-TAG_GENERATION_PROMPT = """You are a CLIL teaching assistant helping to generate related tags.
-Given a clicked tag and the context of the lesson, generate 3 closely related tags that would complement the clicked tag.
-Consider:
-- The existing tags in the context
-- The topic overview and key concepts
-- The overall lesson content and objectives
-- The pedagogical relevance for CLIL teaching
-
-Your response must be a valid JSON object with exactly this structure:
-{
-    "related_tags": ["tag1", "tag2", "tag3"]
-}
-
-The generated tags should:
-- Be concise (1-3 words)
-- Directly relate to CLIL teaching
-- Build upon the existing context
-- Offer new but related perspectives
-- Be useful for lesson planning
-
-Remember to respond with a valid JSON object."""
+
+    def create(messages):
+        response = llm_scheduler.call(
+            lambda: client.chat.completions.create(model=model, messages=messages, **extra_args),
+            priority=priority,
+            tokens=estimate_tokens(messages)
+        )
+        return response.choices[0].message.content
+
+    def complete():
+        content = create(messages)
+        result = content
+        if output is not None:
+            result = parse_structured(output, messages, content, create)
+            content = json.dumps(result, ensure_ascii=False)
+        if response_cache is not None and content:
+            response_cache.set(cache_key, content)
+        return result
+
+    return llm_flights.do(cache_key, complete)
+
+def insight_cache_key(concept, helper_context):
+    return make_cache_key(
+        "gpt-4o-mini",
+        INSIGHT_SYSTEM_PROMPT,
+        insight_user_message(concept, helper_context),
+        INSIGHT_OUTPUT.response_format
+    )
+
+def prefetch_insight(concept, helper_context):
+    """Generate one insight into the response cache ahead of the click."""
+    current_route.set('insight_prefetch')
+    cache_key = insight_cache_key(concept, helper_context)
+    insight_prefetcher.started(cache_key)
+    try:
+        cached_completion(
+            INSIGHT_SYSTEM_PROMPT,
+            insight_user_message(concept, helper_context),
+            output=INSIGHT_OUTPUT,
+            priority='background'
+        )
+        insight_prefetcher.finished(cache_key)
+    except Exception as e:
+        print(f"Error prefetching insight for {concept}: {e}")
+        insight_prefetcher.finished(cache_key, success=False)
+
+def prefetch_user_key(authorization, remote_addr):
+    """Whose prefetch budget a helper card counts against: the signed-in user, else the client address."""
+    if authorization.startswith('Bearer '):
+        try:
+            return token_cache.verify(authorization[len('Bearer '):])['uid']
+        except Exception:
+            pass
+    return remote_addr
+
+def insight_prefetch_enabled():
+    # Without the response cache a prefetched insight would have nowhere to wait for the click
+    return response_cache is not None and insight_prefetcher.enabled
+
+def schedule_insight_prefetch(user_key, helper_content):
+    if not insight_prefetch_enabled():
+        return
+    for concept, helper_context in insight_prefetcher.plan(user_key, helper_content):
+        prefetch_pool.submit(prefetch_insight, concept, helper_context)
+
+def summarize_chat_turns(previous_summary, turns):
+    """Fold older chat turns into the rolling conversation summary."""
+    messages = build_chat_summary_messages(previous_summary, turns)
+    # The chat reply waits for the summary, so it is as interactive as the chat itself
+    response = llm_scheduler.call(
+        lambda: client.chat.completions.create(model="gpt-4o-mini", messages=messages),
+        priority='interactive',
+        tokens=estimate_tokens(messages)
+    )
+    return response.choices[0].message.content
+
+# Keeps /chat prompts inside a token budget (configured through CHAT_HISTORY_* env vars)
+chat_history_manager = create_history_manager(summarize_chat_turns)
+
+# Server-side chat sessions (configured through CONVERSATION_STORE_* env vars)
+conversation_store = create_conversation_store()
 
 @app.route('/')
 def login():
@@ -620,89 +281,41 @@ def generate_activity():
     current_activity = request.json.get('current_activity', {})
     modifiers = request.json.get('modifiers', [])
     custom_theme_text = request.json.get('custom_theme_text', None)
+    use_cache = not request.json.get('fresh', False)
     
     try:
         if section == 'all':
             # Generate main lesson content
-            system_prompt = CLIL_BASE_PROMPT
-            modifier_prompts = ""
-            if modifiers:
-                modifier_prompts += "\n\nAdditional requirements:\n"
-                for mod in modifiers:
-                    if mod in ACTIVITY_TYPES:
-                        if isinstance(ACTIVITY_TYPES[mod], dict) and 'description' in ACTIVITY_TYPES[mod]:
-                            modifier_prompts += f"\n{ACTIVITY_TYPES[mod]['description']}\n"
-                        elif isinstance(ACTIVITY_TYPES[mod], str):
-                            modifier_prompts += f"\n{ACTIVITY_TYPES[mod]}\n"
-            
-            if custom_theme_text and custom_theme_text.strip():
-                if not modifier_prompts:
-                    modifier_prompts += "\n\nAdditional requirements:\n"
-                
-                # Use the template from ACTIVITY_TYPES
-                custom_theme_prompt_template = ACTIVITY_TYPES.get("custom_theme_template", "Incorporate the following custom theme into the activity: '{custom_theme}'.") # Fallback
-                modifier_prompts += f"\n{custom_theme_prompt_template.format(custom_theme=custom_theme_text)}\n"
+            system_prompt = build_lesson_system_prompt(modifiers, custom_theme_text)
             
-            if modifier_prompts:
-                system_prompt += modifier_prompts
-            
-            main_response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": f"Create a CLIL activity for: {user_prompt}. Respond with a JSON object following the exact structure provided."}
-                ],
-                response_format={ "type": "json_object" }
+            main_content = cached_completion(
+                system_prompt,
+                lesson_user_message(user_prompt),
+                output=LESSON_OUTPUT,
+                use_cache=use_cache
             )
             
             return jsonify({
                 "success": True,
-                "data": main_response.choices[0].message.content
+                "data": main_content
             })
             
         else:
             # Modified section customization
-            system_prompt = SECTION_PROMPTS[section].format(
-                current_activity=json.dumps(current_activity, indent=2),
-                customization=customization
-            )
-            
-            # Add modifiers if present (including custom theme for consistency if sections are regenerated with themes)
-            modifier_prompts_section = ""
-            if modifiers:
-                modifier_prompts_section += "\n\nAdditional theme requirements:\n"
-                for mod in modifiers:
-                    if mod in ACTIVITY_TYPES:
-                        if isinstance(ACTIVITY_TYPES[mod], dict) and 'description' in ACTIVITY_TYPES[mod]:
-                            modifier_prompts_section += f"\n{ACTIVITY_TYPES[mod]['description']}\n"
-                        elif isinstance(ACTIVITY_TYPES[mod], str):
-                            modifier_prompts_section += f"\n{ACTIVITY_TYPES[mod]}\n"
-            
-            if custom_theme_text and custom_theme_text.strip():
-                if not modifier_prompts_section:
-                    modifier_prompts_section += "\n\nAdditional theme requirements:\n"
-                
-                # Use the template from ACTIVITY_TYPES
-                custom_theme_prompt_template = ACTIVITY_TYPES.get("custom_theme_template", "Incorporate the following custom theme into the activity: '{custom_theme}'.") # Fallback
-                modifier_prompts_section += f"\n{custom_theme_prompt_template.format(custom_theme=custom_theme_text)}\n"
-            
-            if modifier_prompts_section:
-                system_prompt += modifier_prompts_section
+            system_prompt = build_section_system_prompt(section, modifiers, custom_theme_text)
             
             # Changed to allow natural text response
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": customization}
-                ]
+            section_content = cached_completion(
+                system_prompt,
+                section_user_message(customization, current_activity),
+                use_cache=use_cache
             )
             
             # Return the natural text response
             return jsonify({
                 "success": True,
                 "section": section,
-                "data": response.choices[0].message.content
+                "data": section_content
             })
             
     except Exception as e:
@@ -711,24 +324,222 @@ def generate_activity():
             "error": str(e)
         }), 500
 
+def iter_lesson_pillars(system_prompt, user_message, use_cache=True):
+    """Yield (key, value) for each top-level pillar of a full lesson as soon as its JSON is complete.
+
+    Served from the response cache when possible; a completed stream is stored back into it if it
+    matches the lesson schema. Identical lessons being generated at the same time share one upstream stream.
+    """
+    parser = TopLevelJSONStreamParser()
+    response_format = LESSON_OUTPUT.response_format
+
+    cache_key = make_cache_key("gpt-4o-mini", system_prompt, user_message, response_format)
+    if response_cache is not None and use_cache:
+        cached_content = response_cache.get(cache_key)
+        observe_cache(cached_content is not None)
+        if cached_content is not None:
+            yield from parser.feed(cached_content)
+            return
+
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_message}
+    ]
+    response = llm_flights.stream(cache_key, lambda: llm_scheduler.stream(
+        lambda: client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=messages,
+            response_format=response_format,
+            stream=True,
+            stream_options={"include_usage": True}
+        ),
+        tokens=estimate_tokens(messages)
+    ))
+
+    chunks = []
+    for chunk in response:
+        if chunk.choices and chunk.choices[0].delta.content:
+            text = chunk.choices[0].delta.content
+            chunks.append(text)
+            yield from parser.feed(text)
+
+    if response_cache is not None and parser.finished:
+        content = ''.join(chunks)
+        try:
+            LESSON_OUTPUT.parse(content)
+            response_cache.set(cache_key, content)
+        except StructuredOutputError as e:
+            log_event('structured_output_invalid', schema='lesson', problems=e.problems[:5])
+
+def iter_section_text(system_prompt, user_message, use_cache=True):
+    """Yield the text of a section customization as it is generated.
+
+    Shares its response cache entries with the non-streaming /generate route; a cached section
+    arrives as one piece. Closing the generator closes the upstream stream.
+    """
+    cache_key = make_cache_key("gpt-4o-mini", system_prompt, user_message)
+    if response_cache is not None and use_cache:
+        cached_content = response_cache.get(cache_key)
+        observe_cache(cached_content is not None)
+        if cached_content is not None:
+            yield cached_content
+            return
+
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_message}
+    ]
+    chunks = []
+    with contextlib.closing(llm_flights.stream(cache_key, lambda: llm_scheduler.stream(
+        lambda: client.chat.completions.create(
+            model="gpt-4o-mini", messages=messages, stream=True, stream_options={"include_usage": True}
+        ),
+        priority='interactive',
+        tokens=estimate_tokens(messages)
+    ))) as response:
+        for chunk in response:
+            if chunk.choices and chunk.choices[0].delta.content:
+                chunks.append(chunk.choices[0].delta.content)
+                yield chunks[-1]
+
+    if response_cache is not None and chunks:
+        response_cache.set(cache_key, ''.join(chunks))
+
+@app.route('/generate_section_stream', methods=['POST'])
+def generate_section_stream():
+    """Stream a section customization as server-sent events.
+
+    Takes the same fields as a section request to /generate. The text arrives as 'delta'
+    events with sequential ids and ends with 'done' or 'error'. When the client goes away
+    the upstream stream is closed, so no more tokens are read for it.
+    """
+    section = request.json.get('section')
+    try:
+        system_prompt = build_section_system_prompt(
+            section, request.json.get('modifiers', []), request.json.get('custom_theme_text', None)
+        )
+    except KeyError:
+        return jsonify({"success": False, "error": f"Unknown section: {section}"}), 400
+    user_message = section_user_message(request.json.get('customization', ''), request.json.get('current_activity', {}))
+    use_cache = not request.json.get('fresh', False)
+
+    def generate():
+        event_id = 0
+        try:
+            with contextlib.closing(iter_section_text(system_prompt, user_message, use_cache)) as pieces:
+                for text in pieces:
+                    event_id += 1
+                    yield sse_event({"text": text}, event='delta', event_id=event_id)
+            yield sse_event({"section": section}, event='done', event_id=event_id + 1)
+        except Exception as e:
+            print(f"Error in section streaming: {str(e)}")
+            yield sse_event({"error": str(e)}, event='error', event_id=event_id + 1)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers=SSE_HEADERS)
+
+@app.route('/generate_stream', methods=['POST'])
+def generate_activity_stream():
+    """Stream a full lesson, emitting each top-level pillar as soon as its JSON value is complete."""
+    user_prompt = request.json.get('prompt')
+    modifiers = request.json.get('modifiers', [])
+    custom_theme_text = request.json.get('custom_theme_text', None)
+    use_cache = not request.json.get('fresh', False)
+
+    system_prompt = build_lesson_system_prompt(modifiers, custom_theme_text)
+    user_message = lesson_user_message(user_prompt)
+
+    def generate():
+        try:
+            for key, value in iter_lesson_pillars(system_prompt, user_message, use_cache):
+                yield sse_event({"key": key, "value": value}, event='pillar')
+            yield sse_event({}, event='done')
+        except Exception as e:
+            print(f"Error in lesson streaming: {str(e)}")
+            yield sse_event({"error": str(e)}, event='error')
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers=SSE_HEADERS)
+
+@app.route('/generate_lesson', methods=['POST'])
+def generate_lesson():
+    """Generate the main lesson and its helper card concurrently over one SSE connection.
+
+    Main-lesson pillars arrive as 'pillar' events. Each part then reports its own
+    'part' event with a success flag, so a failure in one part never hides the other.
+    """
+    user_prompt = request.json.get('prompt')
+    modifiers = request.json.get('modifiers', [])
+    custom_theme_text = request.json.get('custom_theme_text', None)
+    use_cache = not request.json.get('fresh', False)
+
+    system_prompt = build_lesson_system_prompt(modifiers, custom_theme_text)
+    user_message = lesson_user_message(user_prompt)
+    # Verifying the ID token can cost a round trip, so only resolve the key when prefetching is on
+    user_key = None
+    if insight_prefetch_enabled():
+        user_key = prefetch_user_key(request.headers.get('Authorization', ''), request.remote_addr)
+    events = queue.Queue()
+
+    def run_main():
+        try:
+            for key, value in iter_lesson_pillars(system_prompt, user_message, use_cache):
+                events.put(sse_event({"key": key, "value": value}, event='pillar'))
+            events.put(sse_event({"part": "main", "success": True}, event='part'))
+        except Exception as e:
+            print(f"Error generating main content: {str(e)}")
+            events.put(sse_event({"part": "main", "success": False, "error": str(e)}, event='part'))
+        finally:
+            events.put(None)
+
+    def run_helper():
+        try:
+            helper_content = cached_completion(
+                HELPER_SYSTEM_PROMPT,
+                helper_user_message(user_prompt),
+                output=HELPER_OUTPUT,
+                use_cache=use_cache
+            )
+            events.put(sse_event({"part": "helper", "success": True, "data": helper_content}, event='part'))
+            schedule_insight_prefetch(user_key, helper_content)
+        except Exception as e:
+            print(f"Error generating helper content: {str(e)}")
+            events.put(sse_event({"part": "helper", "success": False, "error": str(e)}, event='part'))
+        finally:
+            events.put(None)
+
+    def generate():
+        # The pool threads run in a copy of this request's context, so their upstream calls keep its route
+        parts = [generation_pool.submit(contextvars.copy_context().run, part) for part in (run_main, run_helper)]
+        remaining = len(parts)
+        while remaining:
+            event = events.get()
+            if event is None:
+                remaining -= 1
+            else:
+                yield event
+        yield sse_event({}, event='done')
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers=SSE_HEADERS)
+
 @app.route('/generate_helper', methods=['POST'])
 def generate_helper():
     user_prompt = request.json.get('prompt')
     
     try:
         # Generate helper content
-        helper_response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": HELPER_SYSTEM_PROMPT},
-                {"role": "user", "content": f"Create a helper guide for teaching about: {user_prompt}. Respond with a JSON object following the exact structure provided."}
-            ],
-            response_format={ "type": "json_object" }
+        helper_content = cached_completion(
+            HELPER_SYSTEM_PROMPT,
+            helper_user_message(user_prompt),
+            output=HELPER_OUTPUT,
+            use_cache=not request.json.get('fresh', False)
         )
+        if insight_prefetch_enabled():
+            schedule_insight_prefetch(
+                prefetch_user_key(request.headers.get('Authorization', ''), request.remote_addr), helper_content
+            )
         
         return jsonify({
             "success": True,
-            "helper_data": helper_response.choices[0].message.content
+            "helper_data": helper_content
         })
         
     except Exception as e:
@@ -741,23 +552,27 @@ def generate_helper():
 def generate_insight():
     concept = request.json.get('concept')
     helper_context = request.json.get('helper_context', 'No context provided')
-    print(f"\n🤖 Generating insight for: {concept}")
+    use_cache = not request.json.get('fresh', False)
     
     try:
         # Generate insight content
-        print(f"📝 Sending to LLM with prompt:\n{INSIGHT_PROMPT.format(concept=concept, helper_context=helper_context)}")
-        insight_response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": INSIGHT_PROMPT.format(concept=concept, helper_context=helper_context)},
-                {"role": "user", "content": f"Explain this CLIL teaching concept: {concept}"}
-            ],
-            response_format={ "type": "json_object" }
+        user_message = insight_user_message(concept, helper_context)
+        log_event(
+            'insight', concept=concept, prompt=PROMPT_HASHES['insight'],
+            prompt_chars=len(INSIGHT_SYSTEM_PROMPT) + len(user_message), fresh=not use_cache
+        )
+        if insight_prefetcher.enabled and use_cache:
+            insight_prefetcher.record_click(insight_cache_key(concept, helper_context))
+        insight_content = cached_completion(
+            INSIGHT_SYSTEM_PROMPT,
+            user_message,
+            output=INSIGHT_OUTPUT,
+            use_cache=use_cache
         )
         
         return jsonify({
             "success": True,
-            "insight_data": insight_response.choices[0].message.content
+            "insight_data": insight_content
         })
         
     except Exception as e:
@@ -767,8 +582,30 @@ def generate_insight():
             "error": str(e)
         }), 500
 
+def usage_stats(chunk):
+    """Token usage reported on the final chunk of a stream, for a terminal 'done' event (None if missing)."""
+    usage = getattr(chunk, 'usage', None)
+    if usage is None:
+        return None
+    details = getattr(usage, 'prompt_tokens_details', None)
+    return {
+        "prompt_tokens": usage.prompt_tokens,
+        "cached_tokens": getattr(details, 'cached_tokens', None) or 0,
+        "completion_tokens": usage.completion_tokens,
+        "total_tokens": usage.total_tokens
+    }
+
 @app.route('/generate_inline', methods=['POST'])
 def generate_inline():
+    """Stream inline text for an editor command as server-sent events.
+
+    The text arrives as 'delta' events with sequential ids. A heartbeat comment is sent
+    after SSE_HEARTBEAT_SECONDS of silence, e.g. while the call waits for the upstream.
+    The stream ends with 'done' (token usage) or 'error'. When the client disconnects,
+    the next write (at the latest the next heartbeat) fails and the upstream stream is
+    closed, even while it is stalled waiting for the model. A stream shared with identical
+    requests is closed when the last of them disconnects, whichever started it.
+    """
     data = request.json
     content = data.get('content', '')  # Full HTML content (backup)
     command = data.get('command', '')
@@ -781,64 +618,67 @@ def generate_inline():
         # We could try to extract it from HTML here, but it's complex
         text_before_cursor = content
     
+    messages = [
+        {"role": "system", "content": INLINE_GENERATION_PROMPT},
+        {"role": "user", "content": build_inline_user_message(text_before_cursor, command)}
+    ]
+
     def generate():
+        event_id = 0
+        usage = None
         try:
-            # Log what we're using for debugging
-            print(f"Using text before cursor: {text_before_cursor[:100]}...")
-            
-            prompt = f"""Text we are working on:
-{text_before_cursor}
-
- user request: {command}
-
-."""
-
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": INLINE_GENERATION_PROMPT},
-                    {"role": "user", "content": prompt}
-                ],
-                stream=True
-            )
-
-            for chunk in response:
-                if chunk.choices[0].delta.content:
-                    yield chunk.choices[0].delta.content
-                    
+            # Identical commands on identical text (e.g. two open tabs) share one stream
+            flight_key = make_cache_key("gpt-4o-mini", INLINE_GENERATION_PROMPT, messages[1]['content'])
+
+            def create():
+                upstream = client.chat.completions.create(
+                    model="gpt-4o-mini", messages=messages, stream=True, stream_options={"include_usage": True}
+                )
+                # Kept with the shared stream, so whichever request leaves last can stop it
+                llm_flights.attach(flight_key, upstream)
+                return upstream
+
+            response = llm_flights.stream(flight_key, lambda: llm_scheduler.stream(
+                create, priority='interactive', tokens=estimate_tokens(messages)
+            ), interrupt=llm_scheduler.interrupt)
+
+            # When the client goes, stop a stalled upstream unless another request still reads it
+            with contextlib.closing(heartbeats(response, SSE_HEARTBEAT_SECONDS, response.leave)) as chunks:
+                for chunk in chunks:
+                    if chunk is None:
+                        yield sse_comment('heartbeat')
+                    elif chunk.choices and chunk.choices[0].delta.content:
+                        event_id += 1
+                        yield sse_event({"text": chunk.choices[0].delta.content}, event='delta', event_id=event_id)
+                    elif not chunk.choices:
+                        # The final usage chunk has no choices
+                        usage = usage_stats(chunk)
+
+            yield sse_event({"usage": usage}, event='done', event_id=event_id + 1)
         except Exception as e:
             print(f"Error in streaming: {str(e)}")
-            yield f"Error: {str(e)}"
+            yield sse_event({"error": str(e)}, event='error', event_id=event_id + 1)
 
-    return Response(generate(), mimetype='text/event-stream')
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers=SSE_HEADERS)
 
 @app.route('/generate_related_tags', methods=['POST'])
 def generate_related_tags():
     clicked_tag = request.json.get('tag')
     context = request.json.get('context', {})
     
-    # Enhanced context string
-    context_str = f"""
-Topic Overview: {context.get('topicOverview', '')}
-Key Concepts: {', '.join(context.get('keyConcepts', []))}
-Existing Tags: {', '.join(context.get('existingTags', []))}
-Current Content: {context.get('content', '')}
-    """
-    
     try:
-        # Generate related tags
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": TAG_GENERATION_PROMPT},
-                {"role": "user", "content": f"Generate 3 related tags for: {clicked_tag}\nContext:\n{context_str}"}
-            ],
-            response_format={ "type": "json_object" }
+        # Generate related tags; nothing waits on them, so they queue behind everything else.
+        # The same tag clicked in several classrooms at once is generated once.
+        tags = cached_completion(
+            TAG_GENERATION_PROMPT,
+            build_related_tags_user_message(clicked_tag, context),
+            output=RELATED_TAGS_OUTPUT,
+            priority='background'
         )
         
         return jsonify({
             "success": True,
-            "tags": response.choices[0].message.content
+            "tags": tags
         })
         
     except Exception as e:
@@ -848,6 +688,34 @@ Current Content: {context.get('content', '')}
             "error": str(e)
         }), 500
 
+@app.route('/cache_stats')
+def cache_stats():
+    if response_cache is None:
+        return jsonify({"enabled": False})
+    return jsonify({"enabled": True, **response_cache.stats()})
+
+@app.route('/scheduler_stats')
+def scheduler_stats():
+    return jsonify({
+        **llm_scheduler.stats(),
+        "single_flight": llm_flights.stats(),
+        "insight_prefetch": insight_prefetcher.stats()
+    })
+
+@app.route('/prompt_cache_stats')
+def prompt_cache_stats():
+    """Share of prompt tokens served from OpenAI's prompt prefix cache, per route (this process).
+
+    Also lists the hash of every static prompt: any edit to a prompt changes its hash and
+    starts the prefix cache over for that prompt.
+    """
+    return jsonify({**prompt_cache_report(), "prompts": PROMPT_HASHES})
+
+@app.route('/metrics')
+def metrics():
+    """Request, upstream, token, cost and cache metrics of this process in the Prometheus text format."""
+    return Response(render_metrics(), content_type=PROMETHEUS_CONTENT_TYPE)
+
 @app.route('/get-firebase-config')
 def get_firebase_config():
     firebase_config = {
@@ -870,65 +738,86 @@ def dashboard():
 def editor(lesson_id=None):
     return render_template('index.html', lesson_id=lesson_id)
 
+def resolve_chat_request(payload):
+    """Return (message, context, history, conversation_id) for a /chat request.
+
+    Without a conversation_id the request is stateless and carries its own history and context.
+    With one, the stored history is used and the request's context fields are merged into the stored context.
+    """
+    message = payload.get('message')
+    conversation_id = payload.get('conversation_id')
+    if not conversation_id:
+        return message, payload.get('context', {}), payload.get('history', []), None
+
+    conversation = conversation_store.get(conversation_id)
+    if conversation is None:
+        raise UnknownConversationError(conversation_id)
+    context = merge_context(conversation['context'], payload.get('context', {}))
+    return message, context, conversation['history'], conversation_id
+
+def record_chat_turn(conversation_id, context, history, message, reply):
+    """Append a completed exchange to a server-side conversation (no-op in stateless mode)."""
+    if not conversation_id:
+        return
+    conversation_store.save(conversation_id, {
+        "context": context,
+        "history": history + [
+            {"role": "user", "content": message},
+            {"role": "assistant", "content": reply}
+        ]
+    })
+
+def unknown_conversation_response():
+    # Tells the client to start a new session from its local history
+    return {"success": False, "error": "Unknown conversation", "unknown_conversation": True}
+
+@app.route('/conversations', methods=['POST'])
+def create_conversation():
+    """Start a server-side chat session, optionally seeded with existing history and context."""
+    payload = request.get_json(silent=True) or {}
+    conversation_id = new_conversation_id()
+    conversation_store.save(conversation_id, {
+        "context": payload.get('context', {}),
+        "history": payload.get('history', [])
+    })
+    return jsonify({"success": True, "conversation_id": conversation_id})
+
+@app.route('/conversations/<conversation_id>', methods=['DELETE'])
+def delete_conversation(conversation_id):
+    conversation_store.delete(conversation_id)
+    return jsonify({"success": True})
+
 @app.route('/chat', methods=['POST'])
 def chat():
-    message = request.json.get('message')
-    context = request.json.get('context', {})
-    history = request.json.get('history', [])
-    
-    # Format context variables for the prompt
-    class_context = context.get('class_context', {})
-    activity_types = context.get('activity_types', [])
-    
-    # Format class context string
-    class_context_str = f"""
-Current class information:
-- Number of students: {class_context.get('students_count', 'Not specified')}
-- Grade/Age level: {class_context.get('grade_level', 'Not specified')}
-- Language skills: {class_context.get('language_skills', 'Not specified')}
-
-Teaching Parameters:
-- Technical Vocabulary Density: {context.get('teaching_parameters', {}).get('vocab_density', 'Not specified')}%
-- Grammar Complexity Level: {context.get('teaching_parameters', {}).get('grammar_complexity', 'Not specified')}/5
-- Content vs Language Balance: {context.get('teaching_parameters', {}).get('content_language_balance', 'Not specified')}% Content focus
-"""
-    
-    # Format activity types string with descriptions
-    activity_types_str = "No specific activity types selected"
-    if activity_types:
-        activity_descriptions = []
-        for activity_type in activity_types:
-            if activity_type in ACTIVITY_TYPES and isinstance(ACTIVITY_TYPES[activity_type], dict):
-                activity_descriptions.append(f"- {ACTIVITY_TYPES[activity_type]['name']}:\n  {ACTIVITY_TYPES[activity_type]['description']}")
-            elif activity_type in ACTIVITY_TYPES:
-                activity_descriptions.append(f"- {activity_type}:\n  {ACTIVITY_TYPES[activity_type]}")
-        if activity_descriptions:
-            activity_types_str = "\n".join(activity_descriptions)
+    try:
+        message, context, history, conversation_id = resolve_chat_request(request.json)
+    except UnknownConversationError:
+        return jsonify(unknown_conversation_response()), 404
     
     try:
-        # Prepare messages array with system prompt and history
-        messages = [
-            {"role": "system", "content": CHAT_SYSTEM_PROMPT.format(
-                class_context=class_context_str,
-                activity_types=activity_types_str
-            )}
-        ]
-        
-        # Add conversation history
-        messages.extend(history)
-        
-        # Add current user message
-        messages.append({"role": "user", "content": message})
+        # Prepare messages array with system prompt, history and the current user message,
+        # folding older turns into a summary once the history outgrows the token budget
+        messages, history_report = chat_history_manager.compact(
+            build_chat_messages(message, context, history),
+            conversation_id
+        )
+        if history_report['tokens_saved']:
+            log_event('chat_compacted', **history_report)
         
         # Use the chat-specific system prompt with context
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages
+        response = llm_scheduler.call(
+            lambda: client.chat.completions.create(model="gpt-4o-mini", messages=messages),
+            priority='interactive',
+            tokens=estimate_tokens(messages)
         )
+        reply = response.choices[0].message.content
+        record_chat_turn(conversation_id, context, history, message, reply)
         
         return jsonify({
             "success": True,
-            "message": response.choices[0].message.content
+            "message": reply,
+            "conversation_id": conversation_id,
+            "history_tokens": history_report
         })
         
     except Exception as e:
@@ -938,102 +827,267 @@ Teaching Parameters:
             "error": str(e)
         }), 500
 
+@app.route('/chat_stream', methods=['POST'])
+def chat_stream():
+    """Stream a chat reply as server-sent events, in the same session modes as /chat.
+
+    Each piece of the reply is a 'delta' event with a sequential id; the stream ends with a
+    'done' event (conversation_id, history_tokens) or an 'error' event. The turn is only
+    recorded once the reply is complete, and a client that disconnects stops the upstream stream.
+    """
+    try:
+        message, context, history, conversation_id = resolve_chat_request(request.json)
+    except UnknownConversationError:
+        return jsonify(unknown_conversation_response()), 404
+
+    def generate():
+        event_id = 0
+        try:
+            messages, history_report = chat_history_manager.compact(
+                build_chat_messages(message, context, history),
+                conversation_id
+            )
+            if history_report['tokens_saved']:
+                log_event('chat_compacted', **history_report)
+
+            parts = []
+            with contextlib.closing(llm_scheduler.stream(
+                lambda: client.chat.completions.create(
+                    model="gpt-4o-mini", messages=messages, stream=True, stream_options={"include_usage": True}
+                ),
+                priority='interactive',
+                tokens=estimate_tokens(messages)
+            )) as response:
+                for chunk in response:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        parts.append(chunk.choices[0].delta.content)
+                        event_id += 1
+                        yield sse_event({"text": parts[-1]}, event='delta', event_id=event_id)
+
+            record_chat_turn(conversation_id, context, history, message, ''.join(parts))
+            yield sse_event(
+                {"conversation_id": conversation_id, "history_tokens": history_report},
+                event='done', event_id=event_id + 1
+            )
+        except Exception as e:
+            print(f"Error in chat stream: {str(e)}")
+            yield sse_event({"error": str(e)}, event='error', event_id=event_id + 1)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers=SSE_HEADERS)
+
+# Verified ID tokens are reused until they expire (configured through AUTH_* env vars)
+token_cache = create_token_cache(auth.verify_id_token)
+
+def require_user(view):
+    """Verify the Firebase ID token from the Authorization header and pass the user's uid to the view."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        authorization = request.headers.get('Authorization', '')
+        if not authorization.startswith('Bearer '):
+            return jsonify({"success": False, "error": "Missing ID token"}), 401
+        try:
+            decoded_token = token_cache.verify(authorization[len('Bearer '):])
+        except auth.ExpiredIdTokenError:
+            return jsonify({"success": False, "error": "Expired ID token"}), 401
+        except auth.RevokedIdTokenError:
+            return jsonify({"success": False, "error": "Revoked ID token"}), 401
+        except (auth.InvalidIdTokenError, ValueError):
+            # verify_id_token raises ValueError for an empty or malformed token
+            return jsonify({"success": False, "error": "Invalid ID token"}), 401
+        except auth.UserDisabledError:
+            return jsonify({"success": False, "error": "User account is disabled"}), 403
+        except auth.CertificateFetchError as e:
+            # Google's public keys could not be fetched: not the client's fault, so let it retry
+            print(f"Error fetching ID token certificates: {e}")
+            return jsonify({"success": False, "error": "Could not verify ID token, please try again"}), 503
+        except Exception as e:
+            print(f"Error verifying ID token: {e}")
+            return jsonify({"success": False, "error": str(e)}), 500
+        return view(decoded_token['uid'], *args, **kwargs)
+    return wrapper
+
+def lesson_write_error(e):
+    """Turn a lesson_store error into the JSON error response of the lesson save routes."""
+    if isinstance(e, ValueError):
+        return jsonify({"success": False, "error": str(e)}), 400
+    if isinstance(e, LessonNotFoundError):
+        return jsonify({"success": False, "error": "Lesson to update not found."}), 404
+    if isinstance(e, LessonAccessError):
+        return jsonify({"success": False, "error": "Unauthorized to update this lesson."}), 403
+    if isinstance(e, LessonVersionConflictError):
+        return jsonify({
+            "success": False,
+            "error": "The lesson was changed elsewhere since it was loaded.",
+            "currentVersion": e.current_version
+        }), 409
+    return jsonify({"success": False, "error": "The lesson is being saved elsewhere, please try again."}), 409
+
+LESSON_WRITE_ERRORS = (ValueError, LessonNotFoundError, LessonAccessError, LessonConflictError)
+
 @app.route('/save_lesson', methods=['POST'])
-def save_lesson():
+@require_user
+def save_lesson(uid):
     try:
-        id_token = request.headers.get('Authorization').split('Bearer ')[1]
-        decoded_token = auth.verify_id_token(id_token)
-        uid = decoded_token['uid']
-        
         lesson_data = request.json
         lesson_id = lesson_data.pop('lessonId', None)
-
-        lesson_data['userId'] = uid
-        lesson_data['lastModified'] = firestore.SERVER_TIMESTAMP
+        base_version = lesson_data.pop('baseVersion', None)
 
         if lesson_id:
-            # Update existing lesson
-            doc_ref = db.collection('lessons').document(lesson_id)
-            lesson_doc = doc_ref.get()
-            if not lesson_doc.exists:
-                 return jsonify({"success": False, "error": "Lesson to update not found."}), 404
-            if lesson_doc.to_dict().get('userId') != uid:
-                 return jsonify({"success": False, "error": "Unauthorized to update this lesson."}), 403
-            
-            doc_ref.set(lesson_data, merge=True)
-            return jsonify({"success": True, "lessonId": lesson_id})
+            # Update existing lesson (ownership check and write are one conditional update).
+            # Each top-level field sent replaces the stored one; nested maps are not merged.
+            version = lesson_store.update(uid, lesson_id, lesson_data, base_version=base_version)
+            return jsonify({"success": True, "lessonId": lesson_id, "version": version})
         else:
             # Create a new lesson document
-            doc_ref = db.collection('lessons').document()
-            doc_ref.set(lesson_data)
-            return jsonify({"success": True, "lessonId": doc_ref.id})
-            
-    except auth.InvalidIdTokenError:
-        return jsonify({"success": False, "error": "Invalid ID token"}), 401
+            return jsonify({"success": True, "lessonId": lesson_store.create(uid, lesson_data), "version": 1})
+
+    except LESSON_WRITE_ERRORS as e:
+        return lesson_write_error(e)
     except Exception as e:
         print(f"Error saving lesson: {e}")
         return jsonify({"success": False, "error": str(e)}), 500
 
+@app.route('/save_pillars/<lesson_id>', methods=['POST'])
+@require_user
+def save_pillars(uid, lesson_id):
+    """Persist several changed pillars of an existing lesson in one commit."""
+    try:
+        payload = request.json
+        version = lesson_store.save_pillars(
+            uid, lesson_id, payload.get('pillars', {}), base_version=payload.get('baseVersion')
+        )
+        return jsonify({"success": True, "lessonId": lesson_id, "version": version})
+    except LESSON_WRITE_ERRORS as e:
+        return lesson_write_error(e)
+    except Exception as e:
+        print(f"Error saving pillars: {e}")
+        return jsonify({"success": False, "error": str(e)}), 500
+
+@app.route('/patch_lesson/<lesson_id>', methods=['POST'])
+@require_user
+def patch_lesson(uid, lesson_id):
+    """Apply only the changed paths of a lesson, e.g. one appended pillar version or chat message."""
+    try:
+        payload = request.json
+        version = lesson_store.patch(uid, lesson_id, payload.get('ops'), base_version=payload.get('baseVersion'))
+        return jsonify({"success": True, "lessonId": lesson_id, "version": version})
+    except LESSON_WRITE_ERRORS as e:
+        return lesson_write_error(e)
+    except Exception as e:
+        print(f"Error patching lesson: {e}")
+        return jsonify({"success": False, "error": str(e)}), 500
+
+LESSON_PAGE_SIZE = 20
+MAX_LESSON_PAGE_SIZE = 100
+
 @app.route('/get_lessons', methods=['GET'])
-def get_lessons():
+@require_user
+def get_lessons(uid):
+    """List one page of the user's lessons; pass nextCursor back as ?cursor= for the next page.
+
+    nextCursor is "<lastModified ISO 8601>,<lesson id>" of the last lesson on the page.
+    """
     try:
-        # 1. Verify user token
-        id_token = request.headers.get('Authorization').split('Bearer ')[1]
-        decoded_token = auth.verify_id_token(id_token)
-        uid = decoded_token['uid']
-        
-        # 2. Query Firestore for lessons
-        lessons_ref = db.collection('lessons')
-        query = lessons_ref.where('userId', '==', uid).order_by('lastModified', direction=firestore.Query.DESCENDING)
-        results = query.stream()
-        
-        # 3. Format lessons for response
+        page_size = min(max(int(request.args.get('limit', LESSON_PAGE_SIZE)), 1), MAX_LESSON_PAGE_SIZE)
+        cursor = request.args.get('cursor')
+        if cursor:
+            last_modified, lesson_id = cursor.split(',')
+            if not lesson_id:
+                raise ValueError(cursor)
+            cursor = (datetime.fromisoformat(last_modified), lesson_id)
+        else:
+            cursor = None
+    except ValueError:
+        return jsonify({"success": False, "error": "Invalid limit or cursor"}), 400
+
+    try:
+        # 1. Read one page of lesson summaries from the user's index
+        summaries, next_cursor = lesson_store.list_lessons(uid, page_size, cursor)
+
+        # 2. Format lessons for response
         lessons = []
-        for lesson in results:
-            lesson_data = lesson.to_dict()
+        for summary in summaries:
             lessons.append({
-                "id": lesson.id,
-                "title": lesson_data.get("title", "Untitled Lesson"),
-                "lastModified": lesson_data.get("lastModified").strftime("%b %d, %Y")
+                "id": summary["id"],
+                "title": summary.get("title", "Untitled Lesson"),
+                "lastModified": summary["lastModified"].strftime("%b %d, %Y"),
+                "preview": summary.get("preview", ""),
+                "pillarVersions": summary.get("pillarVersions", {})
             })
-            
-        return jsonify({"success": True, "lessons": lessons}), 200
+
+        return jsonify({
+            "success": True,
+            "lessons": lessons,
+            "nextCursor": f"{next_cursor[0].isoformat()},{next_cursor[1]}" if next_cursor else None
+        }), 200
         
-    except auth.InvalidIdTokenError:
-        return jsonify({"success": False, "error": "Invalid ID token"}), 401
     except Exception as e:
         print(f"Error getting lessons: {e}")
         return jsonify({"success": False, "error": str(e)}), 500
 
 @app.route('/load_lesson/<lesson_id>', methods=['GET'])
-def load_lesson(lesson_id):
+@require_user
+def load_lesson(uid, lesson_id):
+    # Each pillar comes back as {versionCount, currentIndex, current}; ?versions=all adds the full versions lists.
+    # ?fields=title,pillars reads only those fields, so the editor can render before side cards and chat arrive.
+    fields = request.args.get('fields')
     try:
-        # 1. Verify user token
-        id_token = request.headers.get('Authorization').split('Bearer ')[1]
-        decoded_token = auth.verify_id_token(id_token)
-        uid = decoded_token['uid']
-        
-        # 2. Fetch lesson from Firestore
-        doc_ref = db.collection('lessons').document(lesson_id)
-        lesson = doc_ref.get()
-        
-        if not lesson.exists:
-            return jsonify({"success": False, "error": "Lesson not found"}), 404
-        
-        lesson_data = lesson.to_dict()
-        
-        # 3. Security check: ensure the user owns this lesson
-        if lesson_data.get('userId') != uid:
-            return jsonify({"success": False, "error": "Unauthorized"}), 403
-            
+        lesson_data = lesson_store.load(
+            uid, lesson_id,
+            all_versions=request.args.get('versions') == 'all',
+            fields=fields.split(',') if fields else None
+        )
         return jsonify({"success": True, "lesson": lesson_data}), 200
-        
-    except auth.InvalidIdTokenError:
-        return jsonify({"success": False, "error": "Invalid ID token"}), 401
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    except LessonNotFoundError:
+        return jsonify({"success": False, "error": "Lesson not found"}), 404
+    except LessonAccessError:
+        return jsonify({"success": False, "error": "Unauthorized"}), 403
     except Exception as e:
         print(f"Error loading lesson: {e}")
         return jsonify({"success": False, "error": str(e)}), 500
 
+@app.route('/lesson_versions/<lesson_id>/<pillar>/<int:index>', methods=['GET'])
+@require_user
+def lesson_versions(uid, lesson_id, pillar, index):
+    # Returns the stored chunk of versions around index, so paging through versions costs one read per chunk
+    try:
+        versions = lesson_store.load_versions(uid, lesson_id, pillar, index)
+        return jsonify({"success": True, "versions": {str(position): body for position, body in versions.items()}}), 200
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    except LessonNotFoundError:
+        return jsonify({"success": False, "error": "Version not found"}), 404
+    except LessonAccessError:
+        return jsonify({"success": False, "error": "Unauthorized"}), 403
+    except Exception as e:
+        print(f"Error loading lesson versions: {e}")
+        return jsonify({"success": False, "error": str(e)}), 500
+
+@app.route('/delete_lesson/<lesson_id>', methods=['DELETE'])
+@require_user
+def delete_lesson(uid, lesson_id):
+    try:
+        lesson_store.delete(uid, lesson_id)
+        return jsonify({"success": True, "lessonId": lesson_id})
+    except LESSON_WRITE_ERRORS as e:
+        return lesson_write_error(e)
+    except Exception as e:
+        print(f"Error deleting lesson: {e}")
+        return jsonify({"success": False, "error": str(e)}), 500
+
+@app.cli.command('rebuild-lesson-index')
+@click.argument('uids', nargs=-1)
+def rebuild_lesson_index(uids):
+    """Rebuild the dashboard lesson index for the given user ids, or for every user."""
+    if uids:
+        for uid in uids:
+            entries = lesson_store.rebuild_index(uid)
+            print(f"Rebuilt lesson index for {uid}: {len(entries)} lessons")
+    else:
+        print(f"Rebuilt lesson indexes for {lesson_store.rebuild_all_indexes()} users")
+
 if __name__ == '__main__':
     # Get port from environment variable or default to 5000
     port = int(os.environ.get('PORT', 5000))
@@ -0,0 +1,610 @@
+"""Async serving mode for the LLM-backed routes.
+
+Run with:
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+
+The LLM routes are served natively on the event loop through one shared
+AsyncOpenAI client backed by a pooled httpx.AsyncClient, so a slow generation
+only holds a coroutine and a pooled connection instead of a worker thread.
+Every other route (pages, lessons, Firebase config) is forwarded to the Flask
+app unchanged. Prompt assembly and the response cache are shared with app.py.
+"""
+import asyncio
+import contextlib
+import functools
+import json
+import os
+
+import httpx
+from a2wsgi import WSGIMiddleware
+from openai import AsyncOpenAI
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+from app import (
+    app as flask_app,
+    OPENAI_BASE_URL,
+    SSE_HEADERS,
+    SSE_HEARTBEAT_SECONDS,
+    usage_stats,
+    response_cache,
+    llm_scheduler,
+    llm_flights,
+    insight_prefetcher,
+    insight_cache_key,
+    prefetch_user_key,
+    insight_prefetch_enabled,
+    STRUCTURED_OUTPUT_REPAIRS,
+    chat_history_manager,
+    resolve_chat_request,
+    record_chat_turn,
+    unknown_conversation_response,
+)
+from conversations import UnknownConversationError
+from instrumentation import current_route, RequestTimer, observe_cache, log_event
+from llm_cache import make_cache_key
+from llm_scheduler import estimate_tokens
+from prompts import (
+    HELPER_SYSTEM_PROMPT,
+    INSIGHT_SYSTEM_PROMPT,
+    INLINE_GENERATION_PROMPT,
+    TAG_GENERATION_PROMPT,
+    PROMPT_HASHES,
+    build_lesson_system_prompt,
+    lesson_user_message,
+    build_section_system_prompt,
+    section_user_message,
+    helper_user_message,
+    insight_user_message,
+    build_inline_user_message,
+    build_related_tags_user_message,
+    build_chat_messages,
+)
+from streaming import sse_event, sse_comment, aheartbeats, TopLevelJSONStreamParser
+from structured_outputs import (
+    LESSON_OUTPUT, HELPER_OUTPUT, INSIGHT_OUTPUT, RELATED_TAGS_OUTPUT, StructuredOutputError
+)
+
+# One pooled HTTP client for all upstream calls. The limits are sized for
+# hundreds of concurrent generations; OpenAI keeps connections alive, so
+# reusing them saves a TLS handshake per request.
+async_http_client = httpx.AsyncClient(
+    limits=httpx.Limits(
+        max_connections=int(os.getenv('OPENAI_MAX_CONNECTIONS', 500)),
+        max_keepalive_connections=int(os.getenv('OPENAI_MAX_KEEPALIVE', 100)),
+        keepalive_expiry=30
+    ),
+    timeout=httpx.Timeout(float(os.getenv('OPENAI_TIMEOUT', 120)), connect=10.0),
+    follow_redirects=True
+)
+
+# Retries, like the concurrency and rate limits, come from the llm_scheduler shared with app.py
+async_client = AsyncOpenAI(
+    api_key=os.getenv('OPENAI_API_KEY'),
+    base_url=OPENAI_BASE_URL,
+    http_client=async_http_client,
+    max_retries=0
+)
+
+
+async def parse_structured_async(output, messages, content, complete):
+    """Async counterpart of app.parse_structured; complete is a coroutine function."""
+    for attempt in range(STRUCTURED_OUTPUT_REPAIRS + 1):
+        try:
+            return output.parse(content)
+        except StructuredOutputError as e:
+            if attempt == STRUCTURED_OUTPUT_REPAIRS:
+                raise
+            log_event('structured_output_repair', schema=output.name, problems=e.problems[:5])
+            content = await complete(output.repair_messages(messages, content, e))
+
+
+async def cached_completion_async(system_prompt, user_message, response_format=None, model="gpt-4o-mini", use_cache=True,
+                                  priority='normal', output=None):
+    """Async counterpart of app.cached_completion, sharing the same response cache."""
+    if output is not None:
+        response_format = output.response_format
+    cache_key = make_cache_key(model, system_prompt, user_message, response_format)
+    if response_cache is not None and use_cache:
+        # The SQLite backend can wait on a file lock, so cache reads and writes run off the event loop
+        cached_content = await asyncio.to_thread(response_cache.get, cache_key)
+        observe_cache(cached_content is not None)
+        if cached_content is not None:
+            if output is None:
+                return cached_content
+            try:
+                return output.parse(cached_content)
+            except StructuredOutputError:
+                pass
+
+    extra_args = {}
+    if response_format:
+        extra_args['response_format'] = response_format
+
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_message}
+    ]
+
+    async def create(messages):
+        response = await llm_scheduler.acall(
+            lambda: async_client.chat.completions.create(model=model, messages=messages, **extra_args),
+            priority=priority,
+            tokens=estimate_tokens(messages)
+        )
+        return response.choices[0].message.content
+
+    async def complete():
+        content = await create(messages)
+        result = content
+        if output is not None:
+            result = await parse_structured_async(output, messages, content, create)
+            content = json.dumps(result, ensure_ascii=False)
+        if response_cache is not None and content:
+            await asyncio.to_thread(response_cache.set, cache_key, content)
+        return result
+
+    return await llm_flights.ado(cache_key, complete)
+
+
+# Running prefetch tasks, referenced so they are not garbage collected mid-flight
+prefetch_tasks = set()
+
+
+async def prefetch_insight_async(concept, helper_context):
+    """Async counterpart of app.prefetch_insight."""
+    current_route.set('insight_prefetch')
+    cache_key = insight_cache_key(concept, helper_context)
+    insight_prefetcher.started(cache_key)
+    try:
+        await cached_completion_async(
+            INSIGHT_SYSTEM_PROMPT,
+            insight_user_message(concept, helper_context),
+            output=INSIGHT_OUTPUT,
+            priority='background'
+        )
+        insight_prefetcher.finished(cache_key)
+    except Exception as e:
+        print(f"Error prefetching insight for {concept}: {e}")
+        insight_prefetcher.finished(cache_key, success=False)
+
+
+async def schedule_insight_prefetch_async(request, helper_content):
+    if not insight_prefetch_enabled():
+        return
+    # Verifying the ID token may fetch Google's certificates, so keep it off the event loop
+    user_key = await asyncio.to_thread(
+        prefetch_user_key, request.headers.get('Authorization', ''), request.client.host if request.client else None
+    )
+    for concept, helper_context in insight_prefetcher.plan(user_key, helper_content):
+        task = asyncio.create_task(prefetch_insight_async(concept, helper_context))
+        prefetch_tasks.add(task)
+        task.add_done_callback(prefetch_tasks.discard)
+
+
+def instrumented(route, endpoint):
+    """Time an endpoint like app.py's request hooks do for the Flask routes."""
+    @functools.wraps(endpoint)
+    async def wrapper(request):
+        current_route.set(route)
+        timer = RequestTimer(route, request.method, len(await request.body()))
+        response = await endpoint(request)
+        if isinstance(response, StreamingResponse):
+            body = response.body_iterator
+
+            async def metered():
+                try:
+                    async for chunk in timer.ameter(body):
+                        yield chunk
+                finally:
+                    timer.finish(response.status_code)
+
+            response.body_iterator = metered()
+        else:
+            timer.finish(response.status_code, len(response.body))
+        return response
+    return wrapper
+
+
+def llm_route(path, endpoint):
+    return Route(path, instrumented(path, endpoint), methods=['POST'])
+
+
+def error_response(e, label):
+    print(f"Error {label}: {str(e)}")
+    return JSONResponse({"success": False, "error": str(e)}, status_code=500)
+
+
+async def generate_activity(request):
+    payload = await request.json()
+    user_prompt = payload.get('prompt')
+    section = payload.get('section', 'all')
+    modifiers = payload.get('modifiers', [])
+    custom_theme_text = payload.get('custom_theme_text', None)
+    use_cache = not payload.get('fresh', False)
+
+    try:
+        if section == 'all':
+            main_content = await cached_completion_async(
+                build_lesson_system_prompt(modifiers, custom_theme_text),
+                lesson_user_message(user_prompt),
+                output=LESSON_OUTPUT,
+                use_cache=use_cache
+            )
+            return JSONResponse({"success": True, "data": main_content})
+
+        section_content = await cached_completion_async(
+            build_section_system_prompt(section, modifiers, custom_theme_text),
+            section_user_message(payload.get('customization', ''), payload.get('current_activity', {})),
+            use_cache=use_cache
+        )
+        return JSONResponse({"success": True, "section": section, "data": section_content})
+
+    except Exception as e:
+        return error_response(e, "generating activity")
+
+
+async def aiter_lesson_pillars(system_prompt, user_message, use_cache=True):
+    """Async counterpart of app.iter_lesson_pillars."""
+    parser = TopLevelJSONStreamParser()
+    response_format = LESSON_OUTPUT.response_format
+
+    cache_key = make_cache_key("gpt-4o-mini", system_prompt, user_message, response_format)
+    if response_cache is not None and use_cache:
+        cached_content = await asyncio.to_thread(response_cache.get, cache_key)
+        observe_cache(cached_content is not None)
+        if cached_content is not None:
+            for pillar in parser.feed(cached_content):
+                yield pillar
+            return
+
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_message}
+    ]
+    response = llm_flights.astream(cache_key, lambda: llm_scheduler.astream(
+        lambda: async_client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=messages,
+            response_format=response_format,
+            stream=True,
+            stream_options={"include_usage": True}
+        ),
+        tokens=estimate_tokens(messages)
+    ))
+
+    chunks = []
+    async for chunk in response:
+        if chunk.choices and chunk.choices[0].delta.content:
+            text = chunk.choices[0].delta.content
+            chunks.append(text)
+            for pillar in parser.feed(text):
+                yield pillar
+
+    if response_cache is not None and parser.finished:
+        content = ''.join(chunks)
+        try:
+            LESSON_OUTPUT.parse(content)
+            await asyncio.to_thread(response_cache.set, cache_key, content)
+        except StructuredOutputError as e:
+            log_event('structured_output_invalid', schema='lesson', problems=e.problems[:5])
+
+
+async def generate_activity_stream(request):
+    payload = await request.json()
+    system_prompt = build_lesson_system_prompt(payload.get('modifiers', []), payload.get('custom_theme_text', None))
+    user_message = lesson_user_message(payload.get('prompt'))
+    use_cache = not payload.get('fresh', False)
+
+    async def generate():
+        try:
+            async for key, value in aiter_lesson_pillars(system_prompt, user_message, use_cache):
+                yield sse_event({"key": key, "value": value}, event='pillar')
+            yield sse_event({}, event='done')
+        except Exception as e:
+            print(f"Error in lesson streaming: {str(e)}")
+            yield sse_event({"error": str(e)}, event='error')
+
+    return StreamingResponse(generate(), media_type='text/event-stream', headers=SSE_HEADERS)
+
+
+async def aiter_section_text(system_prompt, user_message, use_cache=True):
+    """Async counterpart of app.iter_section_text."""
+    cache_key = make_cache_key("gpt-4o-mini", system_prompt, user_message)
+    if response_cache is not None and use_cache:
+        cached_content = await asyncio.to_thread(response_cache.get, cache_key)
+        observe_cache(cached_content is not None)
+        if cached_content is not None:
+            yield cached_content
+            return
+
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_message}
+    ]
+    chunks = []
+    async with contextlib.aclosing(llm_flights.astream(cache_key, lambda: llm_scheduler.astream(
+        lambda: async_client.chat.completions.create(
+            model="gpt-4o-mini", messages=messages, stream=True, stream_options={"include_usage": True}
+        ),
+        priority='interactive',
+        tokens=estimate_tokens(messages)
+    ))) as response:
+        async for chunk in response:
+            if chunk.choices and chunk.choices[0].delta.content:
+                chunks.append(chunk.choices[0].delta.content)
+                yield chunks[-1]
+
+    if response_cache is not None and chunks:
+        await asyncio.to_thread(response_cache.set, cache_key, ''.join(chunks))
+
+
+async def generate_section_stream(request):
+    """Async counterpart of app.generate_section_stream."""
+    payload = await request.json()
+    section = payload.get('section')
+    try:
+        system_prompt = build_section_system_prompt(
+            section, payload.get('modifiers', []), payload.get('custom_theme_text', None)
+        )
+    except KeyError:
+        return JSONResponse({"success": False, "error": f"Unknown section: {section}"}, status_code=400)
+    user_message = section_user_message(payload.get('customization', ''), payload.get('current_activity', {}))
+    use_cache = not payload.get('fresh', False)
+
+    async def generate():
+        event_id = 0
+        try:
+            # Starlette cancels this generator when the client disconnects; aclosing then closes the upstream stream
+            async with contextlib.aclosing(aiter_section_text(system_prompt, user_message, use_cache)) as pieces:
+                async for text in pieces:
+                    event_id += 1
+                    yield sse_event({"text": text}, event='delta', event_id=event_id)
+            yield sse_event({"section": section}, event='done', event_id=event_id + 1)
+        except Exception as e:
+            print(f"Error in section streaming: {str(e)}")
+            yield sse_event({"error": str(e)}, event='error', event_id=event_id + 1)
+
+    return StreamingResponse(generate(), media_type='text/event-stream', headers=SSE_HEADERS)
+
+
+async def generate_lesson(request):
+    payload = await request.json()
+    user_prompt = payload.get('prompt')
+    system_prompt = build_lesson_system_prompt(payload.get('modifiers', []), payload.get('custom_theme_text', None))
+    user_message = lesson_user_message(user_prompt)
+    use_cache = not payload.get('fresh', False)
+    events = asyncio.Queue()
+
+    async def run_main():
+        try:
+            async for key, value in aiter_lesson_pillars(system_prompt, user_message, use_cache):
+                await events.put(sse_event({"key": key, "value": value}, event='pillar'))
+            await events.put(sse_event({"part": "main", "success": True}, event='part'))
+        except Exception as e:
+            print(f"Error generating main content: {str(e)}")
+            await events.put(sse_event({"part": "main", "success": False, "error": str(e)}, event='part'))
+        finally:
+            await events.put(None)
+
+    async def run_helper():
+        try:
+            helper_content = await cached_completion_async(
+                HELPER_SYSTEM_PROMPT,
+                helper_user_message(user_prompt),
+                output=HELPER_OUTPUT,
+                use_cache=use_cache
+            )
+            await events.put(sse_event({"part": "helper", "success": True, "data": helper_content}, event='part'))
+            await schedule_insight_prefetch_async(request, helper_content)
+        except Exception as e:
+            print(f"Error generating helper content: {str(e)}")
+            await events.put(sse_event({"part": "helper", "success": False, "error": str(e)}, event='part'))
+        finally:
+            await events.put(None)
+
+    async def generate():
+        parts = [asyncio.create_task(run_main()), asyncio.create_task(run_helper())]
+        try:
+            remaining = len(parts)
+            while remaining:
+                event = await events.get()
+                if event is None:
+                    remaining -= 1
+                else:
+                    yield event
+            yield sse_event({}, event='done')
+        finally:
+            # The client went away before both parts finished
+            for part in parts:
+                part.cancel()
+
+    return StreamingResponse(generate(), media_type='text/event-stream', headers=SSE_HEADERS)
+
+
+async def generate_helper(request):
+    payload = await request.json()
+    try:
+        helper_content = await cached_completion_async(
+            HELPER_SYSTEM_PROMPT,
+            helper_user_message(payload.get('prompt')),
+            output=HELPER_OUTPUT,
+            use_cache=not payload.get('fresh', False)
+        )
+        await schedule_insight_prefetch_async(request, helper_content)
+        return JSONResponse({"success": True, "helper_data": helper_content})
+    except Exception as e:
+        return error_response(e, "generating helper")
+
+
+async def generate_insight(request):
+    payload = await request.json()
+    concept = payload.get('concept')
+    helper_context = payload.get('helper_context', 'No context provided')
+    use_cache = not payload.get('fresh', False)
+    try:
+        user_message = insight_user_message(concept, helper_context)
+        log_event(
+            'insight', concept=concept, prompt=PROMPT_HASHES['insight'],
+            prompt_chars=len(INSIGHT_SYSTEM_PROMPT) + len(user_message), fresh=not use_cache
+        )
+        if insight_prefetcher.enabled and use_cache:
+            insight_prefetcher.record_click(insight_cache_key(concept, helper_context))
+        insight_content = await cached_completion_async(
+            INSIGHT_SYSTEM_PROMPT,
+            user_message,
+            output=INSIGHT_OUTPUT,
+            use_cache=use_cache
+        )
+        return JSONResponse({"success": True, "insight_data": insight_content})
+    except Exception as e:
+        return error_response(e, "generating insight")
+
+
+async def generate_inline(request):
+    """Async counterpart of app.generate_inline."""
+    payload = await request.json()
+    command = payload.get('command', '')
+    text_before_cursor = payload.get('text_before_cursor', '') or payload.get('content', '')
+    messages = [
+        {"role": "system", "content": INLINE_GENERATION_PROMPT},
+        {"role": "user", "content": build_inline_user_message(text_before_cursor, command)}
+    ]
+
+    async def generate():
+        event_id = 0
+        usage = None
+        try:
+            flight_key = make_cache_key("gpt-4o-mini", INLINE_GENERATION_PROMPT, messages[1]['content'])
+            response = llm_flights.astream(flight_key, lambda: llm_scheduler.astream(
+                lambda: async_client.chat.completions.create(
+                    model="gpt-4o-mini", messages=messages, stream=True, stream_options={"include_usage": True}
+                ),
+                priority='interactive',
+                tokens=estimate_tokens(messages)
+            ))
+            # Starlette cancels this generator when the client disconnects; aclosing then closes the upstream stream
+            async with contextlib.aclosing(aheartbeats(response, SSE_HEARTBEAT_SECONDS)) as chunks:
+                async for chunk in chunks:
+                    if chunk is None:
+                        yield sse_comment('heartbeat')
+                    elif chunk.choices and chunk.choices[0].delta.content:
+                        event_id += 1
+                        yield sse_event({"text": chunk.choices[0].delta.content}, event='delta', event_id=event_id)
+                    elif not chunk.choices:
+                        usage = usage_stats(chunk)
+
+            yield sse_event({"usage": usage}, event='done', event_id=event_id + 1)
+        except Exception as e:
+            print(f"Error in streaming: {str(e)}")
+            yield sse_event({"error": str(e)}, event='error', event_id=event_id + 1)
+
+    return StreamingResponse(generate(), media_type='text/event-stream', headers=SSE_HEADERS)
+
+
+async def generate_related_tags(request):
+    payload = await request.json()
+    try:
+        tags = await cached_completion_async(
+            TAG_GENERATION_PROMPT,
+            build_related_tags_user_message(payload.get('tag'), payload.get('context', {})),
+            output=RELATED_TAGS_OUTPUT,
+            priority='background'
+        )
+        return JSONResponse({"success": True, "tags": tags})
+    except Exception as e:
+        return error_response(e, "generating tags")
+
+
+async def chat(request):
+    payload = await request.json()
+    try:
+        message, context, history, conversation_id = await asyncio.to_thread(resolve_chat_request, payload)
+    except UnknownConversationError:
+        return JSONResponse(unknown_conversation_response(), status_code=404)
+
+    try:
+        messages = build_chat_messages(message, context, history)
+        # Compaction may call the summarizer synchronously, so keep it off the event loop
+        messages, history_report = await asyncio.to_thread(chat_history_manager.compact, messages, conversation_id)
+        response = await llm_scheduler.acall(
+            lambda: async_client.chat.completions.create(model="gpt-4o-mini", messages=messages),
+            priority='interactive',
+            tokens=estimate_tokens(messages)
+        )
+        reply = response.choices[0].message.content
+        await asyncio.to_thread(record_chat_turn, conversation_id, context, history, message, reply)
+        return JSONResponse({
+            "success": True,
+            "message": reply,
+            "conversation_id": conversation_id,
+            "history_tokens": history_report
+        })
+    except Exception as e:
+        return error_response(e, "in chat")
+
+
+async def chat_stream(request):
+    """Async counterpart of app.chat_stream."""
+    payload = await request.json()
+    try:
+        message, context, history, conversation_id = await asyncio.to_thread(resolve_chat_request, payload)
+    except UnknownConversationError:
+        return JSONResponse(unknown_conversation_response(), status_code=404)
+
+    async def generate():
+        event_id = 0
+        try:
+            messages = build_chat_messages(message, context, history)
+            messages, history_report = await asyncio.to_thread(chat_history_manager.compact, messages, conversation_id)
+            parts = []
+            # Starlette cancels this generator when the client disconnects; aclosing then closes the upstream stream
+            async with contextlib.aclosing(llm_scheduler.astream(
+                lambda: async_client.chat.completions.create(
+                    model="gpt-4o-mini", messages=messages, stream=True, stream_options={"include_usage": True}
+                ),
+                priority='interactive',
+                tokens=estimate_tokens(messages)
+            )) as response:
+                async for chunk in response:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        parts.append(chunk.choices[0].delta.content)
+                        event_id += 1
+                        yield sse_event({"text": parts[-1]}, event='delta', event_id=event_id)
+
+            await asyncio.to_thread(record_chat_turn, conversation_id, context, history, message, ''.join(parts))
+            yield sse_event(
+                {"conversation_id": conversation_id, "history_tokens": history_report},
+                event='done', event_id=event_id + 1
+            )
+        except Exception as e:
+            print(f"Error in chat stream: {str(e)}")
+            yield sse_event({"error": str(e)}, event='error', event_id=event_id + 1)
+
+    return StreamingResponse(generate(), media_type='text/event-stream', headers=SSE_HEADERS)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    yield
+    await async_http_client.aclose()
+
+
+app = Starlette(
+    routes=[
+        llm_route('/generate', generate_activity),
+        llm_route('/generate_stream', generate_activity_stream),
+        llm_route('/generate_section_stream', generate_section_stream),
+        llm_route('/generate_lesson', generate_lesson),
+        llm_route('/generate_helper', generate_helper),
+        llm_route('/generate_insight', generate_insight),
+        llm_route('/generate_inline', generate_inline),
+        llm_route('/generate_related_tags', generate_related_tags),
+        llm_route('/chat', chat),
+        llm_route('/chat_stream', chat_stream),
+        # Everything else is served by the existing Flask app, whose request hooks time it (and serve /metrics)
+        Mount('/', app=WSGIMiddleware(flask_app)),
+    ],
+    lifespan=lifespan
+)
@@ -0,0 +1,96 @@
+"""Cache of verified Firebase ID tokens.
+
+The dashboard and editor call the lesson routes repeatedly with the same ID
+token, and every call used to run a full signature verification. Verified
+claims are now kept, keyed by a hash of the token, until the token's own
+`exp` time. The cache is bounded with LRU eviction.
+
+Revocation checks are configurable through revocation_check_interval:
+- None: never check revocation (same as plain auth.verify_id_token)
+- 0: check on every request, which effectively bypasses the cache
+- N > 0: cached claims are re-verified with check_revoked=True at most every N seconds
+
+create_token_cache reads the cache size from AUTH_TOKEN_CACHE_MAX_ENTRIES and
+the interval from AUTH_REVOCATION_CHECK_INTERVAL.
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Stop trusting cached claims slightly before the token really expires
+EXPIRY_MARGIN_SECONDS = 5
+
+
+class VerifiedTokenCache:
+    """Wrap a verifier such as firebase_admin.auth.verify_id_token with an expiring LRU cache.
+
+    verify is called as verify(id_token, check_revoked=bool) and must raise on invalid tokens.
+    Failed verifications are never cached.
+    """
+
+    def __init__(self, verify, max_entries=1024, revocation_check_interval=None, clock=time.time):
+        self._verify = verify
+        self.max_entries = max_entries
+        self.revocation_check_interval = revocation_check_interval
+        self._clock = clock
+        # token hash -> (claims, expires_at, verified_at)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def verify(self, id_token):
+        key = hashlib.sha256(id_token.encode('utf-8')).hexdigest()
+        now = self._clock()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                claims, expires_at, verified_at = entry
+                if now < expires_at and not self._revocation_check_due(verified_at, now):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return claims
+                del self._entries[key]
+            self.misses += 1
+
+        claims = self._verify(id_token, check_revoked=self.revocation_check_interval is not None)
+
+        expires_at = claims.get('exp', 0) - EXPIRY_MARGIN_SECONDS
+        if expires_at > now and self.revocation_check_interval != 0:
+            with self._lock:
+                self._entries[key] = (claims, expires_at, now)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return claims
+
+    def _revocation_check_due(self, verified_at, now):
+        if self.revocation_check_interval is None:
+            return False
+        return now - verified_at >= self.revocation_check_interval
+
+    def invalidate(self, id_token):
+        key = hashlib.sha256(id_token.encode('utf-8')).hexdigest()
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+def create_token_cache(verify):
+    """Build a VerifiedTokenCache configured by environment variables.
+
+    AUTH_TOKEN_CACHE_MAX_ENTRIES bounds the cache (default 1024). AUTH_REVOCATION_CHECK_INTERVAL
+    is unset/empty for no revocation checks, or a number of seconds.
+    """
+    interval = os.getenv('AUTH_REVOCATION_CHECK_INTERVAL', '')
+    return VerifiedTokenCache(
+        verify,
+        max_entries=int(os.getenv('AUTH_TOKEN_CACHE_MAX_ENTRIES', 1024)),
+        revocation_check_interval=int(interval) if interval.strip() else None
+    )
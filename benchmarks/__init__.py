@@ -0,0 +1,4 @@
+"""Offline benchmarks for the CLIL activity generator.
+
+Run them from the repository root, e.g. `python -m benchmarks.load_test`.
+"""
@@ -0,0 +1,93 @@
+"""Workshop burst: many teachers clicking the same few helper tags at once.
+
+Starts benchmarks.fake_openai and sends a burst of insight-style requests
+spread over a handful of distinct prompts, first straight to the upstream and
+then through single_flight.SingleFlight, and counts upstream calls. Half of the
+requests are streamed, to check that every subscriber of a shared stream
+receives the complete text.
+
+    python -m benchmarks.coalescing --teachers 120 --tags 6
+"""
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+
+import httpx
+from openai import AsyncOpenAI
+
+from benchmarks.load_test import start_process, wait_until_ready
+from single_flight import SingleFlight
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--teachers', type=int, default=120)
+    parser.add_argument('--tags', type=int, default=6, help="distinct prompts in the burst")
+    parser.add_argument('--latency', type=float, default=1.0, help="fake upstream latency in seconds")
+    parser.add_argument('--fake-port', type=int, default=8102)
+    args = parser.parse_args()
+
+    fake = start_process([
+        sys.executable, '-m', 'benchmarks.fake_openai', '--port', str(args.fake_port),
+        '--latency', str(args.latency), '--tokens-per-second', '400'
+    ])
+    http_client = httpx.AsyncClient(limits=httpx.Limits(max_connections=args.teachers))
+    client = AsyncOpenAI(
+        api_key='fake-key', base_url=f'http://127.0.0.1:{args.fake_port}/v1', http_client=http_client, max_retries=0
+    )
+    upstream_calls = 0
+
+    def messages_for(i):
+        return [{"role": "user", "content": f"Explain the concept: tag {i % args.tags}"}]
+
+    async def complete(i):
+        nonlocal upstream_calls
+        upstream_calls += 1
+        response = await client.chat.completions.create(model="gpt-4o-mini", messages=messages_for(i))
+        return response.choices[0].message.content
+
+    async def stream(i):
+        nonlocal upstream_calls
+        upstream_calls += 1
+        response = await client.chat.completions.create(model="gpt-4o-mini", messages=messages_for(i), stream=True)
+        async for chunk in response:
+            yield chunk
+
+    async def collect(chunks):
+        return ''.join([chunk.choices[0].delta.content or '' async for chunk in chunks if chunk.choices])
+
+    async def run(name, one_request):
+        nonlocal upstream_calls
+        upstream_calls = 0
+
+        async def timed(i):
+            started = time.perf_counter()
+            text = await one_request(i)
+            return text, time.perf_counter() - started
+
+        results = await asyncio.gather(*(timed(i) for i in range(args.teachers)))
+        texts = {text for text, _ in results}
+        latencies = [latency for _, latency in results]
+        print(f"{name:<12}{args.teachers:>10}{upstream_calls:>16}{statistics.median(latencies):>10.2f}s"
+              f"{max(latencies):>10.2f}s   {'identical' if len(texts) == 1 else f'{len(texts)} different'} texts")
+
+    try:
+        await wait_until_ready(f'http://127.0.0.1:{args.fake_port}/')
+        flights = SingleFlight()
+        print(f"{'mode':<12}{'requests':>10}{'upstream calls':>16}{'p50':>11}{'max':>11}")
+        await run("direct", lambda i: complete(i) if i % 2 else collect(stream(i)))
+        await run("coalesced", lambda i: (
+            flights.ado(f'complete-{i % args.tags}', lambda: complete(i)) if i % 2
+            else collect(flights.astream(f'stream-{i % args.tags}', lambda: stream(i)))
+        ))
+        print(f"single flight: {flights.stats()}")
+    finally:
+        await http_client.aclose()
+        fake.terminate()
+        fake.wait()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
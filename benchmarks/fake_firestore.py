@@ -0,0 +1,380 @@
+"""In-memory stand-in for the parts of the Firestore client that lesson_store.py uses.
+
+Every call that would be a network round trip against real Firestore is
+counted in round_trips, every document returned in documents_read and the
+JSON size of what was returned in bytes_read, so benchmarks can compare
+access patterns without a Firestore project or the emulator. An optional per-call latency simulates the network.
+
+    from benchmarks.fake_firestore import FakeFirestore
+    db = FakeFirestore()
+    store = LessonStore(db)
+"""
+import contextlib
+import copy
+import datetime
+import functools
+import json
+import threading
+import time
+import uuid
+
+from firebase_admin import firestore
+from google.api_core.exceptions import FailedPrecondition, NotFound
+
+
+# FieldPath.document_id(), for ordering and cursors by document id
+DOCUMENT_ID = '__name__'
+
+
+def _resolve(value, now):
+    """Replace Firestore sentinels inside value, the way the server does on commit."""
+    if value is firestore.SERVER_TIMESTAMP:
+        return now
+    if isinstance(value, dict):
+        return {key: _resolve(item, now) for key, item in value.items() if item is not firestore.DELETE_FIELD}
+    if isinstance(value, list):
+        return [_resolve(item, now) for item in value]
+    return copy.deepcopy(value)
+
+
+def _deep_merge(target, changes, now):
+    for key, value in changes.items():
+        if value is firestore.DELETE_FIELD:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            _deep_merge(target[key], value, now)
+        else:
+            target[key] = _resolve(value, now)
+
+
+def _set_path(data, field_path, value, now):
+    *parents, leaf = field_path.split('.')
+    for part in parents:
+        if not isinstance(data.get(part), dict):
+            data[part] = {}
+        data = data[part]
+    if value is firestore.DELETE_FIELD:
+        data.pop(leaf, None)
+    elif isinstance(value, firestore.Increment):
+        data[leaf] = (data.get(leaf) or 0) + value.value
+    else:
+        data[leaf] = _resolve(value, now)
+
+
+def _get_path(data, field_path):
+    for part in field_path.split('.'):
+        if not isinstance(data, dict) or part not in data:
+            return None
+        data = data[part]
+    return data
+
+
+def _project(data, field_paths):
+    projected = {}
+    for field_path in field_paths:
+        value = _get_path(data, field_path)
+        if value is not None:
+            _set_path(projected, field_path, value, None)
+    return projected
+
+
+def _json_default(value):
+    # bytes (compressed pillar versions) are sized at their length: the placeholder plus its quotes
+    if isinstance(value, bytes):
+        return '.' * max(len(value) - 2, 0)
+    return str(value)
+
+
+def _size(data):
+    return len(json.dumps(data, default=_json_default))
+
+
+def _document_id(value):
+    # Cursors on the document id hold a document reference
+    return value.id if isinstance(value, FakeDocumentReference) else value
+
+
+def _compare(a, b):
+    return (a > b) - (a < b)
+
+
+class FakeWriteOption:
+    def __init__(self, last_update_time=None, exists=None):
+        self.last_update_time = last_update_time
+        self.exists = exists
+
+
+class FakeDocumentSnapshot:
+    def __init__(self, reference, data, update_time):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+        self.update_time = update_time
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+    def get(self, field_path):
+        return copy.deepcopy(_get_path(self._data or {}, field_path))
+
+
+class FakeDocumentReference:
+    def __init__(self, db, collection_name, document_id):
+        self._db = db
+        self._collection_name = collection_name
+        self.id = document_id
+
+    def get(self, field_paths=None, transaction=None):
+        with self._db._rpc() as documents:
+            stored = documents.get(self._collection_name, {}).get(self.id)
+            self._db.documents_read += 1
+            if stored is None:
+                return FakeDocumentSnapshot(self, None, None)
+            data, update_time = stored
+            if field_paths is not None:
+                data = _project(data, field_paths)
+            self._db.bytes_read += _size(data)
+            return FakeDocumentSnapshot(self, copy.deepcopy(data), update_time)
+
+    def collection(self, name):
+        return FakeCollectionReference(self._db, f'{self._collection_name}/{self.id}/{name}')
+
+    def set(self, document_data, merge=False):
+        self._db._commit([('set', self, document_data, merge)])
+
+    def update(self, field_updates, option=None):
+        self._db._commit([('update', self, field_updates, option)])
+
+    def delete(self, option=None):
+        self._db._commit([('delete', self, None, option)])
+
+
+class FakeWriteBatch:
+    """Collects writes and commits them atomically in one round trip."""
+
+    def __init__(self, db):
+        self._db = db
+        self._writes = []
+
+    def set(self, reference, document_data, merge=False):
+        self._writes.append(('set', reference, document_data, merge))
+
+    def update(self, reference, field_updates, option=None):
+        self._writes.append(('update', reference, field_updates, option))
+
+    def delete(self, reference, option=None):
+        self._writes.append(('delete', reference, None, option))
+
+    def commit(self):
+        self._db._commit(self._writes)
+
+
+_FILTERS = {
+    '==': lambda value, expected: value == expected,
+    '!=': lambda value, expected: value != expected,
+    '<': lambda value, expected: value is not None and value < expected,
+    '<=': lambda value, expected: value is not None and value <= expected,
+    '>': lambda value, expected: value is not None and value > expected,
+    '>=': lambda value, expected: value is not None and value >= expected,
+    'in': lambda value, expected: value in expected,
+    'array_contains': lambda value, expected: isinstance(value, list) and expected in value,
+}
+
+
+class FakeQuery:
+    def __init__(self, db, collection_name, filters=(), orders=(), projection=None, limit=None, cursor=None):
+        self._db = db
+        self._collection_name = collection_name
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._projection = projection
+        self._limit = limit
+        self._cursor = cursor
+
+    def _copy(self, **changes):
+        state = dict(
+            filters=self._filters, orders=self._orders, projection=self._projection,
+            limit=self._limit, cursor=self._cursor
+        )
+        state.update(changes)
+        return FakeQuery(self._db, self._collection_name, **state)
+
+    def where(self, field_path, op_string, value):
+        return self._copy(filters=self._filters + ((field_path, op_string, value),))
+
+    def order_by(self, field_path, direction='ASCENDING'):
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def select(self, field_paths):
+        return self._copy(projection=list(field_paths))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def start_after(self, document_fields):
+        """document_fields is a snapshot or a dict with a value for each order_by field."""
+        if isinstance(document_fields, FakeDocumentSnapshot):
+            document_fields = {**document_fields.to_dict(), DOCUMENT_ID: document_fields.id}
+        return self._copy(cursor=[
+            _document_id(document_fields.get(DOCUMENT_ID)) if field_path == DOCUMENT_ID
+            else _get_path(document_fields, field_path)
+            for field_path, _ in self._orders
+        ])
+
+    def _compare_orders(self, a_values, b_values):
+        for (_, direction), a_value, b_value in zip(self._orders, a_values, b_values):
+            result = _compare(a_value, b_value)
+            if result:
+                return -result if direction == 'DESCENDING' else result
+        return 0
+
+    def stream(self):
+        with self._db._rpc() as documents:
+            matches = []
+            for document_id, (data, update_time) in documents.get(self._collection_name, {}).items():
+                if not all(_FILTERS[op](_get_path(data, path), value) for path, op, value in self._filters):
+                    continue
+                order_values = [
+                    document_id if path == DOCUMENT_ID else _get_path(data, path) for path, _ in self._orders
+                ]
+                # Like Firestore, ordering by a field leaves out documents without it
+                if any(value is None for value in order_values):
+                    continue
+                if self._cursor is not None and self._compare_orders(order_values, self._cursor) <= 0:
+                    continue
+                matches.append((document_id, (data, update_time), order_values))
+
+            # Ties are broken by document id, as Firestore does
+            matches.sort(key=functools.cmp_to_key(
+                lambda a, b: self._compare_orders(a[2], b[2]) or _compare(a[0], b[0])
+            ))
+            if self._limit is not None:
+                matches = matches[:self._limit]
+
+            snapshots = []
+            for document_id, (data, update_time), _ in matches:
+                if self._projection is not None:
+                    data = _project(data, self._projection)
+                self._db.bytes_read += _size(data)
+                reference = FakeDocumentReference(self._db, self._collection_name, document_id)
+                snapshots.append(FakeDocumentSnapshot(reference, copy.deepcopy(data), update_time))
+            # An empty result still costs one read
+            self._db.documents_read += max(1, len(snapshots))
+        return iter(snapshots)
+
+    def get(self):
+        return list(self.stream())
+
+
+class FakeCollectionReference(FakeQuery):
+    def __init__(self, db, name):
+        super().__init__(db, name)
+        self.id = name
+
+    def document(self, document_id=None):
+        return FakeDocumentReference(self._db, self.id, document_id or uuid.uuid4().hex[:20])
+
+
+class FakeFirestore:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self._documents = {}
+        self._lock = threading.Lock()
+        self._last_commit = None
+        self._before_next_write = []
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.round_trips = 0
+        self.documents_read = 0
+        self.bytes_read = 0
+
+    def collection(self, name):
+        return FakeCollectionReference(self, name)
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def get_all(self, references, field_paths=None):
+        """Read several documents in one round trip."""
+        with self._rpc() as documents:
+            snapshots = []
+            for reference in references:
+                stored = documents.get(reference._collection_name, {}).get(reference.id)
+                self.documents_read += 1
+                if stored is None:
+                    snapshots.append(FakeDocumentSnapshot(reference, None, None))
+                    continue
+                data = _project(stored[0], field_paths) if field_paths is not None else stored[0]
+                self.bytes_read += _size(data)
+                snapshots.append(FakeDocumentSnapshot(reference, copy.deepcopy(data), stored[1]))
+        return iter(snapshots)
+
+    def write_option(self, last_update_time=None, exists=None):
+        return FakeWriteOption(last_update_time=last_update_time, exists=exists)
+
+    def interleave(self, write):
+        """Run write() (e.g. another client's save) right before the next write, to simulate a race."""
+        self._before_next_write.append(write)
+
+    def _commit_time(self):
+        # Commit times are strictly increasing, like Firestore update times
+        now = datetime.datetime.now(datetime.timezone.utc)
+        if self._last_commit is not None and now <= self._last_commit:
+            now = self._last_commit + datetime.timedelta(microseconds=1)
+        self._last_commit = now
+        return now
+
+    def _commit(self, writes):
+        """Apply writes atomically: if any precondition fails, nothing is written."""
+        with self._rpc(write=True) as documents:
+            now = self._commit_time()
+            # (collection, id) -> (data, update_time) or None once deleted
+            staged = {}
+            for kind, reference, payload, option in writes:
+                key = (reference._collection_name, reference.id)
+                stored = staged[key] if key in staged else documents.get(key[0], {}).get(key[1])
+                if kind != 'set' and option is not None and option.last_update_time is not None:
+                    if stored is None or option.last_update_time != stored[1]:
+                        raise FailedPrecondition(f"{key[0]}/{key[1]} was modified")
+
+                if kind == 'delete':
+                    staged[key] = None
+                elif kind == 'update':
+                    if stored is None:
+                        raise NotFound(f"No document to update: {key[0]}/{key[1]}")
+                    data = copy.deepcopy(stored[0])
+                    for field_path, value in payload.items():
+                        _set_path(data, field_path, value, now)
+                    staged[key] = (data, now)
+                elif option and stored is not None:
+                    # For set, option is the merge flag
+                    data = copy.deepcopy(stored[0])
+                    _deep_merge(data, payload, now)
+                    staged[key] = (data, now)
+                else:
+                    staged[key] = (_resolve(payload, now), now)
+
+            for (collection_name, document_id), stored in staged.items():
+                collection = documents.setdefault(collection_name, {})
+                if stored is None:
+                    collection.pop(document_id, None)
+                else:
+                    collection[document_id] = stored
+
+    @contextlib.contextmanager
+    def _rpc(self, write=False):
+        if write and self._before_next_write:
+            # The simulated other client is not counted as our traffic
+            counters = (self.round_trips, self.documents_read, self.bytes_read)
+            self._before_next_write.pop(0)()
+            self.round_trips, self.documents_read, self.bytes_read = counters
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.round_trips += 1
+            yield self._documents
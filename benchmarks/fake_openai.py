@@ -0,0 +1,208 @@
+"""A local OpenAI-compatible server for benchmarks.
+
+It implements POST /v1/chat/completions (streaming and non-streaming) and
+answers after a configurable delay, so load tests measure our serving path
+without spending API money. A fraction of requests can be answered with
+429 Too Many Requests or a 5xx server error, to exercise llm_scheduler's
+retries. Like the real API, it reports the prompt tokens of the longest
+previously seen prompt prefix as cached (usage.prompt_tokens_details).
+
+    python -m benchmarks.fake_openai --port 8100 --latency 2.0 --rate-limit-rate 0.2 --error-rate 0.05
+
+Point the app at it with OPENAI_BASE_URL=http://127.0.0.1:8100/v1.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import time
+import uuid
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+# Returned for response_format={"type": "json_object"} requests so that the
+# app's JSON handling sees a realistic lesson payload.
+FAKE_LESSON = {
+    "content_objectives": ["Explain the water cycle", "Describe evaporation and condensation"],
+    "language_objectives": {
+        "key_vocabulary": ["evaporation", "condensation", "precipitation"],
+        "language_structures": ["First..., then..., finally..."],
+        "example_phrases": ["Water evaporates when it is heated."]
+    },
+    "learning_tasks": [{"title": "Water Cycle Stations", "description": "Students rotate through stations.", "duration": "40 minutes"}],
+    "assessment_criteria": [{"criterion": "Sequence the stages", "method": "Exit ticket"}],
+    "text_deep_learning_input": {"pareto_printable": {"title": "Key Information", "points": []}}
+}
+
+FAKE_TEXT = "This is a generated answer from the local fake OpenAI server. " * 8
+
+# OpenAI caches prompt prefixes from 1,024 tokens on, in 128-token steps
+PREFIX_CACHE_MIN_TOKENS = 1024
+PREFIX_CACHE_STEP_TOKENS = 128
+CHARS_PER_TOKEN = 4
+
+
+class PrefixCache:
+    """Remembers prompt prefixes to report cached tokens the way OpenAI's automatic prompt caching does."""
+
+    def __init__(self):
+        self._seen = set()
+
+    def lookup(self, messages):
+        """Cached tokens for this prompt (the longest prefix seen before); the prompt's prefixes are remembered."""
+        prompt = ''.join(f"{m.get('role')}\n{m.get('content', '')}\n" for m in messages)
+        total_tokens = len(prompt) // CHARS_PER_TOKEN
+        cached = 0
+        for tokens in range(PREFIX_CACHE_MIN_TOKENS, total_tokens + 1, PREFIX_CACHE_STEP_TOKENS):
+            digest = hashlib.sha1(prompt[:tokens * CHARS_PER_TOKEN].encode('utf-8')).digest()
+            if digest in self._seen:
+                cached = tokens
+            else:
+                self._seen.add(digest)
+        return cached
+
+
+def sample_instance(schema, name='value'):
+    """A value matching a structured-output JSON schema, with three items per array."""
+    if schema['type'] == 'object':
+        return {key: sample_instance(value, key) for key, value in schema['properties'].items()}
+    if schema['type'] == 'array':
+        return [sample_instance(schema['items'], f"{name} {i}") for i in range(1, 4)]
+    return f"Sample {name.replace('_', ' ')}"
+
+
+def completion_text(body):
+    response_format = body.get('response_format') or {}
+    if response_format.get('type') == 'json_schema':
+        return json.dumps(sample_instance(response_format['json_schema']['schema']), indent=2)
+    if response_format.get('type') == 'json_object':
+        return json.dumps(FAKE_LESSON, indent=2)
+    return FAKE_TEXT
+
+
+def split_into_tokens(text):
+    # Roughly four characters per token, like the real tokenizer on English text
+    return [text[i:i + 4] for i in range(0, len(text), 4)]
+
+
+SERVER_ERRORS = (500, 502, 503)
+
+
+def create_app(latency=1.0, tokens_per_second=200.0, rate_limit_rate=0.0, retry_after=None, seed=None, error_rate=0.0):
+    """Build the fake server.
+
+    latency is the delay before the first token; tokens_per_second paces the
+    rest of the completion (0 disables pacing). rate_limit_rate is the fraction
+    of requests rejected with a 429, with a Retry-After header if retry_after is set.
+    error_rate is the fraction answered with a 500, 502 or 503 after the latency.
+    """
+    rng = random.Random(seed)
+    prefix_cache = PrefixCache()
+
+    async def chat_completions(request):
+        body = await request.json()
+        if rate_limit_rate and rng.random() < rate_limit_rate:
+            headers = {'retry-after': str(retry_after)} if retry_after is not None else None
+            return JSONResponse({
+                "error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}
+            }, status_code=429, headers=headers)
+        if error_rate and rng.random() < error_rate:
+            await asyncio.sleep(latency)
+            return JSONResponse({
+                "error": {"message": "The server had an error while processing your request.", "type": "server_error"}
+            }, status_code=rng.choice(SERVER_ERRORS))
+
+        text = completion_text(body)
+        tokens = split_into_tokens(text)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+        model = body.get('model', 'gpt-4o-mini')
+        usage = {
+            "prompt_tokens": sum(len(str(m.get('content', ''))) for m in body.get('messages', [])) // CHARS_PER_TOKEN,
+            "completion_tokens": len(tokens),
+        }
+        usage["prompt_tokens_details"] = {
+            "cached_tokens": min(prefix_cache.lookup(body.get('messages', [])), usage["prompt_tokens"])
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        token_delay = 1.0 / tokens_per_second if tokens_per_second else 0
+
+        if not body.get('stream'):
+            await asyncio.sleep(latency + token_delay * len(tokens))
+            return JSONResponse({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": text},
+                    "finish_reason": "stop"
+                }],
+                "usage": usage
+            })
+
+        async def stream():
+            await asyncio.sleep(latency)
+            for token in tokens:
+                chunk = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": model,
+                    "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]
+                }
+                yield f"data: {json.dumps(chunk)}\n\n"
+                if token_delay:
+                    await asyncio.sleep(token_delay)
+            final = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]
+            }
+            yield f"data: {json.dumps(final)}\n\n"
+            if (body.get('stream_options') or {}).get('include_usage'):
+                # Like the real API: one last chunk with no choices carrying the usage
+                usage_chunk = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": model,
+                    "choices": [],
+                    "usage": usage
+                }
+                yield f"data: {json.dumps(usage_chunk)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(stream(), media_type='text/event-stream')
+
+    return Starlette(routes=[Route('/v1/chat/completions', chat_completions, methods=['POST'])])
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8100)
+    parser.add_argument('--latency', type=float, default=1.0, help="seconds before the first token")
+    parser.add_argument('--tokens-per-second', type=float, default=200.0)
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help="fraction of requests answered with 429")
+    parser.add_argument('--retry-after', type=float, default=None, help="Retry-After seconds sent with each 429")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of requests answered with a 5xx")
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    app = create_app(
+        args.latency, args.tokens_per_second, args.rate_limit_rate, args.retry_after, args.seed, args.error_rate
+    )
+    uvicorn.run(app, host=args.host, port=args.port, log_level='warning')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""Dashboard listing cost: full lesson query, projected pages and the summary index.
+
+Fills benchmarks.fake_firestore with a few thousand synthetic lessons for one
+teacher (plus other teachers' lessons) and compares the original get_lessons
+query, which streamed every full document, with a projected, paginated query
+and with LessonStore.list_lessons pages served from the per-user summary index.
+Wall-clock time is not reported because the fake scans the whole collection
+on every query; round trips, documents read and bytes read are what Firestore
+bills and what crosses the network.
+
+    python -m benchmarks.lesson_listing --lessons 3000 --page-size 24
+"""
+import argparse
+import datetime
+
+from benchmarks.fake_firestore import FakeFirestore
+from firebase_admin import firestore
+from google.cloud.firestore_v1.field_path import FieldPath
+from lesson_store import LessonStore
+
+UID = 'teacher-1'
+
+
+def synthetic_lesson(uid, index, last_modified):
+    pillar_text = "<p>Students work in pairs on the activity and report back.</p>" * 12
+    return {
+        "userId": uid,
+        "title": f"Lesson {index}",
+        "version": 3,
+        "lastModified": last_modified,
+        "pillars": {
+            key: {"versions": [f"<h3>{key}</h3>{pillar_text}"] * 3, "currentIndex": 2}
+            for key in ('content', 'language', 'tasks', 'assessment', 'materials')
+        },
+        "sideCards": [{"type": "helper", "recipe": {"title": "Key vocabulary", "body": pillar_text}}],
+        "chatHistory": [{"role": "user", "content": "Make it more interactive, please."}] * 10
+    }
+
+
+def fill(db, lessons, other_lessons):
+    start = datetime.datetime(2025, 1, 1, tzinfo=datetime.timezone.utc)
+    collection = db.collection('lessons')
+    for index in range(lessons + other_lessons):
+        uid = UID if index < lessons else f'teacher-{index % 50 + 2}'
+        # Lessons come in fives with the same timestamp, like a batch import, so pages must break ties
+        last_modified = start + datetime.timedelta(minutes=index // 5)
+        collection.document().set(synthetic_lesson(uid, index, last_modified))
+
+
+def legacy_list(db, uid):
+    # The query get_lessons ran before pagination
+    query = db.collection('lessons').where('userId', '==', uid).order_by(
+        'lastModified', direction=firestore.Query.DESCENDING
+    )
+    return [{"id": lesson.id, "title": lesson.to_dict().get("title")} for lesson in query.stream()]
+
+
+def projected_page(db, uid, page_size, cursor=None):
+    # Paginated query selecting only the summary fields, used before the summary index
+    document_id = FieldPath.document_id()
+    query = db.collection('lessons').where('userId', '==', uid).order_by(
+        'lastModified', direction=firestore.Query.DESCENDING
+    ).order_by(document_id, direction=firestore.Query.DESCENDING).select(('title', 'lastModified'))
+    if cursor is not None:
+        query = query.start_after({'lastModified': cursor[0], document_id: db.collection('lessons').document(cursor[1])})
+    snapshots = list(query.limit(page_size + 1).stream())
+    if len(snapshots) <= page_size:
+        return snapshots, None
+    last = snapshots[page_size - 1]
+    return snapshots[:page_size], (last.get('lastModified'), last.id)
+
+
+def measure(db, name, run):
+    db.reset_counters()
+    count = run()
+    print(f"{name:<30}{count:>9}{db.round_trips:>13}{db.documents_read:>16}{db.bytes_read / 1024:>12.0f}")
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--lessons', type=int, default=3000, help="lessons owned by the measured teacher")
+    parser.add_argument('--other-lessons', type=int, default=2000, help="lessons owned by other teachers")
+    parser.add_argument('--page-size', type=int, default=24)
+    args = parser.parse_args()
+
+    db = FakeFirestore()
+    fill(db, args.lessons, args.other_lessons)
+    store = LessonStore(db)
+
+    def all_pages(list_page, get_id):
+        seen, cursor = [], None
+        while True:
+            page, cursor = list_page(cursor)
+            seen.extend(get_id(item) for item in page)
+            if cursor is None:
+                return seen
+
+    def scroll(list_page, get_id):
+        return len(all_pages(list_page, get_id))
+
+    print(f"{'listing':<30}{'lessons':>9}{'round trips':>13}{'documents read':>16}{'KB read':>12}")
+    legacy_count = measure(db, "full query", lambda: len(legacy_list(db, UID)))
+    measure(db, "projected query: first page", lambda: len(projected_page(db, UID, args.page_size)[0]))
+    measure(db, "projected query: all pages", lambda: scroll(
+        lambda cursor: projected_page(db, UID, args.page_size, cursor), lambda snapshot: snapshot.id
+    ))
+    measure(db, "index: one-time rebuild", lambda: len(store.rebuild_index(UID)))
+    measure(db, "index: first page", lambda: len(store.list_lessons(UID, args.page_size)[0]))
+    measure(db, "index: all pages", lambda: scroll(
+        lambda cursor: store.list_lessons(UID, args.page_size, cursor), lambda summary: summary['id']
+    ))
+
+    ids = all_pages(lambda cursor: store.list_lessons(UID, args.page_size, cursor), lambda summary: summary['id'])
+    assert len(ids) == len(set(ids)) == legacy_count, "pages skipped or repeated lessons"
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+"""Round trips per lesson save, before and after the conditional update.
+
+Replays saves against benchmarks.fake_firestore and counts Firestore round
+trips for the old save_lesson update path (kept below as legacy_update) and
+for lesson_store.LessonStore. It also checks the race the old path had: a
+lesson deleted between the ownership check and the write was silently
+recreated by set(merge=True). Finally it compares the request body of a
+full-blueprint save with a patch that appends one regenerated version, and
+the bytes read to open a lesson with every version inline against the
+compressed current-version-only lesson document, whole and with only the
+fields the editor renders first.
+
+    python -m benchmarks.lesson_saves
+"""
+import json
+
+from benchmarks.fake_firestore import FakeFirestore
+from firebase_admin import firestore
+from lesson_store import LessonStore, LessonNotFoundError
+
+UID = 'teacher-1'
+
+
+def make_lesson(title='Water cycle'):
+    return {
+        "title": title,
+        "pillars": {
+            key: {"versions": [f"<p>{key} v1</p>"], "currentIndex": 0}
+            for key in ('content', 'language', 'tasks', 'assessment', 'materials')
+        },
+        "sideCards": [],
+        "chatHistory": []
+    }
+
+
+def legacy_update(db, uid, lesson_id, lesson_data):
+    # The update path of save_lesson before lesson_store.py
+    lesson_data = {**lesson_data, 'userId': uid, 'lastModified': firestore.SERVER_TIMESTAMP}
+    doc_ref = db.collection('lessons').document(lesson_id)
+    lesson_doc = doc_ref.get()
+    if not lesson_doc.exists:
+        raise LessonNotFoundError(lesson_id)
+    if lesson_doc.to_dict().get('userId') != uid:
+        raise PermissionError(lesson_id)
+    doc_ref.set(lesson_data, merge=True)
+
+
+def changed_pillars():
+    return {
+        key: {"versions": [f"<p>{key} v1</p>", f"<p>{key} v2</p>"], "currentIndex": 1}
+        for key in ('content', 'tasks', 'assessment')
+    }
+
+
+def grown_lesson(regenerations=10, chat_messages=40):
+    """A lesson after a working session: several versions per pillar and a long chat."""
+    lesson = make_lesson()
+    for key, pillar in lesson["pillars"].items():
+        pillar["versions"] = [f"<h3>{key}</h3>" + "<p>Activity text for the class.</p>" * 40] * regenerations
+        pillar["currentIndex"] = regenerations - 1
+    lesson["chatHistory"] = [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": "Chat message about the lesson. " * 15}
+        for i in range(chat_messages)
+    ]
+    return lesson
+
+
+def measure(db, save):
+    db.reset_counters()
+    save()
+    return db.round_trips
+
+
+def deleted_during_save(db, save, lesson_id):
+    """Delete the lesson between the ownership check and the write; return whether it came back."""
+    db.interleave(lambda: db.collection('lessons').document(lesson_id).delete())
+    try:
+        save()
+    except LessonNotFoundError:
+        pass
+    return db.collection('lessons').document(lesson_id).get().exists
+
+
+def main():
+    db = FakeFirestore()
+    store = LessonStore(db)
+    lesson_id = store.create(UID, make_lesson())
+    pillars = changed_pillars()
+
+    rows = [
+        (
+            "full save",
+            measure(db, lambda: legacy_update(db, UID, lesson_id, make_lesson())),
+            measure(db, lambda: store.update(UID, lesson_id, make_lesson())),
+        ),
+        (
+            f"{len(pillars)} pillar changes",
+            measure(db, lambda: [
+                legacy_update(db, UID, lesson_id, {"pillars": {key: value}}) for key, value in pillars.items()
+            ]),
+            measure(db, lambda: store.save_pillars(UID, lesson_id, pillars)),
+        ),
+    ]
+
+    print(f"{'save':<20}{'before (round trips)':>22}{'after (round trips)':>22}")
+    for name, before, after in rows:
+        print(f"{name:<20}{before:>22}{after:>22}")
+
+    stored = db.collection('lessons').document(lesson_id).get().to_dict()
+    assert stored['pillars']['tasks']['currentIndex'] == 1 and stored['pillars']['language']['currentIndex'] == 0
+
+    legacy_id = store.create(UID, make_lesson())
+    current_id = store.create(UID, make_lesson())
+    print()
+    print("lesson deleted between ownership check and write:")
+    print(f"  before: recreated = {deleted_during_save(db, lambda: legacy_update(db, UID, legacy_id, make_lesson()), legacy_id)}")
+    print(f"  after:  recreated = {deleted_during_save(db, lambda: store.update(UID, current_id, make_lesson()), current_id)}")
+
+    lesson = grown_lesson()
+    grown_id = store.create(UID, lesson)
+    new_version = "<h3>tasks</h3>" + "<p>Regenerated activity text.</p>" * 40
+    ops = [
+        {"op": "append", "path": "pillars.tasks.versions", "value": new_version},
+        {"op": "set", "path": "pillars.tasks.currentIndex", "value": len(lesson["pillars"]["tasks"]["versions"])},
+    ]
+    lesson["pillars"]["tasks"]["versions"].append(new_version)
+    lesson["pillars"]["tasks"]["currentIndex"] += 1
+    full_body = len(json.dumps({"lessonId": grown_id, **lesson}))
+    patch_body = len(json.dumps({"baseVersion": 1, "ops": ops}))
+    store.patch(UID, grown_id, ops, base_version=1)
+    stored = store.load(UID, grown_id, all_versions=True)
+    assert all(
+        stored["pillars"][key]["versions"] == pillar["versions"]
+        and stored["pillars"][key]["currentIndex"] == pillar["currentIndex"]
+        for key, pillar in lesson["pillars"].items()
+    ) and stored["version"] == 2
+
+    # What opening the lesson reads: the old inline document versus the new one with only current versions
+    db.collection('lessons').document('inline').set({**lesson, "userId": UID, "version": 2})
+    db.reset_counters()
+    db.collection('lessons').document('inline').get()
+    inline_read = db.bytes_read
+    db.reset_counters()
+    store.load(UID, grown_id)
+    lesson_read = db.bytes_read
+    db.reset_counters()
+    store.load(UID, grown_id, fields=['title', 'pillars', 'chatContext'])
+    first_paint_read = db.bytes_read
+
+    print()
+    print("request body after one regeneration (10 versions per pillar, 40 chat messages):")
+    print(f"  full save: {full_body:>9,} bytes")
+    print(f"  patch:     {patch_body:>9,} bytes")
+    print()
+    print("bytes read to open that lesson:")
+    print(f"  versions inline:                  {inline_read:>9,} bytes")
+    print(f"  current versions, compressed:     {lesson_read:>9,} bytes")
+    print(f"  title and pillars before the rest: {first_paint_read:>8,} bytes")
+
+
+if __name__ == '__main__':
+    main()
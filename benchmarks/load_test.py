@@ -0,0 +1,131 @@
+"""Concurrency load test: sync Flask/gunicorn vs. the async ASGI serving mode.
+
+Starts the fake OpenAI server, then for each serving mode starts the app
+against it and fires a burst of concurrent /generate_helper requests.
+
+    python -m benchmarks.load_test --concurrency 200 --latency 2.0
+
+The app still initializes Firebase at import time, so the FIREBASE_*
+environment variables must be set as for a normal run. The response cache is
+disabled for the app processes so every request reaches the upstream.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+SERVING_MODES = {
+    # gunicorn's default sync workers handle one request per worker at a time
+    'sync': lambda port, workers: [
+        sys.executable, '-m', 'gunicorn', '-w', str(workers), '-b', f'127.0.0.1:{port}', 'app:app'
+    ],
+    'async': lambda port, workers: [
+        sys.executable, '-m', 'uvicorn', 'asgi:app', '--host', '127.0.0.1', '--port', str(port),
+        '--log-level', 'warning'
+    ],
+}
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def start_process(command, env=None):
+    return subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+
+
+async def wait_until_ready(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as http:
+        while time.monotonic() < deadline:
+            try:
+                await http.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"Server at {url} did not start within {timeout}s")
+
+
+async def run_burst(base_url, concurrency, timeout):
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=timeout) as http:
+
+        async def one_request(i):
+            started = time.perf_counter()
+            try:
+                response = await http.post('/generate_helper', json={"prompt": f"load test topic {i}", "fresh": True})
+                ok = response.status_code == 200 and response.json().get('success')
+            except httpx.HTTPError:
+                ok = False
+            return ok, time.perf_counter() - started
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*(one_request(i) for i in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    latencies = [latency for ok, latency in results if ok]
+    return {
+        "requests": concurrency,
+        "ok": len(latencies),
+        "errors": concurrency - len(latencies),
+        "wall_seconds": elapsed,
+        "throughput_rps": len(latencies) / elapsed if elapsed else 0.0,
+        "p50": statistics.median(latencies) if latencies else None,
+        "p95": percentile(latencies, 95) if latencies else None,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=2.0, help="fake upstream latency in seconds")
+    parser.add_argument('--workers', type=int, default=4, help="gunicorn workers for the sync mode")
+    parser.add_argument('--modes', nargs='+', default=list(SERVING_MODES), choices=list(SERVING_MODES))
+    parser.add_argument('--fake-port', type=int, default=8100)
+    parser.add_argument('--app-port', type=int, default=5100)
+    args = parser.parse_args()
+
+    fake = start_process([
+        sys.executable, '-m', 'benchmarks.fake_openai',
+        '--port', str(args.fake_port), '--latency', str(args.latency), '--tokens-per-second', '0'
+    ])
+    env = dict(
+        os.environ,
+        OPENAI_BASE_URL=f'http://127.0.0.1:{args.fake_port}/v1',
+        OPENAI_API_KEY=os.environ.get('OPENAI_API_KEY', 'fake-key'),
+        LLM_CACHE_BACKEND='none',
+        # Let the whole burst through llm_scheduler so the serving modes are what is compared
+        LLM_MAX_CONCURRENCY=str(args.concurrency),
+        LLM_REQUESTS_PER_MINUTE='0',
+        LLM_TOKENS_PER_MINUTE='0'
+    )
+
+    try:
+        await wait_until_ready(f'http://127.0.0.1:{args.fake_port}/')
+        for mode in args.modes:
+            server = start_process(SERVING_MODES[mode](args.app_port, args.workers), env=env)
+            try:
+                base_url = f'http://127.0.0.1:{args.app_port}'
+                await wait_until_ready(f'{base_url}/get-firebase-config')
+                stats = await run_burst(base_url, args.concurrency, timeout=args.latency * args.concurrency + 30)
+            finally:
+                server.terminate()
+                server.wait()
+
+            print(f"[{mode}] {stats['ok']}/{stats['requests']} ok, {stats['errors']} errors, "
+                  f"wall {stats['wall_seconds']:.2f}s, {stats['throughput_rps']:.1f} req/s, "
+                  f"p50 {stats['p50'] or 0:.2f}s, p95 {stats['p95'] or 0:.2f}s")
+    finally:
+        fake.terminate()
+        fake.wait()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,137 @@
+"""Microbenchmark for system prompt assembly.
+
+Compares the per-request string building that app.py used to do (kept below
+as legacy_* functions) with the precompiled, memoized assembly in prompts.py.
+
+    python -m benchmarks.prompt_assembly
+"""
+import json
+import timeit
+
+from prompts import (
+    ACTIVITY_TYPES,
+    CHAT_CONTEXT_PROMPT,
+    CHAT_SYSTEM_PROMPT,
+    CLIL_BASE_PROMPT,
+    SECTION_PROMPTS,
+    build_chat_messages,
+    build_lesson_system_prompt,
+    build_section_system_prompt,
+    section_user_message,
+)
+
+MODIFIERS = ["space", "station_rotation", "think_pair_share", "game_based"]
+CUSTOM_THEME = "Pirates sailing the Caribbean"
+CURRENT_ACTIVITY = {
+    "content_objectives": "<ol><li>Explain the water cycle</li></ol>",
+    "learning_tasks": "<p>Station rotation with four stations</p>" * 20
+}
+CHAT_CONTEXT = {
+    "class_context": {"students_count": "24", "grade_level": "7", "language_skills": "B1"},
+    "teaching_parameters": {"vocab_density": "40", "grammar_complexity": "3", "content_language_balance": "60"},
+    "activity_types": ["station_rotation", "debate_format", "role_play"]
+}
+CHAT_HISTORY = [{"role": "user", "content": "We have 24 students."}, {"role": "assistant", "content": "Great!"}]
+
+
+def legacy_modifier_prompts(modifiers, custom_theme_text, heading):
+    modifier_prompts = ""
+    if modifiers:
+        modifier_prompts += heading
+        for mod in modifiers:
+            if mod in ACTIVITY_TYPES:
+                if isinstance(ACTIVITY_TYPES[mod], dict) and 'description' in ACTIVITY_TYPES[mod]:
+                    modifier_prompts += f"\n{ACTIVITY_TYPES[mod]['description']}\n"
+                elif isinstance(ACTIVITY_TYPES[mod], str):
+                    modifier_prompts += f"\n{ACTIVITY_TYPES[mod]}\n"
+    if custom_theme_text and custom_theme_text.strip():
+        if not modifier_prompts:
+            modifier_prompts += heading
+        custom_theme_prompt_template = ACTIVITY_TYPES.get("custom_theme_template", "Incorporate the following custom theme into the activity: '{custom_theme}'.")
+        modifier_prompts += f"\n{custom_theme_prompt_template.format(custom_theme=custom_theme_text)}\n"
+    return modifier_prompts
+
+
+def legacy_lesson_system_prompt(modifiers, custom_theme_text):
+    return CLIL_BASE_PROMPT + legacy_modifier_prompts(modifiers, custom_theme_text, "\n\nAdditional requirements:\n")
+
+
+def legacy_section_messages(section, customization, current_activity, modifiers, custom_theme_text):
+    system_prompt = SECTION_PROMPTS[section] + legacy_modifier_prompts(
+        modifiers, custom_theme_text, "\n\nAdditional theme requirements:\n"
+    )
+    user_message = f"Current full activity context:\n{json.dumps(current_activity, indent=2)}\n\nCustomization request: {customization}"
+    return system_prompt, user_message
+
+
+def legacy_chat_messages(message, context, history):
+    class_context = context.get('class_context', {})
+    activity_types = context.get('activity_types', [])
+    class_context_str = f"""
+Current class information:
+- Number of students: {class_context.get('students_count', 'Not specified')}
+- Grade/Age level: {class_context.get('grade_level', 'Not specified')}
+- Language skills: {class_context.get('language_skills', 'Not specified')}
+
+Teaching Parameters:
+- Technical Vocabulary Density: {context.get('teaching_parameters', {}).get('vocab_density', 'Not specified')}%
+- Grammar Complexity Level: {context.get('teaching_parameters', {}).get('grammar_complexity', 'Not specified')}/5
+- Content vs Language Balance: {context.get('teaching_parameters', {}).get('content_language_balance', 'Not specified')}% Content focus
+"""
+    activity_types_str = "No specific activity types selected"
+    if activity_types:
+        activity_descriptions = []
+        for activity_type in activity_types:
+            if activity_type in ACTIVITY_TYPES and isinstance(ACTIVITY_TYPES[activity_type], dict):
+                activity_descriptions.append(f"- {ACTIVITY_TYPES[activity_type]['name']}:\n  {ACTIVITY_TYPES[activity_type]['description']}")
+            elif activity_type in ACTIVITY_TYPES:
+                activity_descriptions.append(f"- {activity_type}:\n  {ACTIVITY_TYPES[activity_type]}")
+        if activity_descriptions:
+            activity_types_str = "\n".join(activity_descriptions)
+    messages = [{"role": "system", "content": CHAT_SYSTEM_PROMPT + CHAT_CONTEXT_PROMPT.format(
+        class_context=class_context_str,
+        activity_types=activity_types_str
+    )}]
+    messages.extend(history)
+    messages.append({"role": "user", "content": message})
+    return messages
+
+
+CASES = [
+    (
+        "lesson system prompt",
+        lambda: legacy_lesson_system_prompt(MODIFIERS, CUSTOM_THEME),
+        lambda: build_lesson_system_prompt(MODIFIERS, CUSTOM_THEME),
+    ),
+    (
+        "section messages",
+        lambda: legacy_section_messages("3", "Make it shorter", CURRENT_ACTIVITY, MODIFIERS, CUSTOM_THEME),
+        lambda: (
+            build_section_system_prompt("3", MODIFIERS, CUSTOM_THEME),
+            section_user_message("Make it shorter", CURRENT_ACTIVITY)
+        ),
+    ),
+    (
+        "chat messages",
+        lambda: legacy_chat_messages("Any ideas?", CHAT_CONTEXT, CHAT_HISTORY),
+        lambda: build_chat_messages("Any ideas?", CHAT_CONTEXT, CHAT_HISTORY),
+    ),
+]
+
+
+def bench(func, number):
+    # Best of five runs, reported per call in microseconds
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6
+
+
+def main(number=20000):
+    print(f"{'case':<24}{'before (us)':>14}{'after (us)':>14}{'speedup':>10}")
+    for name, legacy, current in CASES:
+        assert legacy() == current(), f"{name}: assembled prompts differ"
+        before = bench(legacy, number)
+        after = bench(current, number)
+        print(f"{name:<24}{before:>14.2f}{after:>14.2f}{before / after:>9.1f}x")
+
+
+if __name__ == '__main__':
+    main()
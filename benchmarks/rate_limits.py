@@ -0,0 +1,100 @@
+"""Burst of mixed-priority completions against a fake upstream that answers 429s.
+
+Starts benchmarks.fake_openai with a fraction of requests rejected as rate
+limited, then sends the same burst twice: straight through an AsyncOpenAI
+client without retries (what the routes did before llm_scheduler), and
+through a RequestScheduler. Reports failures, retries and latency per
+priority; interactive requests should finish ahead of background ones.
+
+    python -m benchmarks.rate_limits --requests 200 --rate-limit-rate 0.2
+"""
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+
+import httpx
+from openai import AsyncOpenAI
+
+from benchmarks.load_test import percentile, start_process, wait_until_ready
+from llm_scheduler import RequestScheduler, estimate_tokens
+
+PRIORITY_MIX = ('interactive', 'normal', 'background', 'background')
+
+
+async def run_burst(request_count, send):
+    async def one_request(i):
+        priority = PRIORITY_MIX[i % len(PRIORITY_MIX)]
+        started = time.perf_counter()
+        try:
+            await send(priority, [{"role": "user", "content": f"benchmark request {i}"}])
+            ok = True
+        except Exception:
+            ok = False
+        return priority, ok, time.perf_counter() - started
+
+    return await asyncio.gather(*(one_request(i) for i in range(request_count)))
+
+
+def report(name, results):
+    failed = sum(1 for _, ok, _ in results if not ok)
+    print(f"[{name}] {len(results) - failed}/{len(results)} ok, {failed} failed")
+    for priority in dict.fromkeys(PRIORITY_MIX):
+        latencies = [latency for p, ok, latency in results if p == priority and ok]
+        if latencies:
+            print(f"  {priority:<12} p50 {statistics.median(latencies):6.2f}s  p95 {percentile(latencies, 95):6.2f}s")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=16, help="scheduler concurrency limit")
+    parser.add_argument('--requests-per-minute', type=int, default=0, help="scheduler RPM limit (0: none)")
+    parser.add_argument('--rate-limit-rate', type=float, default=0.2, help="fraction of upstream calls answered with 429")
+    parser.add_argument('--latency', type=float, default=0.5, help="fake upstream latency in seconds")
+    parser.add_argument('--fake-port', type=int, default=8101)
+    args = parser.parse_args()
+
+    fake = start_process([
+        sys.executable, '-m', 'benchmarks.fake_openai', '--port', str(args.fake_port),
+        '--latency', str(args.latency), '--tokens-per-second', '0',
+        '--rate-limit-rate', str(args.rate_limit_rate), '--seed', '1'
+    ])
+    http_client = httpx.AsyncClient(limits=httpx.Limits(max_connections=args.requests))
+    client = AsyncOpenAI(
+        api_key='fake-key', base_url=f'http://127.0.0.1:{args.fake_port}/v1', http_client=http_client, max_retries=0
+    )
+
+    try:
+        await wait_until_ready(f'http://127.0.0.1:{args.fake_port}/')
+
+        async def direct(priority, messages):
+            await client.chat.completions.create(model="gpt-4o-mini", messages=messages)
+
+        report("direct", await run_burst(args.requests, direct))
+
+        scheduler = RequestScheduler(
+            max_concurrency=args.concurrency, requests_per_minute=args.requests_per_minute, base_delay=0.2
+        )
+
+        async def scheduled(priority, messages):
+            await scheduler.acall(
+                lambda: client.chat.completions.create(model="gpt-4o-mini", messages=messages),
+                priority=priority,
+                tokens=estimate_tokens(messages)
+            )
+
+        report("scheduler", await run_burst(args.requests, scheduled))
+        stats = scheduler.stats()
+        print(f"  retries {stats['retries']}, 429s {stats['rate_limited']}, gave up {stats['failures']}")
+        for priority, wait in stats['wait_seconds'].items():
+            print(f"  {priority:<12} queue wait avg {wait['avg']:.2f}s max {wait['max']:.2f}s")
+    finally:
+        await http_client.aclose()
+        fake.terminate()
+        fake.wait()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
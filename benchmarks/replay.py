@@ -0,0 +1,296 @@
+"""Replay a recorded request mix against the app and report latency per route.
+
+Starts benchmarks.fake_openai (with optional latency, token rate, 429 and 5xx
+injection), then for each serving mode starts benchmarks.serve (app.py on an
+in-memory Firestore) and replays the mix with --users copies of every
+session running concurrently. Per route it reports throughput, p50/p95/p99
+latency and p50/p95 time to first byte, the upstream call outcomes from
+the app's /metrics, and the share of prompt tokens served from the prompt
+prefix cache (/prompt_cache_stats).
+
+    python -m benchmarks.replay --users 20 --latency 1.0 --error-rate 0.02
+    python -m benchmarks.replay --modes async --output after.json --baseline before.json
+
+A mix is a JSON-lines file (see benchmarks/mixes/classroom.jsonl). Each line
+is one request:
+
+    {"session": "chat", "method": "POST", "path": "/chat", "json": {...},
+     "auth": true, "think": 1.0, "capture": {"conversation_id": "conversation_id"}}
+
+Requests of one session run in order, after "think" seconds (scaled by
+--think-scale); sessions run concurrently. "{user}" in the path or any JSON
+string is replaced with the session copy's user id, and "{name}" with a value
+captured from an earlier JSON response of the same session, so a lesson can
+be saved and then loaded, or a conversation started and then continued.
+Requests with "auth" sign in with a benchmark ID token. A request whose
+placeholders cannot be filled because an earlier request failed is skipped.
+
+With --baseline, p95 latencies are compared with an earlier --output file and
+the exit status is 1 if any route got slower than --max-regression allows.
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+import time
+
+import httpx
+
+from benchmarks.load_test import percentile, start_process, wait_until_ready
+
+SERVING_MODES = {
+    # The in-memory Firestore is per process, so the sync mode is one worker with threads
+    'sync': lambda port, threads: [
+        sys.executable, '-m', 'gunicorn', '-w', '1', '-k', 'gthread', '--threads', str(threads),
+        '-b', f'127.0.0.1:{port}', 'benchmarks.serve:app'
+    ],
+    'async': lambda port, threads: [
+        sys.executable, '-m', 'uvicorn', 'benchmarks.serve:asgi_app', '--host', '127.0.0.1', '--port', str(port),
+        '--log-level', 'warning'
+    ],
+}
+
+PLACEHOLDER = re.compile(r'\{(\w+)\}')
+# Response bodies that mean the request failed even with a 200 status
+STREAM_ERROR_MARKERS = (b'event: error', b'"success": false')
+
+
+def load_mix(path):
+    """Return {session: [request, ...]} in recorded order."""
+    sessions = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                request = json.loads(line)
+                sessions.setdefault(request['session'], []).append(request)
+    return sessions
+
+
+def fill(value, variables):
+    """Substitute {name} placeholders in every string of value; raise KeyError for a missing one."""
+    if isinstance(value, str):
+        # Only {word} is a placeholder, so JSON text inside strings (e.g. a helper_context) is left alone
+        return PLACEHOLDER.sub(lambda match: str(variables[match.group(1)]), value)
+    if isinstance(value, dict):
+        return {key: fill(item, variables) for key, item in value.items()}
+    if isinstance(value, list):
+        return [fill(item, variables) for item in value]
+    return value
+
+
+def failed(response, body):
+    if response.status_code >= 400:
+        return True
+    if response.headers.get('content-type', '').startswith('application/json'):
+        try:
+            return json.loads(body).get('success') is False
+        except (ValueError, AttributeError):
+            return False
+    return any(marker in body for marker in STREAM_ERROR_MARKERS)
+
+
+async def run_session(http, requests, user, think_scale, results):
+    variables = {'user': user}
+    for recorded in requests:
+        if recorded.get('think') and think_scale:
+            await asyncio.sleep(recorded['think'] * think_scale)
+        label = recorded.get('label') or recorded['path'].split('?')[0]
+        try:
+            path = fill(recorded['path'], variables)
+            payload = fill(recorded.get('json'), variables)
+        except KeyError:
+            results.append((label, 'skipped', None, None))
+            continue
+        headers = {'Authorization': f'Bearer bench-{user}'} if recorded.get('auth') else None
+
+        started = time.perf_counter()
+        first_byte = None
+        try:
+            async with http.stream(recorded.get('method', 'GET'), path, json=payload, headers=headers) as response:
+                chunks = []
+                async for chunk in response.aiter_raw():
+                    if first_byte is None:
+                        first_byte = time.perf_counter() - started
+                    chunks.append(chunk)
+            body = b''.join(chunks)
+            outcome = 'error' if failed(response, body) else 'ok'
+        except httpx.HTTPError:
+            body, outcome = b'', 'error'
+        latency = time.perf_counter() - started
+        results.append((label, outcome, latency, first_byte if first_byte is not None else latency))
+
+        if outcome == 'ok' and recorded.get('capture'):
+            data = json.loads(body)
+            for name, field in recorded['capture'].items():
+                if data.get(field) is not None:
+                    variables[name] = data[field]
+
+
+def summarize(results, wall_seconds):
+    """Per-route stats, plus an 'all' row."""
+    by_route = {}
+    for label, outcome, latency, first_byte in results:
+        by_route.setdefault(label, []).append((outcome, latency, first_byte))
+    by_route['all'] = [(outcome, latency, first_byte) for _, outcome, latency, first_byte in results]
+
+    report = {}
+    for label, rows in by_route.items():
+        latencies = [latency for outcome, latency, _ in rows if outcome == 'ok']
+        first_bytes = [first_byte for outcome, _, first_byte in rows if outcome == 'ok']
+        report[label] = {
+            "requests": len(rows),
+            "ok": len(latencies),
+            "errors": sum(1 for outcome, _, _ in rows if outcome == 'error'),
+            "skipped": sum(1 for outcome, _, _ in rows if outcome == 'skipped'),
+            "throughput_rps": len(latencies) / wall_seconds if wall_seconds else 0.0,
+            "p50": percentile(latencies, 50) if latencies else None,
+            "p95": percentile(latencies, 95) if latencies else None,
+            "p99": percentile(latencies, 99) if latencies else None,
+            "ttfb_p50": percentile(first_bytes, 50) if first_bytes else None,
+            "ttfb_p95": percentile(first_bytes, 95) if first_bytes else None,
+        }
+    return report
+
+
+def upstream_outcomes(metrics_text):
+    """Sum llm_requests_total from a /metrics page by outcome."""
+    outcomes = {}
+    for line in metrics_text.splitlines():
+        if line.startswith('llm_requests_total{'):
+            labels, value = line.rsplit(' ', 1)
+            outcome = re.search(r'outcome="(\w+)"', labels).group(1)
+            outcomes[outcome] = outcomes.get(outcome, 0) + int(float(value))
+    return outcomes
+
+
+async def replay(base_url, sessions, users, think_scale, timeout):
+    results = []
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=200)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=timeout) as http:
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            run_session(http, requests, f'user{copy}', think_scale, results)
+            for copy in range(users)
+            for requests in sessions.values()
+        ))
+        wall_seconds = time.perf_counter() - started
+        try:
+            upstream = upstream_outcomes((await http.get('/metrics')).text)
+            prompt_cache = (await http.get('/prompt_cache_stats')).json()
+        except (httpx.HTTPError, ValueError):
+            upstream, prompt_cache = {}, None
+    return {
+        "wall_seconds": wall_seconds,
+        "routes": summarize(results, wall_seconds),
+        "upstream": upstream,
+        "prompt_cache": prompt_cache
+    }
+
+
+def print_report(mode, run):
+    def seconds(value):
+        return f"{value:.3f}" if value is not None else "-"
+
+    print(f"\n[{mode}] wall {run['wall_seconds']:.2f}s, upstream calls {run['upstream'] or 'n/a'}")
+    print(f"{'route':<48}{'req':>6}{'err':>5}{'skip':>5}{'req/s':>8}{'p50':>8}{'p95':>8}{'p99':>8}"
+          f"{'ttfb50':>8}{'ttfb95':>8}")
+    for label, stats in sorted(run['routes'].items(), key=lambda item: (item[0] == 'all', item[0])):
+        print(f"{label:<48}{stats['requests']:>6}{stats['errors']:>5}{stats['skipped']:>5}"
+              f"{stats['throughput_rps']:>8.1f}{seconds(stats['p50']):>8}{seconds(stats['p95']):>8}"
+              f"{seconds(stats['p99']):>8}{seconds(stats['ttfb_p50']):>8}{seconds(stats['ttfb_p95']):>8}")
+
+    prompt_cache = run.get('prompt_cache')
+    if prompt_cache:
+        print(f"\n{'upstream route':<48}{'prompt tokens':>14}{'cached':>12}{'ratio':>8}")
+        rows = list(prompt_cache['routes'].items()) + [('all', prompt_cache['total'])]
+        for route, stats in rows:
+            print(f"{route:<48}{stats['prompt_tokens']:>14}{stats['cached_tokens']:>12}{stats['cached_ratio']:>8.1%}")
+
+
+def regressions(baseline, current, max_regression):
+    """[(mode, route, old p95, new p95)] for routes whose p95 grew by more than max_regression."""
+    found = []
+    for mode, run in current.items():
+        for label, stats in run['routes'].items():
+            old = baseline.get(mode, {}).get('routes', {}).get(label, {}).get('p95')
+            if old and stats['p95'] and stats['p95'] > old * (1 + max_regression):
+                found.append((mode, label, old, stats['p95']))
+    return found
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mix', default=os.path.join(os.path.dirname(__file__), 'mixes', 'classroom.jsonl'))
+    parser.add_argument('--users', type=int, default=20, help="concurrent copies of every session in the mix")
+    parser.add_argument('--think-scale', type=float, default=1.0, help="multiplier for recorded think times (0 = none)")
+    parser.add_argument('--modes', nargs='+', default=list(SERVING_MODES), choices=list(SERVING_MODES))
+    parser.add_argument('--base-url', help="replay against an already running server instead of starting one")
+    parser.add_argument('--threads', type=int, default=64, help="gunicorn threads for the sync mode")
+    parser.add_argument('--latency', type=float, default=1.0, help="fake upstream latency in seconds")
+    parser.add_argument('--tokens-per-second', type=float, default=200.0)
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of upstream calls answered with a 5xx")
+    parser.add_argument('--firestore-latency', type=float, default=0.02, help="seconds per fake Firestore round trip")
+    parser.add_argument('--cache', action='store_true', help="keep the response cache on (off by default)")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--fake-port', type=int, default=8103)
+    parser.add_argument('--app-port', type=int, default=5103)
+    parser.add_argument('--timeout', type=float, default=300.0)
+    parser.add_argument('--output', help="write the results as JSON")
+    parser.add_argument('--baseline', help="JSON results of an earlier run to compare p95 latencies with")
+    parser.add_argument('--max-regression', type=float, default=0.2, help="allowed p95 growth over the baseline")
+    args = parser.parse_args()
+
+    sessions = load_mix(args.mix)
+    results = {}
+    if args.base_url:
+        results['external'] = await replay(args.base_url, sessions, args.users, args.think_scale, args.timeout)
+        print_report('external', results['external'])
+    else:
+        fake = start_process([
+            sys.executable, '-m', 'benchmarks.fake_openai', '--port', str(args.fake_port),
+            '--latency', str(args.latency), '--tokens-per-second', str(args.tokens_per_second),
+            '--rate-limit-rate', str(args.rate_limit_rate), '--error-rate', str(args.error_rate),
+            '--seed', str(args.seed)
+        ])
+        env = dict(
+            os.environ,
+            OPENAI_BASE_URL=f'http://127.0.0.1:{args.fake_port}/v1',
+            OPENAI_API_KEY='fake-key',
+            BENCH_FIRESTORE_LATENCY=str(args.firestore_latency),
+            METRICS_LOG='0'
+        )
+        if not args.cache:
+            env['LLM_CACHE_BACKEND'] = 'none'
+        try:
+            await wait_until_ready(f'http://127.0.0.1:{args.fake_port}/')
+            for mode in args.modes:
+                server = start_process(SERVING_MODES[mode](args.app_port, args.threads), env=env)
+                try:
+                    base_url = f'http://127.0.0.1:{args.app_port}'
+                    await wait_until_ready(f'{base_url}/get-firebase-config')
+                    results[mode] = await replay(base_url, sessions, args.users, args.think_scale, args.timeout)
+                finally:
+                    server.terminate()
+                    server.wait()
+                print_report(mode, results[mode])
+        finally:
+            fake.terminate()
+            fake.wait()
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            found = regressions(json.load(f), results, args.max_regression)
+        for mode, label, old, new in found:
+            print(f"REGRESSION [{mode}] {label}: p95 {old:.3f}s -> {new:.3f}s")
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
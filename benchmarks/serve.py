@@ -0,0 +1,37 @@
+"""app.py wired to an in-memory Firestore and benchmark ID tokens, for offline benchmarks.
+
+    gunicorn -w 1 -k gthread --threads 64 benchmarks.serve:app
+    uvicorn benchmarks.serve:asgi_app
+
+Firestore is replaced by benchmarks.fake_firestore before app.py creates its
+client, with BENCH_FIRESTORE_LATENCY seconds added to every round trip. With
+BENCH_FIRESTORE=emulator the real client is kept instead, so point it at the
+Firestore emulator with FIRESTORE_EMULATOR_HOST and the usual FIREBASE_*
+variables. The in-memory store lives in one process: run a single worker.
+
+ID tokens are not verified: "Bearer bench-<uid>" signs in as <uid>. Point
+OPENAI_BASE_URL at benchmarks.fake_openai.
+"""
+import os
+import time
+
+from firebase_admin import auth, firestore
+
+from benchmarks.fake_firestore import FakeFirestore
+
+TOKEN_PREFIX = 'bench-'
+
+
+def verify_bench_token(id_token, check_revoked=False):
+    if not id_token.startswith(TOKEN_PREFIX):
+        raise auth.InvalidIdTokenError('Not a benchmark token', cause=None, http_response=None)
+    return {'uid': id_token[len(TOKEN_PREFIX):], 'exp': time.time() + 3600}
+
+
+if os.getenv('BENCH_FIRESTORE', 'memory') == 'memory':
+    fake_db = FakeFirestore(latency=float(os.getenv('BENCH_FIRESTORE_LATENCY', 0)))
+    firestore.client = lambda *args, **kwargs: fake_db
+auth.verify_id_token = verify_bench_token
+
+from app import app  # noqa: E402
+from asgi import app as asgi_app  # noqa: E402
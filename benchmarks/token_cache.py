@@ -0,0 +1,64 @@
+"""Microbenchmark for ID token verification on the lesson routes.
+
+firebase_admin's verify_id_token checks an RS256 signature (and, with
+check_revoked, makes a network call) on every request. This compares a stub
+verifier with a configurable cost against the same verifier behind
+auth_cache.VerifiedTokenCache, replaying the dashboard/editor pattern of a few
+users reusing their tokens.
+
+    python -m benchmarks.token_cache --verify-ms 2 --requests 5000 --users 20
+"""
+import argparse
+import random
+import time
+
+from auth_cache import VerifiedTokenCache
+
+
+def make_verifier(verify_ms):
+    calls = {"count": 0}
+
+    def verify(id_token, check_revoked=False):
+        calls["count"] += 1
+        # Busy-wait so the cost is CPU time, like a signature check
+        deadline = time.perf_counter() + verify_ms / 1000
+        while time.perf_counter() < deadline:
+            pass
+        return {"uid": id_token.split('.')[0], "exp": time.time() + 3600}
+
+    return verify, calls
+
+
+def replay(verify, tokens):
+    start = time.perf_counter()
+    for token in tokens:
+        verify(token)['uid']
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--verify-ms', type=float, default=2.0, help='cost of one verification in milliseconds')
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=20)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    user_tokens = [f"user{i}.{rng.getrandbits(64):x}" for i in range(args.users)]
+    tokens = [rng.choice(user_tokens) for _ in range(args.requests)]
+
+    plain_verify, plain_calls = make_verifier(args.verify_ms)
+    uncached = replay(lambda token: plain_verify(token), tokens)
+
+    cached_verify, cached_calls = make_verifier(args.verify_ms)
+    cache = VerifiedTokenCache(cached_verify)
+    cached = replay(cache.verify, tokens)
+
+    print(f"{'mode':<10}{'verifications':>15}{'per request (us)':>20}")
+    print(f"{'uncached':<10}{plain_calls['count']:>15}{uncached / args.requests * 1e6:>20.1f}")
+    print(f"{'cached':<10}{cached_calls['count']:>15}{cached / args.requests * 1e6:>20.1f}")
+    print(f"speedup: {uncached / cached:.1f}x, cache stats: {cache.stats()}")
+
+
+if __name__ == '__main__':
+    main()
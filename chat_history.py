@@ -0,0 +1,226 @@
+"""Token-budgeted history compaction for /chat.
+
+The browser sends the whole conversation on every message. Once the prompt
+grows past the token budget, the oldest turns are folded into a rolling
+summary, and the system prompt plus the most recent turns stay verbatim. The
+summary is cached per conversation and extended incrementally, so each turn
+is summarized at most once. If the turns that stay verbatim are still over
+the budget on their own (a long paste, say), the longest of them are cut
+down to a common length, with a note saying so.
+
+tiktoken is used for token counts when it is installed. Without it, counts
+fall back to the usual ~4 characters per token estimate.
+"""
+import functools
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("o200k_base")
+except Exception:  # tiktoken missing, or its encoding files cannot be fetched
+    _encoding = None
+
+# Per-message overhead of the chat format (role markers and separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+# Appended to a message that was cut to fit the budget; TRUNCATION_MARKER_TOKENS is an upper bound on its size
+TRUNCATION_MARKER = "\n[... cut from {tokens} tokens to fit the conversation's token budget]"
+TRUNCATION_MARKER_TOKENS = 20
+
+
+@functools.lru_cache(maxsize=8192)
+def count_tokens(text):
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    return max(1, len(text) // 4)
+
+
+def message_tokens(message):
+    return count_tokens(message.get('content') or '') + MESSAGE_OVERHEAD_TOKENS
+
+
+def truncate_tokens(text, max_tokens):
+    """Return the first max_tokens tokens of text."""
+    if _encoding is not None:
+        return _encoding.decode(_encoding.encode(text)[:max_tokens])
+    return text[:max_tokens * 4]
+
+
+def _prefix_hash(messages):
+    payload = json.dumps([(m.get('role'), m.get('content')) for m in messages], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def conversation_key(history):
+    """Derive a stable key from the opening of a conversation when the client does not send an id."""
+    return _prefix_hash(history[:2])
+
+
+class ChatHistoryManager:
+    """Fit a chat message list into a token budget.
+
+    summarize is a callable (previous_summary, messages) -> summary text that
+    folds the given turns into the previous summary (which may be None).
+    When compaction is needed, recent turns are kept up to fold_target of the
+    budget so the summary is extended in batches rather than on every turn.
+    """
+
+    def __init__(self, summarize, token_budget=6000, keep_recent=6, fold_target=0.6, max_conversations=1000):
+        self.summarize = summarize
+        self.token_budget = token_budget
+        self.keep_recent = keep_recent
+        self.fold_target = fold_target
+        self.max_conversations = max_conversations
+        # conversation key -> (number of folded messages, hash of those messages, summary)
+        self._summaries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def compact(self, messages, key=None):
+        """Return (messages, report) for a list shaped [system, *history, new user message].
+
+        report contains the token counts before and after and the tokens saved.
+        """
+        system_message, history, current = messages[0], messages[1:-1], messages[-1]
+        original_tokens = sum(message_tokens(m) for m in messages)
+        report = {
+            "original_tokens": original_tokens,
+            "sent_tokens": original_tokens,
+            "tokens_saved": 0,
+            "summarized_messages": 0,
+            "truncated_messages": 0
+        }
+        if original_tokens <= self.token_budget:
+            return messages, report
+
+        compacted, recent_start = messages, 0
+        if len(history) > self.keep_recent:
+            compacted, recent_start = self._fold(messages, key)
+        compacted, truncated = self._truncate(compacted)
+
+        sent_tokens = sum(message_tokens(m) for m in compacted)
+        report.update({
+            "sent_tokens": sent_tokens,
+            "tokens_saved": original_tokens - sent_tokens,
+            "summarized_messages": recent_start,
+            "truncated_messages": truncated
+        })
+        return compacted, report
+
+    def _fold(self, messages, key):
+        """Fold the older turns into the summary; return (messages, number of turns folded)."""
+        system_message, history, current = messages[0], messages[1:-1], messages[-1]
+
+        key = key or conversation_key(history)
+        fixed_tokens = message_tokens(system_message) + message_tokens(current)
+
+        # If the summary from an earlier request still leaves the rest within budget, reuse it as is
+        recent_start = self._cached_fold(key, history, fixed_tokens)
+        if recent_start is None:
+            # Keep recent turns verbatim up to fold_target of the budget (but never fewer than
+            # keep_recent), so the next few turns fit without summarizing again
+            available = int(self.token_budget * self.fold_target) - fixed_tokens
+            recent_start = len(history)
+            used = 0
+            while recent_start > 0:
+                tokens = message_tokens(history[recent_start - 1])
+                if len(history) - recent_start >= self.keep_recent and used + tokens > available:
+                    break
+                used += tokens
+                recent_start -= 1
+            if recent_start == 0:
+                return messages, 0
+
+        summary = self._summary_for(key, history[:recent_start])
+        compacted = [
+            system_message,
+            {"role": "system", "content": f"Summary of the earlier conversation with this teacher:\n{summary}"},
+            *history[recent_start:],
+            current
+        ]
+        return compacted, recent_start
+
+    def _truncate(self, messages):
+        """Cut the longest user and assistant messages down to a common length until messages fit the budget.
+
+        Short turns stay whole, and the system prompt and summary are never cut.
+        Returns (messages, number of messages cut).
+        """
+        excess = sum(message_tokens(m) for m in messages) - self.token_budget
+        if excess <= 0:
+            return messages, 0
+        sizes = {
+            index: count_tokens(message.get('content') or '')
+            for index, message in enumerate(messages) if message.get('role') != 'system'
+        }
+
+        def saved(cap):
+            longer = [size for size in sizes.values() if size > cap + TRUNCATION_MARKER_TOKENS]
+            return sum(size - cap - TRUNCATION_MARKER_TOKENS for size in longer)
+
+        # The longest cap that still saves enough; saved() shrinks as the cap grows
+        low, high = 0, max(sizes.values(), default=0)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if saved(middle) >= excess:
+                low = middle
+            else:
+                high = middle - 1
+
+        fitted, truncated = list(messages), 0
+        for index, size in sizes.items():
+            if size > low + TRUNCATION_MARKER_TOKENS:
+                content = truncate_tokens(messages[index]['content'], low) + TRUNCATION_MARKER.format(tokens=size)
+                fitted[index] = {**messages[index], "content": content}
+                truncated += 1
+        return fitted, truncated
+
+    def _cached_fold(self, key, history, fixed_tokens):
+        """Return how many messages the cached summary covers, if reusing it keeps the prompt in budget."""
+        with self._lock:
+            cached = self._summaries.get(key)
+        if cached is None:
+            return None
+        count, prefix_hash, summary = cached
+        if count > len(history) - self.keep_recent or _prefix_hash(history[:count]) != prefix_hash:
+            return None
+        summary_tokens = count_tokens(summary) + MESSAGE_OVERHEAD_TOKENS
+        if fixed_tokens + summary_tokens + sum(message_tokens(m) for m in history[count:]) > self.token_budget:
+            return None
+        return count
+
+    def _summary_for(self, key, folded):
+        with self._lock:
+            cached = self._summaries.get(key)
+
+        previous_summary, already_folded = None, 0
+        if cached is not None:
+            count, prefix_hash, summary = cached
+            # Reuse the cached summary only if the client's history still starts the same way
+            if count <= len(folded) and _prefix_hash(folded[:count]) == prefix_hash:
+                previous_summary, already_folded = summary, count
+
+        if already_folded == len(folded):
+            summary = previous_summary
+        else:
+            summary = self.summarize(previous_summary, folded[already_folded:])
+
+        with self._lock:
+            self._summaries[key] = (len(folded), _prefix_hash(folded), summary)
+            self._summaries.move_to_end(key)
+            while len(self._summaries) > self.max_conversations:
+                self._summaries.popitem(last=False)
+        return summary
+
+
+def create_history_manager(summarize):
+    """Build a ChatHistoryManager configured by the CHAT_HISTORY_* environment variables."""
+    return ChatHistoryManager(
+        summarize,
+        token_budget=int(os.getenv('CHAT_HISTORY_TOKEN_BUDGET', 6000)),
+        keep_recent=int(os.getenv('CHAT_HISTORY_KEEP_RECENT', 6))
+    )
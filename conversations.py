@@ -0,0 +1,130 @@
+"""Server-side conversation sessions for /chat.
+
+With a session, the browser sends only the new message and the context fields
+that changed; the server keeps the history and the merged context under a
+conversation id. Clients without a session keep using the stateless mode.
+
+Two backends are available, mirroring llm_cache.py:
+- MemoryConversationStore: per-process LRU with idle expiry
+- SQLiteConversationStore: a local database file shared by every worker
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+class UnknownConversationError(KeyError):
+    """The conversation id is unknown, e.g. because the session expired or was evicted."""
+
+
+def new_conversation_id():
+    return uuid.uuid4().hex
+
+
+def merge_context(base, changes):
+    """Return base updated with changes, merging nested dicts instead of replacing them."""
+    merged = dict(base)
+    for key, value in changes.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_context(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+class MemoryConversationStore:
+    def __init__(self, max_conversations=1000, ttl=6 * 3600):
+        self.max_conversations = max_conversations
+        self.ttl = ttl
+        self._conversations = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, conversation_id):
+        with self._lock:
+            entry = self._conversations.get(conversation_id)
+            if entry is None:
+                return None
+            conversation, touched_at = entry
+            if touched_at + self.ttl < time.time():
+                del self._conversations[conversation_id]
+                return None
+            self._conversations.move_to_end(conversation_id)
+            # Callers get their own copy so a half-finished request never leaks into the store
+            return json.loads(json.dumps(conversation))
+
+    def save(self, conversation_id, conversation):
+        with self._lock:
+            self._conversations[conversation_id] = (conversation, time.time())
+            self._conversations.move_to_end(conversation_id)
+            while len(self._conversations) > self.max_conversations:
+                self._conversations.popitem(last=False)
+
+    def delete(self, conversation_id):
+        with self._lock:
+            self._conversations.pop(conversation_id, None)
+
+
+class SQLiteConversationStore:
+    def __init__(self, path, max_conversations=10000, ttl=7 * 24 * 3600):
+        self.path = path
+        self.max_conversations = max_conversations
+        self.ttl = ttl
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS conversations (
+                    id TEXT PRIMARY KEY,
+                    data TEXT NOT NULL,
+                    touched_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS conversations_touched_at ON conversations (touched_at)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5)
+
+    def get(self, conversation_id):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT data, touched_at FROM conversations WHERE id = ?", (conversation_id,)
+            ).fetchone()
+        if row is None or row[1] + self.ttl < time.time():
+            return None
+        return json.loads(row[0])
+
+    def save(self, conversation_id, conversation):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO conversations (id, data, touched_at) VALUES (?, ?, ?)",
+                (conversation_id, json.dumps(conversation), now)
+            )
+            conn.execute("DELETE FROM conversations WHERE touched_at < ?", (now - self.ttl,))
+            conn.execute("""
+                DELETE FROM conversations WHERE id IN (
+                    SELECT id FROM conversations ORDER BY touched_at DESC LIMIT -1 OFFSET ?
+                )
+            """, (self.max_conversations,))
+
+    def delete(self, conversation_id):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
+
+
+def create_conversation_store():
+    """Build the store described by the CONVERSATION_STORE_* environment variables.
+
+    CONVERSATION_STORE_BACKEND is 'memory' (default) or 'sqlite'.
+    """
+    backend_name = os.getenv('CONVERSATION_STORE_BACKEND', 'memory').lower()
+    max_conversations = int(os.getenv('CONVERSATION_STORE_MAX', 1000))
+    ttl = int(os.getenv('CONVERSATION_STORE_TTL', 6 * 3600))
+
+    if backend_name == 'sqlite':
+        path = os.getenv('CONVERSATION_STORE_PATH', 'conversations.sqlite3')
+        return SQLiteConversationStore(path, max_conversations=max_conversations, ttl=ttl)
+    return MemoryConversationStore(max_conversations=max_conversations, ttl=ttl)
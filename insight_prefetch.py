@@ -0,0 +1,163 @@
+"""Speculative insight generation for the tags of a new helper card.
+
+Clicking a helper-card tag asks /generate_insight for an insight card, which
+used to be a cold completion taking seconds. When prefetching is enabled, the
+server generates the insights for the first few tags of every new helper card
+in the background, at the scheduler's lowest priority, and the results land
+in the response cache. The click is then served from the cache, or joins the
+prefetch if it is still running.
+
+The insight prompt depends on the helper context the editor sends, so both
+sides build it from the helper card data with helper_insight_context().
+Prefetches are capped per user and time window, and clicks are classified as
+hits (prefetched and finished), joins (prefetch still running) or misses, so
+the number of tags can be tuned from /scheduler_stats.
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+def helper_insight_context(helper_data):
+    """The helper_context the editor sends when a tag of this helper card is clicked.
+
+    Must stay identical to helperInsightContext() in static/js/script.js.
+    """
+    overview = helper_data.get('topic_overview') or {}
+    concepts = list(overview.get('key_concepts') or [])
+    for aspect in helper_data.get('teaching_aspects') or []:
+        concepts.extend(aspect.get('tags') or [])
+    for resource in helper_data.get('suggested_resources') or []:
+        concepts.extend(resource.get('examples') or [])
+    context = {
+        "title": overview.get('title') or 'Context',
+        "overview": {
+            "description": overview.get('description') or '',
+            "concepts": concepts
+        },
+        "aspects": []
+    }
+    # Same layout as JSON.stringify(context, null, 2)
+    return json.dumps(context, indent=2, ensure_ascii=False)
+
+
+def helper_tags(helper_data):
+    """Tags in the order a teacher sees them: key concepts first, then each teaching aspect's tags."""
+    overview = helper_data.get('topic_overview') or {}
+    tags = list(overview.get('key_concepts') or [])
+    for aspect in helper_data.get('teaching_aspects') or []:
+        tags.extend(aspect.get('tags') or [])
+    return list(dict.fromkeys(tag for tag in tags if isinstance(tag, str) and tag))
+
+
+class InsightPrefetcher:
+    """Plan prefetches within a per-user budget and keep hit-rate counters.
+
+    The caller runs the planned jobs (on a thread pool or as tasks) and reports
+    each one with started() and finished(), keyed by the insight's cache key.
+    """
+
+    def __init__(self, top_n=3, budget=30, budget_window=3600, max_tracked=5000, clock=time.time):
+        self.top_n = top_n
+        self.budget = budget
+        self.budget_window = budget_window
+        self.max_tracked = max_tracked
+        self._clock = clock
+        self._lock = threading.Lock()
+        # user -> [window start, prefetches used]
+        self._budgets = OrderedDict()
+        # cache key -> True once finished, False while running
+        self._prefetched = OrderedDict()
+        self.planned = 0
+        self.over_budget = 0
+        self.failed = 0
+        self.hits = 0
+        self.joins = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.top_n > 0
+
+    def plan(self, user_key, helper_content):
+        """Return [(concept, helper_context)] to prefetch for a new helper card (JSON text or dict)."""
+        if not self.enabled:
+            return []
+        try:
+            helper_data = json.loads(helper_content) if isinstance(helper_content, str) else helper_content
+            tags = helper_tags(helper_data)[:self.top_n]
+            helper_context = helper_insight_context(helper_data)
+        except (ValueError, TypeError, AttributeError):
+            return []
+
+        now = self._clock()
+        with self._lock:
+            window = self._budgets.get(user_key)
+            if window is None or now - window[0] >= self.budget_window:
+                window = self._budgets[user_key] = [now, 0]
+            self._budgets.move_to_end(user_key)
+            while len(self._budgets) > self.max_tracked:
+                self._budgets.popitem(last=False)
+
+            allowed = max(0, min(len(tags), self.budget - window[1]))
+            window[1] += allowed
+            self.planned += allowed
+            self.over_budget += len(tags) - allowed
+        return [(tag, helper_context) for tag in tags[:allowed]]
+
+    def started(self, cache_key):
+        with self._lock:
+            self._prefetched[cache_key] = False
+            self._prefetched.move_to_end(cache_key)
+            while len(self._prefetched) > self.max_tracked:
+                self._prefetched.popitem(last=False)
+
+    def finished(self, cache_key, success=True):
+        with self._lock:
+            if not success:
+                self.failed += 1
+                self._prefetched.pop(cache_key, None)
+            elif cache_key in self._prefetched:
+                self._prefetched[cache_key] = True
+
+    def record_click(self, cache_key):
+        """Classify an insight request as a hit, a join or a miss."""
+        with self._lock:
+            state = self._prefetched.pop(cache_key, None)
+            if state is True:
+                self.hits += 1
+            elif state is False:
+                self.joins += 1
+            else:
+                self.misses += 1
+
+    def stats(self):
+        with self._lock:
+            clicks = self.hits + self.joins + self.misses
+            return {
+                "enabled": self.enabled,
+                "top_n": self.top_n,
+                "planned": self.planned,
+                "over_budget": self.over_budget,
+                "failed": self.failed,
+                "hits": self.hits,
+                "joins": self.joins,
+                "misses": self.misses,
+                # Share of clicks that found a prefetch, and share of prefetches that were clicked
+                "hit_rate": round((self.hits + self.joins) / clicks, 4) if clicks else 0.0,
+                "used_rate": round((self.hits + self.joins) / self.planned, 4) if self.planned else 0.0
+            }
+
+
+def create_insight_prefetcher():
+    """Build the InsightPrefetcher described by the INSIGHT_PREFETCH_* environment variables.
+
+    INSIGHT_PREFETCH_TAGS is the number of tags prefetched per helper card; 0 (the default) disables prefetching.
+    """
+    return InsightPrefetcher(
+        top_n=int(os.getenv('INSIGHT_PREFETCH_TAGS', 0)),
+        budget=int(os.getenv('INSIGHT_PREFETCH_BUDGET', 30)),
+        budget_window=int(os.getenv('INSIGHT_PREFETCH_WINDOW', 3600))
+    )
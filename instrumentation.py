@@ -0,0 +1,318 @@
+"""Request and upstream-call instrumentation.
+
+Every HTTP request and every OpenAI call is measured into a small set of
+Prometheus counters and histograms, served in the text exposition format on
+/metrics, and logged as one JSON line:
+
+- requests: duration, time to first byte, status, request and response bytes
+- upstream calls: queue time (waiting for a slot, rate limits and retry
+  backoff), time to first token, total upstream time, prompt, cached prompt
+  and completion tokens from the reported usage, and the estimated cost
+- response cache lookups: hits and misses
+
+Upstream calls are attributed to the route that made them through the
+current_route context variable, which the request hooks set. Calls made on
+pool threads keep the route when the work is submitted through
+copy_context().run; prefetches set their own label.
+
+prompt_cache_report() turns the token counters into per-route cached-token
+ratios (served on /prompt_cache_stats), to check how much of each route's
+prompt OpenAI's prefix cache serves.
+
+Metrics are per process: with several gunicorn workers, each worker reports
+its own values.
+"""
+import bisect
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+
+# Route an upstream call is made for, e.g. '/generate_insight'
+current_route = contextvars.ContextVar('current_route', default='background')
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+TOKEN_BUCKETS = (16, 64, 256, 1024, 2048, 4096, 8192, 16384, 32768)
+
+# USD per million (prompt, cached prompt, completion) tokens, matched on the model name prefix
+MODEL_PRICES = {
+    'gpt-4o-mini': (0.15, 0.075, 0.60),
+    'gpt-4o': (2.50, 1.25, 10.00),
+}
+
+
+def model_price(model):
+    """(prompt, cached prompt, completion) USD per million tokens for a model name such as 'gpt-4o-mini-2024-07-18'."""
+    for prefix in sorted(MODEL_PRICES, key=len, reverse=True):
+        if model and model.startswith(prefix):
+            return MODEL_PRICES[prefix]
+    return (0.0, 0.0, 0.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(tuple(str(labels[name]) for name in self.labelnames), 0)
+
+    def series(self):
+        """{label values: value} for every series recorded so far."""
+        with self._lock:
+            return dict(self._values)
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_labels(self.labelnames, key)} {_number(value)}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # label values -> [per-bucket counts (last one is +Inf), sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, amount, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, amount)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += amount
+
+    def count(self, **labels):
+        with self._lock:
+            series = self._values.get(tuple(str(labels[name]) for name in self.labelnames))
+            return sum(series[0]) if series else 0
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{_labels(self.labelnames, key, [("le", _number(bound))])} {cumulative}')
+                lines.append(f'{self.name}_sum{_labels(self.labelnames, key)} {_number(total)}')
+                lines.append(f'{self.name}_count{_labels(self.labelnames, key)} {cumulative}')
+        return lines
+
+
+REQUESTS = Counter('http_requests_total', 'HTTP requests by route, method and status.', ('route', 'method', 'status'))
+REQUEST_SECONDS = Histogram('http_request_duration_seconds', 'Time until the response body was fully sent.', ('route',))
+REQUEST_TTFB_SECONDS = Histogram('http_time_to_first_byte_seconds', 'Time until the first response bytes.', ('route',))
+REQUEST_BYTES = Histogram('http_request_size_bytes', 'Request body size.', ('route',), SIZE_BUCKETS)
+RESPONSE_BYTES = Histogram('http_response_size_bytes', 'Response body size.', ('route',), SIZE_BUCKETS)
+
+LLM_CALLS = Counter('llm_requests_total', 'Upstream OpenAI calls by route, priority and outcome.', ('route', 'priority', 'outcome'))
+LLM_QUEUE_SECONDS = Histogram(
+    'llm_queue_seconds', 'Time before the successful attempt was sent: slot wait, rate limits and retry backoff.',
+    ('route', 'priority')
+)
+LLM_FIRST_TOKEN_SECONDS = Histogram('llm_time_to_first_token_seconds', 'Upstream time to the first streamed token.', ('route',))
+LLM_UPSTREAM_SECONDS = Histogram('llm_upstream_seconds', 'Upstream time from sending the request to the last token.', ('route',))
+LLM_TOKENS = Counter(
+    'llm_tokens_total',
+    'Tokens reported by the API, by route and kind (prompt, cached_prompt or completion; cached_prompt is part of prompt).',
+    ('route', 'kind')
+)
+LLM_COMPLETION_TOKENS = Histogram('llm_completion_tokens', 'Completion tokens per upstream call.', ('route',), TOKEN_BUCKETS)
+LLM_COST = Counter('llm_cost_usd_total', 'Estimated upstream cost in USD.', ('route', 'model'))
+CACHE_LOOKUPS = Counter('llm_cache_lookups_total', 'Response cache lookups by route and result (hit or miss).', ('route', 'result'))
+
+METRICS = (
+    REQUESTS, REQUEST_SECONDS, REQUEST_TTFB_SECONDS, REQUEST_BYTES, RESPONSE_BYTES,
+    LLM_CALLS, LLM_QUEUE_SECONDS, LLM_FIRST_TOKEN_SECONDS, LLM_UPSTREAM_SECONDS,
+    LLM_TOKENS, LLM_COMPLETION_TOKENS, LLM_COST, CACHE_LOOKUPS,
+)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def render_metrics():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.expose())
+    return '\n'.join(lines) + '\n'
+
+
+_log_lock = threading.Lock()
+
+
+def log_event(event, **fields):
+    """Write one JSON log line to stdout (METRICS_LOG=0 turns them off; the metrics are still collected)."""
+    if os.environ.get('METRICS_LOG') == '0':
+        return
+    line = json.dumps({"ts": round(time.time(), 3), "event": event, **fields}, default=str, ensure_ascii=False)
+    with _log_lock:
+        sys.stdout.write(line + '\n')
+        sys.stdout.flush()
+
+
+def observe_request(route, method, status, duration, first_byte, request_bytes, response_bytes):
+    REQUESTS.inc(route=route, method=method, status=status)
+    REQUEST_SECONDS.observe(duration, route=route)
+    REQUEST_TTFB_SECONDS.observe(first_byte, route=route)
+    if request_bytes is not None:
+        REQUEST_BYTES.observe(request_bytes, route=route)
+    if response_bytes is not None:
+        RESPONSE_BYTES.observe(response_bytes, route=route)
+    log_event(
+        'request', route=route, method=method, status=status, duration=round(duration, 4),
+        ttfb=round(first_byte, 4), request_bytes=request_bytes, response_bytes=response_bytes
+    )
+
+
+class RequestTimer:
+    """Times one request until its response body has been sent, counting streamed bytes on the way."""
+
+    def __init__(self, route, method, request_bytes):
+        self.route = route
+        self.method = method
+        self.request_bytes = request_bytes
+        self.started = time.perf_counter()
+        self.first_byte = None
+        self.response_bytes = 0
+
+    def _sent(self, chunk):
+        if self.first_byte is None:
+            self.first_byte = time.perf_counter() - self.started
+        self.response_bytes += len(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+
+    def meter(self, chunks):
+        """Pass a streamed body through, timing its first chunk and counting its bytes."""
+        for chunk in chunks:
+            self._sent(chunk)
+            yield chunk
+
+    async def ameter(self, chunks):
+        async for chunk in chunks:
+            self._sent(chunk)
+            yield chunk
+
+    def finish(self, status, response_bytes=None):
+        """Record the request; response_bytes is the body size of a response that was not metered."""
+        duration = time.perf_counter() - self.started
+        if response_bytes is None:
+            response_bytes = self.response_bytes
+        observe_request(
+            self.route, self.method, status, duration,
+            self.first_byte if self.first_byte is not None else duration,
+            self.request_bytes, response_bytes
+        )
+
+
+def observe_cache(hit):
+    CACHE_LOOKUPS.inc(route=current_route.get(), result='hit' if hit else 'miss')
+
+
+class UpstreamMetrics:
+    """The llm_scheduler observer: records every upstream call made through the scheduler."""
+
+    def upstream(self, priority, queued, first_token, duration, response, stream):
+        """One successful call; response is the completion, or for streams the chunk carrying usage (or None)."""
+        route = current_route.get()
+        LLM_CALLS.inc(route=route, priority=priority, outcome='ok')
+        LLM_QUEUE_SECONDS.observe(queued, route=route, priority=priority)
+        LLM_UPSTREAM_SECONDS.observe(duration, route=route)
+        if first_token is not None:
+            LLM_FIRST_TOKEN_SECONDS.observe(first_token, route=route)
+
+        usage = getattr(response, 'usage', None)
+        model = getattr(response, 'model', None) or 'unknown'
+        prompt_tokens = getattr(usage, 'prompt_tokens', None) or 0
+        completion_tokens = getattr(usage, 'completion_tokens', None) or 0
+        # Prompt tokens served from OpenAI's prefix cache, billed at the cached rate
+        cached_tokens = getattr(getattr(usage, 'prompt_tokens_details', None), 'cached_tokens', None) or 0
+        cost = 0.0
+        if usage is not None:
+            LLM_TOKENS.inc(prompt_tokens, route=route, kind='prompt')
+            LLM_TOKENS.inc(cached_tokens, route=route, kind='cached_prompt')
+            LLM_TOKENS.inc(completion_tokens, route=route, kind='completion')
+            LLM_COMPLETION_TOKENS.observe(completion_tokens, route=route)
+            prompt_price, cached_price, completion_price = model_price(model)
+            cost = (
+                (prompt_tokens - cached_tokens) * prompt_price + cached_tokens * cached_price
+                + completion_tokens * completion_price
+            ) / 1_000_000
+            LLM_COST.inc(cost, route=route, model=model)
+
+        log_event(
+            'upstream', route=route, priority=priority, model=model, stream=stream,
+            queue=round(queued, 4), ttft=round(first_token, 4) if first_token is not None else None,
+            upstream=round(duration, 4), prompt_tokens=prompt_tokens, cached_tokens=cached_tokens,
+            completion_tokens=completion_tokens, cost_usd=round(cost, 6)
+        )
+
+    def error(self, priority, error, retrying):
+        route = current_route.get()
+        LLM_CALLS.inc(route=route, priority=priority, outcome='retried' if retrying else 'failed')
+        log_event('upstream_error', route=route, priority=priority, error=type(error).__name__, retrying=retrying)
+
+    def cancelled(self, priority):
+        """A call or stream given up by its caller before it completed, e.g. a client disconnect."""
+        route = current_route.get()
+        LLM_CALLS.inc(route=route, priority=priority, outcome='cancelled')
+        log_event('upstream_cancelled', route=route, priority=priority)
+
+
+def prompt_cache_report():
+    """Prompt tokens, cached prompt tokens and the cached ratio per route and in total."""
+    routes = {}
+    for (route, kind), value in LLM_TOKENS.series().items():
+        if kind in ('prompt', 'cached_prompt'):
+            routes.setdefault(route, {'prompt_tokens': 0, 'cached_tokens': 0})
+            routes[route]['prompt_tokens' if kind == 'prompt' else 'cached_tokens'] += value
+
+    def with_ratio(totals):
+        prompt_tokens = totals['prompt_tokens']
+        return {**totals, 'cached_ratio': round(totals['cached_tokens'] / prompt_tokens, 4) if prompt_tokens else 0.0}
+
+    total = {
+        'prompt_tokens': sum(r['prompt_tokens'] for r in routes.values()),
+        'cached_tokens': sum(r['cached_tokens'] for r in routes.values())
+    }
+    return {
+        'routes': {route: with_ratio(totals) for route, totals in sorted(routes.items())},
+        'total': with_ratio(total)
+    }
@@ -0,0 +1,600 @@
+"""Firestore access for saved lessons.
+
+Lessons live in the 'lessons' collection, one document per lesson with the
+owner's uid in userId. An update reads only the fields it needs (userId, the
+version counter, the pillars it touches and any arrays being appended to),
+then writes with a last_update_time precondition. If another save lands
+between the read and the write, Firestore rejects the write and the update is
+retried, so concurrent saves can no longer slip between the ownership check
+and the write.
+
+Every write bumps the lesson's version counter. Clients that send the version
+they last saw (baseVersion) get a LessonVersionConflictError instead of
+overwriting someone else's save.
+
+Pillar versions are stored compressed and out of the lesson document. The
+lesson keeps, per pillar, only {versionCount, currentIndex, current}, where
+current is the compressed current version. Every version lives in the
+'versions' subcollection of the lesson, VERSION_CHUNK_SIZE versions per chunk
+document ('<pillar>-<chunk number>'). Lessons saved in the old format, with
+full 'versions' arrays inline, are still read as is and are converted pillar
+by pillar the next time that pillar is written.
+
+Each user also has a summary index, 'lessonIndex/<uid>/lessons', with one
+small entry document per lesson holding its title, lastModified, version,
+pillar version counts and a preview, so a dashboard page reads only the
+entries on that page. The entry is written in the same batch as the lesson
+on create, update and delete, so the two commit together. An index that was
+never built (for lessons saved before it existed) is rebuilt from the
+lessons on the next listing; `flask --app app rebuild-lesson-index`
+rebuilds every user's index.
+"""
+import json
+import re
+import zlib
+
+from firebase_admin import firestore
+from google.api_core.exceptions import FailedPrecondition, NotFound
+from google.cloud.firestore_v1.field_path import FieldPath
+
+LESSONS_COLLECTION = 'lessons'
+VERSIONS_COLLECTION = 'versions'
+INDEX_COLLECTION = 'lessonIndex'
+INDEX_ENTRIES_COLLECTION = 'lessons'
+PILLAR_KEYS = ('content', 'language', 'tasks', 'assessment', 'materials')
+# Top-level fields clients read and patch; userId, version and lastModified are managed here
+LESSON_FIELDS = ('title', 'pillars', 'sideCards', 'chatHistory', 'chatContext')
+VERSION_CHUNK_SIZE = 10
+PREVIEW_LENGTH = 80
+# Firestore allows 500 writes per batch
+INDEX_REBUILD_BATCH_SIZE = 400
+# How many times an update re-reads the lesson after losing a race with another write
+UPDATE_ATTEMPTS = 3
+
+
+class LessonNotFoundError(KeyError):
+    """The lesson (or the requested pillar version) does not exist."""
+
+
+class LessonAccessError(PermissionError):
+    """The lesson belongs to another user."""
+
+
+class LessonConflictError(RuntimeError):
+    """The lesson kept changing between the ownership check and the write."""
+
+
+class LessonVersionConflictError(LessonConflictError):
+    """The lesson was saved by someone else since the client's baseVersion."""
+
+    def __init__(self, lesson_id, current_version):
+        super().__init__(lesson_id)
+        self.current_version = current_version
+
+
+def _field(snapshot, field_path, default=None):
+    # DocumentSnapshot.get raises KeyError for missing fields
+    try:
+        value = snapshot.get(field_path)
+    except KeyError:
+        return default
+    return default if value is None else value
+
+
+def compress_version(body):
+    return zlib.compress(json.dumps(body, ensure_ascii=False).encode('utf-8'))
+
+
+def decompress_version(data):
+    return json.loads(zlib.decompress(bytes(data)).decode('utf-8'))
+
+
+def _chunk_count(version_count):
+    return -(-version_count // VERSION_CHUNK_SIZE)
+
+
+def _chunk_id(key, index):
+    return f'{key}-{index // VERSION_CHUNK_SIZE}'
+
+
+def _pillar_state(stored):
+    """Return (versionCount, currentIndex, current version or None) for a stored pillar in either format."""
+    stored = stored or {}
+    current_index = stored.get('currentIndex') or 0
+    if isinstance(stored.get('versions'), list):
+        versions = stored['versions']
+        current = versions[current_index] if 0 <= current_index < len(versions) else None
+        return len(versions), current_index, current
+    current = decompress_version(stored['current']) if stored.get('current') is not None else None
+    return stored.get('versionCount') or 0, current_index, current
+
+
+def _check_path(path):
+    parts = path.split('.') if isinstance(path, str) else []
+    if not parts or not all(parts) or parts[0] not in LESSON_FIELDS:
+        raise ValueError(f"Cannot patch field: {path}")
+    if parts[0] == 'pillars' and len(parts) > 1:
+        if parts[1] not in PILLAR_KEYS:
+            raise ValueError(f"Unknown pillar: {parts[1]}")
+        tail = parts[2:]
+        if not (tail in ([], ['versions'], ['currentIndex'])
+                or (len(tail) == 2 and tail[0] == 'versions' and tail[1].isdigit())):
+            raise ValueError(f"Cannot patch field: {path}")
+
+
+def _check_ops(ops):
+    """Validate patch operations and return the non-pillar field paths they append to."""
+    if not isinstance(ops, list) or not ops:
+        raise ValueError("A patch needs a non-empty list of ops")
+    for op in ops:
+        if not isinstance(op, dict) or op.get('op') not in ('set', 'append') or 'value' not in op:
+            raise ValueError(f"Invalid patch op: {op}")
+        _check_path(op.get('path'))
+        parts = op['path'].split('.')
+        if op['op'] == 'append' and parts[0] == 'pillars' and parts[2:] != ['versions']:
+            raise ValueError(f"Can only append to pillar versions: {op['path']}")
+
+    # Firestore rejects one update that writes both a field and something inside it.
+    # Pillar ops are applied in order by LessonStore, so they may overlap.
+    paths = sorted({op['path'] for op in ops if not op['path'].startswith('pillars')})
+    for parent, child in zip(paths, paths[1:]):
+        if child.startswith(parent + '.'):
+            raise ValueError(f"Patch paths overlap: {parent} and {child}")
+    return sorted({
+        op['path'] for op in ops if op['op'] == 'append' and not op['path'].startswith('pillars')
+    })
+
+
+def _pillar_changes(path, value, append=False):
+    """Translate one write to a pillar path into [(pillar key, change), ...]."""
+    parts = path.split('.')
+    if len(parts) == 1:
+        if not isinstance(value, dict):
+            raise ValueError("pillars must be an object")
+        return [change for key, pillar in value.items() for change in _pillar_changes(f'pillars.{key}', pillar)]
+    key = parts[1]
+    if key not in PILLAR_KEYS:
+        raise ValueError(f"Unknown pillar: {key}")
+    if len(parts) == 2:
+        pillar = value or {}
+        return [
+            (key, ('replace', list(pillar.get('versions') or []))),
+            (key, ('current_index', pillar.get('currentIndex') or 0))
+        ]
+    if parts[2] == 'currentIndex':
+        return [(key, ('current_index', value))]
+    if len(parts) == 4:
+        return [(key, ('set_version', int(parts[3]), value))]
+    if append:
+        return [(key, ('append', value))]
+    return [(key, ('replace', list(value or [])))]
+
+
+def _group_pillar_changes(changes):
+    grouped = {}
+    for key, change in changes:
+        grouped.setdefault(key, []).append(change)
+    return grouped
+
+
+def _preview(body):
+    if not isinstance(body, str):
+        return ''
+    text = ' '.join(re.sub(r'<[^>]+>', ' ', body).split())
+    return text[:PREVIEW_LENGTH].rstrip()
+
+
+class LessonStore:
+    def __init__(self, db):
+        self.db = db
+
+    def _document(self, lesson_id=None):
+        collection = self.db.collection(LESSONS_COLLECTION)
+        return collection.document(lesson_id) if lesson_id else collection.document()
+
+    def _chunk(self, doc_ref, chunk_id):
+        return doc_ref.collection(VERSIONS_COLLECTION).document(chunk_id)
+
+    def _index(self, uid):
+        return self.db.collection(INDEX_COLLECTION).document(uid)
+
+    def _index_entries(self, uid):
+        return self._index(uid).collection(INDEX_ENTRIES_COLLECTION)
+
+    def _index_entry(self, uid, lesson_id):
+        return self._index_entries(uid).document(lesson_id)
+
+    def _read_chunk(self, doc_ref, key, index):
+        snapshot = self._chunk(doc_ref, _chunk_id(key, index)).get()
+        if not snapshot.exists:
+            return {}
+        return {int(position): decompress_version(data) for position, data in _field(snapshot, 'versions', {}).items()}
+
+    def _stage_pillar(self, batch, doc_ref, uid, key, stored, changes):
+        """Add the chunk writes for changes to one pillar to batch.
+
+        Returns the pillar's new entry for the lesson document and its current version.
+        """
+        stored = stored or {}
+        legacy = isinstance(stored.get('versions'), list)
+        old_count, current_index, _ = _pillar_state(stored)
+        count = old_count
+        # Versions this save writes (index -> version); with rewrite, every chunk is written from scratch
+        written = dict(enumerate(stored['versions'])) if legacy else {}
+        rewrite = legacy
+
+        for change in changes:
+            if change[0] == 'replace':
+                written, count, rewrite = dict(enumerate(change[1])), len(change[1]), True
+            elif change[0] == 'append':
+                written[count] = change[1]
+                count += 1
+            elif change[0] == 'set_version':
+                if not 0 <= change[1] < count:
+                    raise ValueError(f"No version {change[1]} in pillar {key}")
+                written[change[1]] = change[2]
+            else:
+                current_index = change[1] if isinstance(change[1], int) else 0
+        current_index = min(max(current_index, 0), max(count - 1, 0))
+
+        chunks = {}
+        for index, version in written.items():
+            chunks.setdefault(_chunk_id(key, index), {})[str(index)] = compress_version(version)
+        for chunk_id, versions in chunks.items():
+            # Appends and single-version edits merge into the chunk; a rewrite replaces it
+            batch.set(self._chunk(doc_ref, chunk_id), {'userId': uid, 'versions': versions}, merge=not rewrite)
+        if rewrite and not legacy:
+            for chunk in range(_chunk_count(count), _chunk_count(old_count)):
+                batch.delete(self._chunk(doc_ref, f'{key}-{chunk}'))
+
+        if count == 0:
+            current = None
+        elif current_index in written:
+            current = written[current_index]
+        elif current_index == (stored.get('currentIndex') or 0) and stored.get('current') is not None:
+            current = decompress_version(stored['current'])
+        else:
+            # Switched to a version this save did not send: read it from its chunk
+            current = self._read_chunk(doc_ref, key, current_index).get(current_index)
+
+        entry = {
+            'versionCount': count,
+            'currentIndex': current_index,
+            'current': compress_version(current) if current is not None else None
+        }
+        return entry, current
+
+    def create(self, uid, lesson_data):
+        """Store a new lesson for uid and return its id."""
+        doc_ref = self._document()
+        batch = self.db.batch()
+        lesson_data = dict(lesson_data)
+        pillar_changes = _group_pillar_changes(_pillar_changes('pillars', lesson_data.pop('pillars', None) or {}))
+
+        pillars = {}
+        summary = {'title': lesson_data.get('title') or 'Untitled Lesson', 'preview': '', 'pillarVersions': {}}
+        for key, changes in pillar_changes.items():
+            pillars[key], current = self._stage_pillar(batch, doc_ref, uid, key, {}, changes)
+            summary['pillarVersions'][key] = pillars[key]['versionCount']
+            if key == 'content':
+                summary['preview'] = _preview(current)
+
+        batch.set(doc_ref, {
+            **lesson_data,
+            'pillars': pillars,
+            'userId': uid,
+            'version': 1,
+            'lastModified': firestore.SERVER_TIMESTAMP
+        })
+        batch.set(self._index_entry(uid, doc_ref.id), {
+            **summary, 'version': 1, 'lastModified': firestore.SERVER_TIMESTAMP
+        })
+        batch.commit()
+        return doc_ref.id
+
+    def load(self, uid, lesson_id, all_versions=False, fields=None):
+        """Return uid's lesson with each pillar as {versionCount, currentIndex, current}.
+
+        With all_versions, each pillar also has its full 'versions' list, read from the chunks.
+        fields limits the read to those top-level fields (plus version), so the editor can
+        fetch the title and pillars first and side cards or chat history only when needed.
+        """
+        if fields is not None:
+            unknown = [field for field in fields if field not in LESSON_FIELDS]
+            if unknown:
+                raise ValueError(f"Unknown lesson fields: {', '.join(unknown)}")
+        doc_ref = self._document(lesson_id)
+        snapshot = doc_ref.get(field_paths=['userId', 'version', *fields]) if fields is not None else doc_ref.get()
+        if not snapshot.exists:
+            raise LessonNotFoundError(lesson_id)
+        lesson = snapshot.to_dict()
+        if lesson.get('userId') != uid:
+            raise LessonAccessError(lesson_id)
+
+        pillars = {}
+        for key, stored in (lesson.get('pillars') or {}).items():
+            count, current_index, current = _pillar_state(stored)
+            pillars[key] = {'versionCount': count, 'currentIndex': current_index, 'current': current}
+            if all_versions and isinstance((stored or {}).get('versions'), list):
+                pillars[key]['versions'] = stored['versions']
+
+        if all_versions:
+            # One batched read for every chunk of every pillar
+            chunk_refs = [
+                self._chunk(doc_ref, f'{key}-{chunk}')
+                for key, pillar in pillars.items() if 'versions' not in pillar
+                for chunk in range(_chunk_count(pillar['versionCount']))
+            ]
+            found = {}
+            for chunk in (self.db.get_all(chunk_refs) if chunk_refs else []):
+                if chunk.exists:
+                    key = chunk.id.rsplit('-', 1)[0]
+                    for position, data in _field(chunk, 'versions', {}).items():
+                        found.setdefault(key, {})[int(position)] = decompress_version(data)
+            for key, pillar in pillars.items():
+                if 'versions' not in pillar:
+                    pillar['versions'] = [found.get(key, {}).get(index) for index in range(pillar['versionCount'])]
+
+        if fields is None or 'pillars' in fields:
+            lesson['pillars'] = pillars
+        return lesson
+
+    def load_versions(self, uid, lesson_id, key, index):
+        """Return {index: version} for the chunk of pillar key that holds version index."""
+        if key not in PILLAR_KEYS:
+            raise ValueError(f"Unknown pillar: {key}")
+        doc_ref = self._document(lesson_id)
+        chunk = self._chunk(doc_ref, _chunk_id(key, index)).get()
+        if chunk.exists:
+            if _field(chunk, 'userId') != uid:
+                raise LessonAccessError(lesson_id)
+            versions = {
+                int(position): decompress_version(data) for position, data in _field(chunk, 'versions', {}).items()
+            }
+        else:
+            # Lessons in the old format keep their versions inline
+            snapshot = doc_ref.get(field_paths=['userId', f'pillars.{key}'])
+            if not snapshot.exists:
+                raise LessonNotFoundError(lesson_id)
+            if _field(snapshot, 'userId') != uid:
+                raise LessonAccessError(lesson_id)
+            inline = _field(snapshot, f'pillars.{key}.versions', [])
+            start = index - index % VERSION_CHUNK_SIZE
+            versions = {position: inline[position] for position in range(start, min(start + VERSION_CHUNK_SIZE, len(inline)))}
+        if index not in versions:
+            raise LessonNotFoundError(f'{lesson_id}/{key}/{index}')
+        return versions
+
+    def list_lessons(self, uid, page_size, cursor=None):
+        """Return (summaries, next_cursor) for one page of uid's lessons, newest first.
+
+        The page is read from uid's summary index entries, page_size + 1 small documents.
+        Lessons are ordered by lastModified, then id, so lessons saved at the same instant
+        (batch imports, rebuilds) are neither skipped nor repeated. cursor is the
+        (lastModified, id) of the last lesson on the previous page; next_cursor is None on the
+        last page. The first page checks that the index is complete and rebuilds it if not.
+        """
+        if cursor is None:
+            snapshot = self._index(uid).get(field_paths=['entriesComplete'])
+            if not (snapshot.exists and _field(snapshot, 'entriesComplete', False)):
+                self.rebuild_index(uid)
+
+        document_id = FieldPath.document_id()
+        query = (
+            self._index_entries(uid)
+            .order_by('lastModified', direction=firestore.Query.DESCENDING)
+            .order_by(document_id, direction=firestore.Query.DESCENDING)
+        )
+        if cursor is not None:
+            last_modified, lesson_id = cursor
+            # A cursor on the document id takes a reference, not the bare id
+            query = query.start_after({
+                'lastModified': last_modified, document_id: self._index_entry(uid, lesson_id)
+            })
+        # One extra entry tells us whether there is another page
+        snapshots = list(query.limit(page_size + 1).stream())
+        page = [{'id': snapshot.id, **snapshot.to_dict()} for snapshot in snapshots[:page_size]]
+        next_cursor = (page[-1]['lastModified'], page[-1]['id']) if len(snapshots) > page_size else None
+        return page, next_cursor
+
+    def rebuild_index(self, uid):
+        """Rebuild uid's summary index from their lessons and return its entries.
+
+        Entries are merged document by document, and an entry is deleted only once its lesson
+        is confirmed gone, so a lesson saved while the rebuild runs keeps its entry.
+        """
+        query = (
+            self.db.collection(LESSONS_COLLECTION)
+            .where('userId', '==', uid)
+            .select(('title', 'lastModified', 'version', 'pillars'))
+        )
+        entries = {}
+        for snapshot in query.stream():
+            lesson = snapshot.to_dict()
+            pillars = {key: _pillar_state(stored) for key, stored in (lesson.get('pillars') or {}).items()}
+            entries[snapshot.id] = {
+                'title': lesson.get('title') or 'Untitled Lesson',
+                'preview': _preview(pillars['content'][2]) if 'content' in pillars else '',
+                'pillarVersions': {key: state[0] for key, state in pillars.items()},
+                'version': lesson.get('version') or 0,
+                'lastModified': lesson.get('lastModified')
+            }
+
+        # An empty select returns whole documents, so select only the document names
+        names = self._index_entries(uid).select([FieldPath.document_id()])
+        unlisted = [snapshot.id for snapshot in names.stream() if snapshot.id not in entries]
+        if unlisted:
+            lessons = self.db.get_all([self._document(lesson_id) for lesson_id in unlisted], field_paths=['userId'])
+            unlisted = [lesson.id for lesson in lessons if not lesson.exists]
+
+        writes = list(entries.items()) + [(lesson_id, None) for lesson_id in unlisted]
+        for start in range(0, len(writes), INDEX_REBUILD_BATCH_SIZE):
+            batch = self.db.batch()
+            for lesson_id, entry in writes[start:start + INDEX_REBUILD_BATCH_SIZE]:
+                if entry is None:
+                    batch.delete(self._index_entry(uid, lesson_id))
+                else:
+                    batch.set(self._index_entry(uid, lesson_id), entry, merge=True)
+            batch.commit()
+        # Also drops the entries map of the old single-document index
+        self._index(uid).set(
+            {
+                'userId': uid,
+                'entriesComplete': True,
+                'complete': firestore.DELETE_FIELD,
+                'lessons': firestore.DELETE_FIELD
+            },
+            merge=True
+        )
+        return entries
+
+    def rebuild_all_indexes(self):
+        """Rebuild the summary index of every user who has lessons; return the number of users."""
+        uids = {
+            snapshot.to_dict().get('userId')
+            for snapshot in self.db.collection(LESSONS_COLLECTION).select(('userId',)).stream()
+        }
+        uids.discard(None)
+        for uid in uids:
+            self.rebuild_index(uid)
+        return len(uids)
+
+    def _commit_checked(self, uid, lesson_id, stage, read_paths=(), base_version=None):
+        """Check ownership (and baseVersion) and commit the writes stage() adds to a batch.
+
+        stage(batch, doc_ref, snapshot, version, option) must write the lesson with option,
+        a last_update_time precondition, so the commit fails if the lesson changed since the read.
+        """
+        doc_ref = self._document(lesson_id)
+
+        for _ in range(UPDATE_ATTEMPTS):
+            snapshot = doc_ref.get(field_paths=['userId', 'version', *read_paths])
+            if not snapshot.exists:
+                raise LessonNotFoundError(lesson_id)
+            if _field(snapshot, 'userId') != uid:
+                raise LessonAccessError(lesson_id)
+            version = _field(snapshot, 'version', 0)
+            if base_version is not None and base_version != version:
+                raise LessonVersionConflictError(lesson_id, version)
+
+            batch = self.db.batch()
+            result = stage(batch, doc_ref, snapshot, version, self.db.write_option(last_update_time=snapshot.update_time))
+            try:
+                batch.commit()
+                return result
+            except FailedPrecondition:
+                # Someone else saved or deleted it in between; check again against the new version
+                continue
+            except NotFound:
+                raise LessonNotFoundError(lesson_id)
+        raise LessonConflictError(lesson_id)
+
+    def _write(self, uid, lesson_id, build_fields, pillar_changes, read_paths=(), base_version=None):
+        """Apply build_fields(snapshot) and the pillar changes to the lesson and its index entry.
+
+        pillar_changes maps pillar keys to lists of changes: ('replace', versions),
+        ('append', version), ('set_version', index, version) or ('current_index', index).
+        Returns the lesson's new version.
+        """
+        def stage(batch, doc_ref, snapshot, version, option):
+            fields = build_fields(snapshot)
+            summary = {'title': fields['title']} if 'title' in fields else {}
+            for key, changes in pillar_changes.items():
+                entry, current = self._stage_pillar(
+                    batch, doc_ref, uid, key, _field(snapshot, f'pillars.{key}', {}), changes
+                )
+                fields[f'pillars.{key}'] = entry
+                summary.setdefault('pillarVersions', {})[key] = entry['versionCount']
+                if key == 'content':
+                    summary['preview'] = _preview(current)
+
+            batch.update(doc_ref, {
+                **fields,
+                'userId': uid,
+                'version': version + 1,
+                'lastModified': firestore.SERVER_TIMESTAMP
+            }, option=option)
+            # Merged, so pillarVersions keeps the counts of the pillars this save left alone
+            batch.set(self._index_entry(uid, lesson_id), {
+                **summary, 'version': version + 1, 'lastModified': firestore.SERVER_TIMESTAMP
+            }, merge=True)
+            return version + 1
+
+        read_paths = [*read_paths, *(f'pillars.{key}' for key in pillar_changes)]
+        return self._commit_checked(uid, lesson_id, stage, read_paths=read_paths, base_version=base_version)
+
+    def update(self, uid, lesson_id, fields, base_version=None):
+        """Update an existing lesson owned by uid and return its new version.
+
+        fields maps top-level field names or dotted field paths to their new values;
+        each value replaces the stored one. Unlike the set(merge=True) that save_lesson
+        used to do, a map such as chatContext is replaced whole rather than merged into
+        the stored map, so keys the caller leaves out are dropped. To change single keys,
+        pass dotted paths (chatContext.topic) or use patch().
+        """
+        plain, pillar_changes = {}, []
+        for path, value in fields.items():
+            if path in ('userId', 'version', 'lastModified'):
+                continue
+            if path.split('.')[0] == 'pillars':
+                pillar_changes.extend(_pillar_changes(path, value))
+            else:
+                plain[path] = value
+        return self._write(
+            uid, lesson_id, lambda snapshot: dict(plain), _group_pillar_changes(pillar_changes),
+            base_version=base_version
+        )
+
+    def save_pillars(self, uid, lesson_id, pillars, base_version=None):
+        """Write several pillars ({pillar key: {versions, currentIndex}}) in one commit."""
+        unknown = [key for key in pillars if key not in PILLAR_KEYS]
+        if unknown:
+            raise ValueError(f"Unknown pillars: {', '.join(unknown)}")
+        return self.update(
+            uid, lesson_id, {f'pillars.{key}': value for key, value in pillars.items()}, base_version=base_version
+        )
+
+    def patch(self, uid, lesson_id, ops, base_version=None):
+        """Apply patch ops to a lesson in one commit and return its new version.
+
+        Each op is {"op": "set" | "append", "path": dotted field path, "value": ...}.
+        "set" replaces the value at path; "append" adds value to the end of the array at path.
+        One pillar version is replaced with a set on pillars.<pillar>.versions.<index>.
+        """
+        append_paths = _check_ops(ops)
+        field_ops = [op for op in ops if not op['path'].startswith('pillars')]
+        pillar_changes = []
+        for op in ops:
+            if op['path'].startswith('pillars'):
+                pillar_changes.extend(_pillar_changes(op['path'], op['value'], append=op['op'] == 'append'))
+
+        def build_fields(snapshot):
+            fields = {}
+            for op in field_ops:
+                path, value = op['path'], op['value']
+                if op['op'] == 'set':
+                    fields[path] = value
+                    continue
+                current = fields[path] if path in fields else _field(snapshot, path, [])
+                if not isinstance(current, list):
+                    raise ValueError(f"Cannot append to non-array field: {path}")
+                fields[path] = current + [value]
+            return fields
+
+        return self._write(
+            uid, lesson_id, build_fields, _group_pillar_changes(pillar_changes),
+            read_paths=append_paths, base_version=base_version
+        )
+
+    def delete(self, uid, lesson_id):
+        """Delete a lesson owned by uid together with its version chunks and index entry."""
+        def stage(batch, doc_ref, snapshot, version, option):
+            batch.delete(doc_ref, option=option)
+            for key, stored in _field(snapshot, 'pillars', {}).items():
+                if isinstance((stored or {}).get('versions'), list):
+                    continue
+                for chunk in range(_chunk_count(_pillar_state(stored)[0])):
+                    batch.delete(self._chunk(doc_ref, f'{key}-{chunk}'))
+            batch.delete(self._index_entry(uid, lesson_id))
+
+        self._commit_checked(uid, lesson_id, stage, read_paths=['pillars'])
@@ -0,0 +1,190 @@
+"""Content-addressed response cache for LLM completions.
+
+Entries are keyed on a hash of everything that determines the model output
+(model, final system prompt, user message and response_format), so two
+teachers sending the same lesson topic with the same modifiers share a single
+OpenAI call.
+
+Two backends are available:
+- MemoryCacheBackend: per-process LRU dictionary, fastest, lost on restart
+- SQLiteCacheBackend: a local database file shared by every gunicorn worker
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# The on-disk cache outlives restarts and is shared by every worker, so it keeps more than one process's LRU
+SQLITE_MAX_ENTRIES = 5000
+
+
+def make_cache_key(model, system_prompt, user_message, response_format=None):
+    """Return a stable SHA-256 hex digest for a completion request."""
+    payload = json.dumps({
+        "model": model,
+        "system": system_prompt,
+        "user": user_message,
+        "response_format": response_format
+    }, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class MemoryCacheBackend:
+    """In-process LRU cache with per-entry expiry."""
+
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.time() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+class SQLiteCacheBackend:
+    """On-disk LRU cache that can be shared by several worker processes."""
+
+    def __init__(self, path, max_entries=SQLITE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_last_access ON llm_cache (last_access)")
+
+    def _connect(self):
+        # A short-lived connection per call keeps this safe across threads and forks
+        return sqlite3.connect(self.path, timeout=5)
+
+    def get(self, key):
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT value, expires_at FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, expires_at = row
+            if expires_at < now:
+                conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                return None
+            conn.execute("UPDATE llm_cache SET last_access = ? WHERE key = ?", (now, key))
+            return value
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, expires_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, value, now + ttl, now)
+            )
+            conn.execute("DELETE FROM llm_cache WHERE expires_at < ?", (now,))
+            conn.execute("""
+                DELETE FROM llm_cache WHERE key IN (
+                    SELECT key FROM llm_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?
+                )
+            """, (self.max_entries,))
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM llm_cache")
+
+    def __len__(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+
+
+class ResponseCache:
+    """Cache front-end that applies the TTL and keeps hit/miss counters."""
+
+    def __init__(self, backend, ttl=3600):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        try:
+            value = self.backend.get(key)
+        except Exception as e:
+            # A broken cache must never take a generation down with it
+            print(f"Error reading response cache: {e}")
+            value = None
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value):
+        try:
+            self.backend.set(key, value, self.ttl)
+        except Exception as e:
+            print(f"Error writing response cache: {e}")
+
+    def stats(self):
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {
+            "backend": type(self.backend).__name__,
+            "entries": len(self.backend),
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / total, 4) if total else 0.0
+        }
+
+
+def create_response_cache():
+    """Build the response cache described by the LLM_CACHE_* environment variables.
+
+    LLM_CACHE_BACKEND is 'memory' (default), 'sqlite' or 'none'. LLM_CACHE_MAX_ENTRIES bounds the
+    in-memory LRU and LLM_CACHE_SQLITE_MAX_ENTRIES the SQLite database.
+    """
+    backend_name = os.getenv('LLM_CACHE_BACKEND', 'memory').lower()
+    ttl = int(os.getenv('LLM_CACHE_TTL', 3600))
+
+    if backend_name == 'none':
+        return None
+    if backend_name == 'sqlite':
+        path = os.getenv('LLM_CACHE_PATH', 'llm_cache.sqlite3')
+        max_entries = int(os.getenv('LLM_CACHE_SQLITE_MAX_ENTRIES', SQLITE_MAX_ENTRIES))
+        return ResponseCache(SQLiteCacheBackend(path, max_entries=max_entries), ttl=ttl)
+    max_entries = int(os.getenv('LLM_CACHE_MAX_ENTRIES', 512))
+    return ResponseCache(MemoryCacheBackend(max_entries=max_entries), ttl=ttl)
@@ -0,0 +1,421 @@
+"""Bounded concurrency, rate limiting and retries for upstream OpenAI calls.
+
+Every completion goes through one RequestScheduler, shared by the Flask
+worker threads and the async routes:
+
+- at most max_concurrency requests are in flight; the rest wait in a priority
+  queue, so interactive calls (inline generation, chat) are started before
+  normal ones (lesson generation) and background ones (related tags)
+- token buckets keep us under the requests/min and tokens/min limits of the
+  OpenAI account instead of finding them through 429s; token use is estimated
+  before the call and corrected with the usage the API reports
+- 429, 5xx and connection errors are retried with jittered exponential
+  backoff, honouring Retry-After; a 429 with Retry-After pauses every caller
+
+Streams hold their slot until the stream is consumed or closed. A stream is
+only retried if it fails before the first chunk.
+
+An optional observer (see instrumentation.UpstreamMetrics) is told about
+every completed call with its queue time, time to first token, upstream time
+and reported usage, about every failed attempt (including streams that fail
+part way) and about calls cancelled before they completed, such as streams
+closed early because the client went away.
+"""
+import asyncio
+import heapq
+import itertools
+import os
+import random
+import socket
+import threading
+import time
+import weakref
+
+import openai
+
+from chat_history import message_tokens
+
+# Lower runs first
+PRIORITIES = {'interactive': 0, 'normal': 1, 'background': 2}
+# Completion tokens assumed when reserving tokens/min; corrected from usage afterwards
+DEFAULT_COMPLETION_TOKENS = 1000
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError)
+
+
+def estimate_tokens(messages, completion_tokens=DEFAULT_COMPLETION_TOKENS):
+    """Rough prompt + completion token count for a chat request."""
+    return sum(message_tokens(message) for message in messages) + completion_tokens
+
+
+def _retry_after(error):
+    """Seconds the API asked us to wait, if it said so."""
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    try:
+        if 'retry-after-ms' in response.headers:
+            return float(response.headers['retry-after-ms']) / 1000
+        if 'retry-after' in response.headers:
+            return float(response.headers['retry-after'])
+    except ValueError:
+        pass
+    return None
+
+
+class TokenBucket:
+    """Refills at rate_per_minute and holds at most one minute's worth."""
+
+    def __init__(self, rate_per_minute, now):
+        self.capacity = float(rate_per_minute)
+        self.rate = rate_per_minute / 60.0
+        self.level = self.capacity
+        self.updated = now
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount, now):
+        """Take amount (the level may go negative) and return the seconds until it is paid back."""
+        self._refill(now)
+        # A request larger than the bucket waits for a full bucket rather than forever
+        self.level -= min(amount, self.capacity)
+        return max(0.0, -self.level / self.rate)
+
+    def refund(self, amount, now):
+        """Give back (or, with a negative amount, take) tokens after the real usage is known."""
+        self._refill(now)
+        self.level = min(self.capacity, self.level + amount)
+
+
+class _Waiter:
+    __slots__ = ('priority', 'granted', 'cancelled', 'notify')
+
+    def __init__(self, priority, notify):
+        self.priority = priority
+        self.granted = False
+        self.cancelled = False
+        self.notify = notify
+
+
+class RequestScheduler:
+    """Run upstream calls within a concurrency limit, rate limits and a retry policy.
+
+    A limit of 0 or None for requests_per_minute / tokens_per_minute disables that bucket.
+    """
+
+    def __init__(self, max_concurrency=32, requests_per_minute=None, tokens_per_minute=None,
+                 max_retries=4, base_delay=0.5, max_delay=20.0, clock=time.monotonic, rng=random.random,
+                 observer=None):
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._clock = clock
+        self._rng = rng
+        self._observer = observer
+        now = clock()
+        self._requests = TokenBucket(requests_per_minute, now) if requests_per_minute else None
+        self._tokens = TokenBucket(tokens_per_minute, now) if tokens_per_minute else None
+        self._paused_until = now
+        # Streams stopped by interrupt(); their read errors are counted as cancellations
+        self._interrupted = weakref.WeakSet()
+        self._lock = threading.Lock()
+        self._active = 0
+        # (priority rank, arrival order, waiter)
+        self._queue = []
+        self._order = itertools.count()
+
+        self.requests = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.failures = 0
+        self.throttle_seconds = 0.0
+        self._waits = {priority: [0, 0.0, 0.0] for priority in PRIORITIES}  # count, total, max
+
+    # Admission
+
+    def _enter(self, waiter):
+        """Take a free slot (True) or queue the waiter to be notified when one is handed to it (False)."""
+        with self._lock:
+            if self._active < self.max_concurrency and not self._queue:
+                self._active += 1
+                return True
+            heapq.heappush(self._queue, (PRIORITIES[waiter.priority], next(self._order), waiter))
+            return False
+
+    def _leave(self):
+        """Hand the slot to the first waiter in priority order, or free it."""
+        with self._lock:
+            while self._queue:
+                waiter = heapq.heappop(self._queue)[2]
+                if not waiter.cancelled:
+                    waiter.granted = True
+                    break
+            else:
+                self._active -= 1
+                return
+        waiter.notify()
+
+    def _record_wait(self, priority, waited):
+        with self._lock:
+            stats = self._waits[priority]
+            stats[0] += 1
+            stats[1] += waited
+            stats[2] = max(stats[2], waited)
+
+    def _acquire(self, priority):
+        started = self._clock()
+        granted = threading.Event()
+        if not self._enter(_Waiter(priority, granted.set)):
+            granted.wait()
+        self._record_wait(priority, self._clock() - started)
+
+    async def _aacquire(self, priority):
+        started = self._clock()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def grant():
+            if not future.done():
+                future.set_result(None)
+
+        waiter = _Waiter(priority, lambda: loop.call_soon_threadsafe(grant))
+        if not self._enter(waiter):
+            try:
+                await future
+            except asyncio.CancelledError:
+                with self._lock:
+                    waiter.cancelled = True
+                    granted = waiter.granted
+                if granted:
+                    # The slot arrived just as the caller went away; pass it on
+                    self._leave()
+                raise
+        self._record_wait(priority, self._clock() - started)
+
+    # Rate limits and retries
+
+    def _rate_delay(self, tokens):
+        """Reserve one request and tokens; return how long to wait before sending."""
+        with self._lock:
+            now = self._clock()
+            delay = max(0.0, self._paused_until - now)
+            if self._requests is not None:
+                delay = max(delay, self._requests.reserve(1, now))
+            if self._tokens is not None and tokens:
+                delay = max(delay, self._tokens.reserve(tokens, now))
+            self.requests += 1
+            self.throttle_seconds += delay
+        return delay
+
+    def _settle(self, tokens, response):
+        """Correct the tokens/min reservation with the usage the API reported."""
+        usage = getattr(response, 'usage', None)
+        if self._tokens is None or not tokens or usage is None or not getattr(usage, 'total_tokens', None):
+            return
+        with self._lock:
+            self._tokens.refund(tokens - usage.total_tokens, self._clock())
+
+    def _retry_delay(self, attempt, error, priority):
+        """Count a failed attempt and return the backoff before the next one, or None to give up."""
+        retry_after = _retry_after(error)
+        with self._lock:
+            if isinstance(error, openai.RateLimitError):
+                self.rate_limited += 1
+                if retry_after:
+                    # The limit is per account, so everyone waits
+                    self._paused_until = max(self._paused_until, self._clock() + retry_after)
+            give_up = attempt >= self.max_retries
+            if give_up:
+                self.failures += 1
+            else:
+                self.retries += 1
+        if self._observer is not None:
+            self._observer.error(priority, error, retrying=not give_up)
+        if give_up:
+            return None
+        # Full jitter keeps retries from a burst from arriving together
+        delay = self._rng() * min(self.max_delay, self.base_delay * 2 ** attempt)
+        return max(delay, retry_after or 0.0)
+
+    def _failed(self, priority, error, cancelled=False):
+        """Count a call that ended without completing, outside the retry path."""
+        if isinstance(error, Exception) and not cancelled:
+            with self._lock:
+                self.failures += 1
+            if self._observer is not None:
+                self._observer.error(priority, error, retrying=False)
+        elif self._observer is not None:
+            # GeneratorExit from closing a stream early, or asyncio cancellation
+            self._observer.cancelled(priority)
+
+    def _start(self, request, priority, tokens):
+        """Run request() with retries; on success return (result, queue seconds, send time) with the slot still held."""
+        started = self._clock()
+        for attempt in itertools.count():
+            self._acquire(priority)
+            try:
+                delay = self._rate_delay(tokens)
+                if delay:
+                    time.sleep(delay)
+                sent = self._clock()
+                return request(), sent - started, sent
+            except RETRYABLE_ERRORS as e:
+                self._leave()
+                backoff = self._retry_delay(attempt, e, priority)
+                if backoff is None:
+                    raise
+            except BaseException as e:
+                self._leave()
+                self._failed(priority, e)
+                raise
+            time.sleep(backoff)
+
+    async def _astart(self, request, priority, tokens):
+        started = self._clock()
+        for attempt in itertools.count():
+            await self._aacquire(priority)
+            try:
+                delay = self._rate_delay(tokens)
+                if delay:
+                    await asyncio.sleep(delay)
+                sent = self._clock()
+                return await request(), sent - started, sent
+            except RETRYABLE_ERRORS as e:
+                self._leave()
+                backoff = self._retry_delay(attempt, e, priority)
+                if backoff is None:
+                    raise
+            except BaseException as e:
+                self._leave()
+                self._failed(priority, e)
+                raise
+            await asyncio.sleep(backoff)
+
+    def _observe(self, priority, queued, sent, first_token, response, stream):
+        if self._observer is not None:
+            self._observer.upstream(priority, queued, first_token, self._clock() - sent, response, stream)
+
+    # Public API
+
+    def call(self, request, priority='normal', tokens=0):
+        """Run request(), one blocking upstream call, and return its result.
+
+        tokens is the estimated prompt + completion size (see estimate_tokens).
+        """
+        response, queued, sent = self._start(request, priority, tokens)
+        self._leave()
+        self._settle(tokens, response)
+        self._observe(priority, queued, sent, None, response, stream=False)
+        return response
+
+    async def acall(self, request, priority='normal', tokens=0):
+        """Async call(): request is a coroutine function."""
+        response, queued, sent = await self._astart(request, priority, tokens)
+        self._leave()
+        self._settle(tokens, response)
+        self._observe(priority, queued, sent, None, response, stream=False)
+        return response
+
+    def stream(self, request, priority='normal', tokens=0):
+        """Yield the chunks of request(), a stream=True call, holding a slot until the stream ends or is closed.
+
+        Usage is only known for streams requested with stream_options={"include_usage": True}.
+        The call is observed as completed only once the stream has been read to the end.
+        """
+        response, queued, sent = self._start(request, priority, tokens)
+        first_token = last = None
+        try:
+            for chunk in response:
+                if first_token is None:
+                    first_token = self._clock() - sent
+                last = chunk
+                yield chunk
+        except BaseException as e:
+            self._failed(priority, e, cancelled=response in self._interrupted)
+            raise
+        finally:
+            self._leave()
+            if hasattr(response, 'close'):
+                response.close()
+            self._settle(tokens, last)
+        self._observe(priority, queued, sent, first_token, last, stream=True)
+
+    async def astream(self, request, priority='normal', tokens=0):
+        """Async stream(): request is a coroutine function returning an async stream."""
+        response, queued, sent = await self._astart(request, priority, tokens)
+        first_token = last = None
+        try:
+            async for chunk in response:
+                if first_token is None:
+                    first_token = self._clock() - sent
+                last = chunk
+                yield chunk
+        except BaseException as e:
+            self._failed(priority, e)
+            raise
+        finally:
+            self._leave()
+            if hasattr(response, 'close'):
+                await response.close()
+            self._settle(tokens, last)
+        self._observe(priority, queued, sent, first_token, last, stream=True)
+
+    def interrupt(self, response):
+        """Stop a blocking read of response, an OpenAI stream being read by stream() in another thread.
+
+        Closing a stream from another thread does not wake a read that is waiting for the next
+        chunk, so a stalled model would keep the call open (and billed) until it sends one.
+        Shutting the connection's socket down makes the read fail at once, and the stream is
+        counted as cancelled.
+        """
+        self._interrupted.add(response)
+        http_response = getattr(response, 'response', None)
+        network_stream = http_response.extensions.get('network_stream') if http_response is not None else None
+        sock = network_stream.get_extra_info('socket') if network_stream is not None else None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                # Already closed
+                pass
+
+    def stats(self):
+        with self._lock:
+            queued = {priority: 0 for priority in PRIORITIES}
+            for _, _, waiter in self._queue:
+                if not waiter.cancelled:
+                    queued[waiter.priority] += 1
+            return {
+                "max_concurrency": self.max_concurrency,
+                "active": self._active,
+                "queued": queued,
+                "requests": self.requests,
+                "retries": self.retries,
+                "rate_limited": self.rate_limited,
+                "failures": self.failures,
+                "throttle_seconds": round(self.throttle_seconds, 3),
+                "wait_seconds": {
+                    priority: {
+                        "count": count,
+                        "avg": round(total / count, 4) if count else 0.0,
+                        "max": round(longest, 4)
+                    }
+                    for priority, (count, total, longest) in self._waits.items()
+                }
+            }
+
+
+def create_scheduler(observer=None):
+    """Build the RequestScheduler described by the LLM_* environment variables.
+
+    The rate limit defaults match OpenAI's first usage tier for gpt-4o-mini.
+    """
+    return RequestScheduler(
+        max_concurrency=int(os.getenv('LLM_MAX_CONCURRENCY', 32)),
+        requests_per_minute=int(os.getenv('LLM_REQUESTS_PER_MINUTE', 500)),
+        tokens_per_minute=int(os.getenv('LLM_TOKENS_PER_MINUTE', 200000)),
+        max_retries=int(os.getenv('LLM_MAX_RETRIES', 4)),
+        observer=observer
+    )
@@ -0,0 +1,336 @@
+"""Single-flight deduplication of identical in-flight upstream calls.
+
+During workshops many teachers click the same helper tag at the same moment.
+The response cache only helps once the first answer is back; until then every
+click used to start its own OpenAI call. With SingleFlight, the first request
+for a key (the hash of the final assembled prompt) makes the call and every
+identical request that arrives while it is in flight waits for that call and
+gets the same result, or the same error.
+
+Streams are fanned out: all subscribers get every chunk, and a subscriber
+that joins late first gets the chunks already received. The upstream stream
+is only abandoned when its last subscriber goes away. A subscriber whose
+reader is stuck on a stalled upstream can leave() first; once every
+subscriber has left, the upstream handle attached to the stream is
+interrupted.
+
+Blocking callers (Flask worker threads) use do() and stream(); coroutines use
+ado() and astream().
+"""
+import asyncio
+import threading
+
+_PUMP = object()
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _Stream:
+    def __init__(self, factory, interrupt):
+        self.factory = factory
+        self.interrupt = interrupt
+        self.upstream = None
+        self.iterator = None
+        self.items = []
+        self.done = False
+        self.error = None
+        self.pumping = False
+        self.subscribers = 0
+        # Subscribers that left() but whose reader has not let go of the stream yet
+        self.left = 0
+        self.cond = threading.Condition()
+
+
+class _Subscription:
+    """One caller's iterator over a shared stream, returned by SingleFlight.stream()."""
+
+    def __init__(self, group, key, factory, interrupt):
+        self._group = group
+        self.flight = None
+        self.left = False
+        self._items = group._subscribe(self, key, factory, interrupt)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._items)
+
+    def close(self):
+        self._items.close()
+
+    def leave(self):
+        """Give up on the stream while another thread may still be blocked reading it.
+
+        If every subscriber has now left, the stream's attached upstream is interrupted.
+        """
+        self._group._leave(self)
+
+
+class _AsyncCall:
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class _AsyncStream:
+    def __init__(self):
+        self.items = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.task = None
+        self.cond = asyncio.Condition()
+
+
+class SingleFlight:
+    """Share one execution of identical concurrent calls, keyed by the caller."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._streams = {}
+        self._async_calls = {}
+        self._async_streams = {}
+        # Calls that went upstream, and calls that joined one already in flight
+        self.leaders = 0
+        self.followers = 0
+
+    def _join(self, flights, key, create):
+        with self._lock:
+            flight = flights.get(key)
+            if flight is None:
+                flight = flights[key] = create()
+                self.leaders += 1
+            else:
+                self.followers += 1
+            return flight
+
+    def _retire(self, flights, key, flight):
+        with self._lock:
+            if flights.get(key) is flight:
+                del flights[key]
+
+    # Blocking callers
+
+    def do(self, key, fn):
+        """Return fn(), or the result of the identical call already in flight."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+            else:
+                self.followers += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            self._retire(self._calls, key, call)
+            call.done.set()
+
+    def stream(self, key, factory, interrupt=None):
+        """Return an iterator over the items of factory(), sharing one iteration with identical concurrent streams.
+
+        Whichever subscriber needs the next item first reads it from the upstream
+        iterator, so the stream keeps going as long as anyone is listening.
+        interrupt(upstream) is called with the handle given to attach() once every
+        subscriber has called leave() on its iterator.
+        """
+        return _Subscription(self, key, factory, interrupt)
+
+    def _subscribe(self, subscription, key, factory, interrupt):
+        flight = self._join(self._streams, key, lambda: _Stream(factory, interrupt))
+        with self._lock:
+            flight.subscribers += 1
+            subscription.flight = flight
+            if subscription.left:
+                # Left before its reader got here
+                flight.left += 1
+            upstream = self._abandoned_upstream(flight)
+        self._interrupt(flight, upstream)
+        index = 0
+        try:
+            while True:
+                with flight.cond:
+                    while index >= len(flight.items) and not flight.done and flight.pumping:
+                        flight.cond.wait()
+                    if index < len(flight.items):
+                        item = flight.items[index]
+                        index += 1
+                    elif flight.done:
+                        if flight.error is not None:
+                            raise flight.error
+                        return
+                    else:
+                        flight.pumping = True
+                        item = _PUMP
+                if item is _PUMP:
+                    self._pump(key, flight)
+                else:
+                    yield item
+        finally:
+            self._unsubscribe(key, flight, subscription)
+
+    def attach(self, key, upstream):
+        """Keep upstream (e.g. the OpenAI stream) with key's in-flight stream, for interrupt.
+
+        Called from the factory once the upstream call is made. If every subscriber left
+        while the call was still waiting to be made, it is interrupted right away.
+        """
+        with self._lock:
+            flight = self._streams.get(key)
+            if flight is None:
+                return
+            flight.upstream = upstream
+            upstream = self._abandoned_upstream(flight)
+        self._interrupt(flight, upstream)
+
+    def _leave(self, subscription):
+        with self._lock:
+            if subscription.left:
+                return
+            subscription.left = True
+            flight = subscription.flight
+            if flight is None:
+                return
+            flight.left += 1
+            upstream = self._abandoned_upstream(flight)
+        self._interrupt(flight, upstream)
+
+    def _abandoned_upstream(self, flight):
+        # The attached upstream once every subscriber has left; called with self._lock held
+        if flight.left >= flight.subscribers and not flight.done:
+            return flight.upstream
+        return None
+
+    def _interrupt(self, flight, upstream):
+        if upstream is not None and flight.interrupt is not None:
+            flight.interrupt(upstream)
+
+    def _pump(self, key, flight):
+        """Read the next upstream item into the shared buffer."""
+        finished, error = False, None
+        try:
+            if flight.iterator is None:
+                flight.iterator = iter(flight.factory())
+            item = next(flight.iterator)
+        except StopIteration:
+            finished = True
+        except Exception as e:
+            finished, error = True, e
+        with flight.cond:
+            if finished:
+                flight.done, flight.error = True, error
+            else:
+                flight.items.append(item)
+            flight.pumping = False
+            flight.cond.notify_all()
+        if finished:
+            self._retire(self._streams, key, flight)
+
+    def _unsubscribe(self, key, flight, subscription):
+        with self._lock:
+            flight.subscribers -= 1
+            if subscription.left:
+                flight.left -= 1
+            abandoned = flight.subscribers == 0 and not flight.done
+            if abandoned:
+                flight.done = True
+                if self._streams.get(key) is flight:
+                    del self._streams[key]
+        if abandoned and hasattr(flight.iterator, 'close'):
+            # Nobody is listening any more: stop the upstream stream
+            flight.iterator.close()
+
+    # Coroutines
+
+    async def ado(self, key, factory):
+        """Await factory(), a coroutine function, or the identical call already in flight.
+
+        The call runs as its own task, so one caller going away does not cancel it for
+        the others; it is cancelled when every caller has gone.
+        """
+        def create():
+            task = asyncio.ensure_future(factory())
+            task.add_done_callback(lambda _: self._retire(self._async_calls, key, flight))
+            return _AsyncCall(task)
+
+        flight = self._join(self._async_calls, key, create)
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                flight.task.cancel()
+                self._retire(self._async_calls, key, flight)
+
+    async def astream(self, key, factory):
+        """Async stream(): factory returns an async iterator, read by a task shared by all subscribers."""
+        flight = self._join(self._async_streams, key, _AsyncStream)
+        if flight.task is None:
+            flight.task = asyncio.ensure_future(self._apump(key, flight, factory))
+        flight.subscribers += 1
+        index = 0
+        try:
+            while True:
+                async with flight.cond:
+                    await flight.cond.wait_for(lambda: index < len(flight.items) or flight.done)
+                    items = flight.items[index:]
+                    done, error = flight.done, flight.error
+                index += len(items)
+                for item in items:
+                    yield item
+                if done and index == len(flight.items):
+                    if error is not None:
+                        raise error
+                    return
+        finally:
+            flight.subscribers -= 1
+            if flight.subscribers == 0 and not flight.done:
+                flight.task.cancel()
+                self._retire(self._async_streams, key, flight)
+
+    async def _apump(self, key, flight, factory):
+        iterator = factory()
+        try:
+            async for item in iterator:
+                async with flight.cond:
+                    flight.items.append(item)
+                    flight.cond.notify_all()
+        except Exception as e:
+            flight.error = e
+        finally:
+            if hasattr(iterator, 'aclose'):
+                await iterator.aclose()
+            self._retire(self._async_streams, key, flight)
+            flight.done = True
+            async with flight.cond:
+                flight.cond.notify_all()
+
+    def stats(self):
+        with self._lock:
+            total = self.leaders + self.followers
+            return {
+                "in_flight": len(self._calls) + len(self._streams) + len(self._async_calls) + len(self._async_streams),
+                "upstream_calls": self.leaders,
+                "coalesced": self.followers,
+                "coalesced_rate": round(self.followers / total, 4) if total else 0.0
+            }
@@ -25,35 +25,79 @@ document.addEventListener('DOMContentLoaded', () => {
     }
 });
 
+const LESSONS_PAGE_SIZE = 24;
+
+// Loads the first page of lessons, then the next page whenever the end of the grid scrolls into view
 async function loadLessons(user) {
     const lessonsGrid = document.getElementById('lessons-grid');
     if (!lessonsGrid) return;
 
-    try {
-        const idToken = await user.getIdToken();
-        const response = await fetch('/get_lessons', {
-            headers: {
-                'Authorization': `Bearer ${idToken}`
-            }
-        });
+    let nextCursor = null;
+    let loading = false;
+    let firstPage = true;
 
-        const result = await response.json();
+    // Invisible marker after the grid; reaching it triggers the next page
+    const sentinel = document.createElement('div');
+    sentinel.className = 'lessons-sentinel';
+    lessonsGrid.after(sentinel);
 
-        if (result.success && result.lessons.length > 0) {
-            lessonsGrid.innerHTML = ''; // Clear placeholder
-            result.lessons.forEach(lesson => {
-                const card = createLessonCard(lesson);
-                lessonsGrid.appendChild(card);
+    const loadPage = async () => {
+        if (loading) return;
+        loading = true;
+        try {
+            const idToken = await user.getIdToken();
+            const params = new URLSearchParams({ limit: LESSONS_PAGE_SIZE });
+            if (nextCursor) params.set('cursor', nextCursor);
+            const response = await fetch(`/get_lessons?${params}`, {
+                headers: {
+                    'Authorization': `Bearer ${idToken}`
+                }
             });
-        } else if (!result.success) {
-            throw new Error(result.error || "Could not fetch lessons.");
+
+            const result = await response.json();
+
+            if (!result.success) {
+                throw new Error(result.error || "Could not fetch lessons.");
+            }
+            if (result.lessons.length > 0) {
+                if (firstPage) {
+                    lessonsGrid.innerHTML = ''; // Clear placeholder
+                }
+                result.lessons.forEach(lesson => {
+                    const card = createLessonCard(lesson);
+                    lessonsGrid.appendChild(card);
+                });
+            }
+            // If there are no lessons, the placeholder will remain.
+            firstPage = false;
+            nextCursor = result.nextCursor;
+            if (nextCursor) {
+                // Re-observing reports the sentinel again, so a short page that leaves it in view loads the next one
+                observer.unobserve(sentinel);
+                observer.observe(sentinel);
+            } else {
+                observer.disconnect();
+                sentinel.remove();
+            }
+
+        } catch (error) {
+            console.error("Error loading lessons:", error);
+            observer.disconnect();
+            if (firstPage) {
+                lessonsGrid.innerHTML = '<p style="color: #ff8a80;">Error loading lessons. Please try again.</p>';
+            }
+        } finally {
+            loading = false;
         }
-        // If there are no lessons, the placeholder will remain.
+    };
 
-    } catch (error) {
-        console.error("Error loading lessons:", error);
-        lessonsGrid.innerHTML = '<p style="color: #ff8a80;">Error loading lessons. Please try again.</p>';
-    }
+    const observer = new IntersectionObserver(entries => {
+        if (entries.some(entry => entry.isIntersecting)) {
+            loadPage();
+        }
+    }, { rootMargin: '400px' });
+
+    await loadPage();
 }
 
 function createLessonCard(lesson) {
@@ -68,6 +112,9 @@ function createLessonCard(lesson) {
     `;
     card.querySelector('h3').textContent = lesson.title;
     card.querySelector('p').textContent = `Last modified: ${lesson.lastModified}`;
+    if (lesson.preview) {
+        card.title = lesson.preview;
+    }
 
     card.addEventListener('click', () => {
         window.location.href = `/editor/${lesson.id}`;
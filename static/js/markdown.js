@@ -0,0 +1,143 @@
+// Markdown formatting for generated text, including text that is still streaming in.
+// Loaded after marked and before script.js; benchmarks/render.html loads it on its own.
+
+// Helper function to detect and format content type
+function formatContent(text) {
+    if (!text) return '';
+
+    // Pre-process markdown to fix common issues
+    text = fixMarkdownPatterns(text);
+
+    // Use marked to convert markdown to HTML
+    return marked.parse(text);
+}
+
+// Add a helper function to fix markdown patterns that might be misinterpreted
+function fixMarkdownPatterns(text) {
+    if (!text) return text;
+
+    // Fix indented lists (4+ spaces followed by a dash or asterisk)
+    text = text.replace(/^(\s{4,})([*-])/gm, '  $2');
+
+    // Fix blank lines in lists that cause list restart
+    text = text.replace(/^([*-]\s.+)(\n\n)([*-]\s)/gm, '$1\n$3');
+
+    // Fix mixed list markers
+    text = text.replace(/^([*-]\s.+\n)([*-]\s)/gm, '$1$2');
+
+    // Fix indented text blocks that get interpreted as code blocks
+    text = text.replace(/^(\s{4,})([^*-\s])/gm, '$2');
+
+    // Fix multiple consecutive indented lines
+    text = text.replace(/^\s{4,}(.+)$/gm, '$1');
+
+    return text;
+}
+
+const MARKDOWN_FENCE = /^\s*(```|~~~)/;
+const MARKDOWN_LIST_ITEM = /^\s*([*+-]|\d+[.)])\s/;
+
+// Render streamed markdown into target without re-formatting everything received so far.
+// Text is split into blocks at blank lines (outside code fences, and not between list items).
+// A finished block is formatted once and its nodes are appended; only the open last block is
+// formatted again, at most once per animation frame. finish() renders the whole text once with
+// formatContent, so the final DOM is exactly what a one-shot render would give.
+function createStreamingMarkdownRenderer(target, { format = formatContent, onRender = null } = {}) {
+    let text = '';
+    let committed = 0;        // text before this index is rendered into finished blocks
+    let scanned = 0;          // complete lines before this index have been scanned for block ends
+    let inFence = false;
+    let blankAt = -1;         // start of the blank line that ends the open block, unless the next line continues it
+    let lastLine = '';        // last non-blank line of the open block
+    let tailNodes = [];       // nodes rendered for the open block
+    let frame = null;
+
+    function htmlNodes(html) {
+        const template = document.createElement('template');
+        template.innerHTML = html;
+        return template.content;
+    }
+
+    function commit(end) {
+        const block = text.slice(committed, end);
+        committed = end;
+        if (block.trim()) {
+            const fragment = htmlNodes(format(block));
+            target.insertBefore(fragment, tailNodes[0] || null);
+        }
+    }
+
+    function scan() {
+        let newline;
+        while ((newline = text.indexOf('\n', scanned)) !== -1) {
+            const line = text.slice(scanned, newline);
+            const lineStart = scanned;
+            scanned = newline + 1;
+
+            if (MARKDOWN_FENCE.test(line)) {
+                inFence = !inFence;
+            } else if (inFence) {
+                continue;
+            } else if (!line.trim()) {
+                if (blankAt === -1 && lastLine) blankAt = lineStart;
+                continue;
+            }
+
+            if (blankAt !== -1) {
+                // A blank line between list items (or before an item's indented continuation) keeps the list open
+                const continuesList = MARKDOWN_LIST_ITEM.test(lastLine) && (MARKDOWN_LIST_ITEM.test(line) || /^\s/.test(line));
+                if (!continuesList) commit(blankAt);
+                blankAt = -1;
+            }
+            lastLine = line;
+        }
+    }
+
+    function flush() {
+        if (frame !== null) {
+            cancelAnimationFrame(frame);
+            frame = null;
+        }
+        scan();
+        tailNodes.forEach(node => node.remove());
+        const fragment = htmlNodes(format(text.slice(committed)));
+        tailNodes = Array.from(fragment.childNodes);
+        target.appendChild(fragment);
+        if (onRender) onRender();
+    }
+
+    return {
+        get text() {
+            return text;
+        },
+
+        append(chunk) {
+            text += chunk;
+            if (frame === null) {
+                frame = requestAnimationFrame(() => {
+                    frame = null;
+                    flush();
+                });
+            }
+        },
+
+        flush,
+
+        finish() {
+            if (frame !== null) {
+                cancelAnimationFrame(frame);
+                frame = null;
+            }
+            target.innerHTML = format(text);
+            tailNodes = [];
+            if (onRender) onRender();
+        },
+
+        cancel() {
+            if (frame !== null) {
+                cancelAnimationFrame(frame);
+                frame = null;
+            }
+        }
+    };
+}
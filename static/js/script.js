@@ -31,6 +31,33 @@ let shouldGenerateAfterRecording = false;
 // Add conversation history array
 let conversationHistory = [];
 
+// Server-side chat session, and the context it last received
+let chatConversationId = null;
+let lastSentChatContext = null;
+
+// Version of the saved lesson and the blueprint the server last stored, so saves send only what changed
+let lessonVersion = null;
+let savedLessonBlueprint = null;
+
+// The helper_context sent for a tag of a helper card, built from the card's data.
+// Must stay identical to helper_insight_context() in insight_prefetch.py, so clicks hit prefetched insights.
+function helperInsightContext(recipe) {
+    const overview = recipe.topic_overview || {};
+    const concepts = [
+        ...(overview.key_concepts || []),
+        ...(recipe.teaching_aspects || []).flatMap(aspect => aspect.tags || []),
+        ...(recipe.suggested_resources || []).flatMap(resource => resource.examples || [])
+    ];
+    return JSON.stringify({
+        title: overview.title || 'Context',
+        overview: {
+            description: overview.description || '',
+            concepts
+        },
+        aspects: []
+    }, null, 2);
+}
+
 // Separate tag click handler function
 async function handleTagClick(e) {
     console.log('🏷️ Tag clicked:', e.target.textContent);
@@ -84,7 +111,9 @@ async function handleTagClick(e) {
             },
             body: JSON.stringify({
                 concept: tagText,
-                helper_context: JSON.stringify(helperContext, null, 2)
+                helper_context: parentCard._cardData?.type === 'helper'
+                    ? helperInsightContext(parentCard._cardData.recipe)
+                    : JSON.stringify(helperContext, null, 2)
             })
         });
         
@@ -92,11 +121,8 @@ async function handleTagClick(e) {
         console.log('📥 Received insight response:', result);
         
         if (result.success) {
-            const insightData = typeof result.insight_data === 'string'
-                ? JSON.parse(result.insight_data)
-                : result.insight_data;
-            
-            const insightCard = createInsightCard(insightData);
+            // The server validates the insight against its schema and sends the object itself
+            const insightCard = createInsightCard(result.insight_data);
             loadingCard.replaceWith(insightCard);
             setTimeout(() => insightCard.classList.add('visible'), 100);
         } else {
@@ -145,7 +171,7 @@ async function handleTagExpansion(tag) {
         const result = await response.json();
         
         if (result.success) {
-            const tagsData = typeof result.tags === 'string' ? JSON.parse(result.tags) : result.tags;
+            const tagsData = result.tags;
             const tagsContainer = tag.closest('.helper-tags') || createTagsContainer(tag);
             
             // Create and add new tags with animation
@@ -733,6 +759,8 @@ document.addEventListener('DOMContentLoaded', () => {
     const commandStatus = commandPrompt.querySelector('.command-status');
     let currentCommandRange = null;
     let isGenerating = false;
+    // Aborts the inline generation on Escape or when the modal is closed, which stops it on the server too
+    let inlineAbortController = null;
 
     // Function to extract text before cursor as a fallback
     function extractTextBeforeCursor(element, range) {
@@ -862,7 +890,7 @@ document.addEventListener('DOMContentLoaded', () => {
     // Handle command input
     commandInput.addEventListener('keydown', async (e) => {
         if (e.key === 'Escape') {
-            closeCommandPrompt();
+            cancelInlineGeneration();
             return;
         }
 
@@ -871,8 +899,11 @@ document.addEventListener('DOMContentLoaded', () => {
             const command = commandInput.value.trim();
             if (!command) return;
 
+            let generatedSpan = null;
+            let renderer = null;
             try {
                 isGenerating = true;
+                inlineAbortController = new AbortController();
                 commandStatus.textContent = 'Generating...';
                 commandStatus.classList.add('generating');
 
@@ -903,63 +934,78 @@ document.addEventListener('DOMContentLoaded', () => {
                     headers: {
                         'Content-Type': 'application/json'
                     },
-                    body: JSON.stringify(contextPrompt)
+                    body: JSON.stringify(contextPrompt),
+                    signal: inlineAbortController.signal
                 });
 
-                if (!response.body) {
-                    throw new Error('ReadableStream not supported');
-                }
-
                 // Remove the command marker
                 if (marker) {
                     marker.remove();
                 }
 
                 // Create a new element for the generated content
-                const generatedSpan = document.createElement('span');
+                generatedSpan = document.createElement('span');
                 generatedSpan.className = 'generating-text';
                 currentCommandRange.insertNode(generatedSpan);
 
-                // Set up text streaming
-                const reader = response.body.getReader();
-                const decoder = new TextDecoder();
-                let generatedText = '';
-
-                while (true) {
-                    const {value, done} = await reader.read();
-                    if (done) break;
-                    
-                    const text = decoder.decode(value);
-                    generatedText += text;
-                    
-                    // Use the formatContent function to properly format the text
-                    // This will convert markdown to HTML and handle lists, tables, etc.
-                    generatedSpan.innerHTML = formatContent(generatedText);
+                // Text arrives as 'delta' events; the stream ends with 'done' (token usage) or 'error'.
+                // The renderer formats the markdown incrementally, at most once per frame
+                renderer = createStreamingMarkdownRenderer(generatedSpan);
+                let usage = null;
+                let finished = false;
+                await readServerSentEvents(response, event => {
+                    const payload = JSON.parse(event.data);
+                    if (event.event === 'delta') {
+                        renderer.append(payload.text);
+                    } else if (event.event === 'done') {
+                        finished = true;
+                        usage = payload.usage;
+                    } else if (event.event === 'error') {
+                        throw new Error(payload.error);
+                    }
+                });
+                if (!finished) {
+                    throw new Error('The generation ended early');
+                }
+                if (usage) {
+                    console.log(`Inline generation used ${usage.total_tokens} tokens`);
                 }
 
                 // Finalize generated content
                 generatedSpan.classList.remove('generating-text');
                 
-                // Ensure the content is properly formatted in the DOM
-                // This helps with saving the content later
-                if (generatedSpan.innerHTML !== formatContent(generatedText)) {
-                    generatedSpan.innerHTML = formatContent(generatedText);
-                }
+                // Render the whole text once more so the saved content is exactly formatContent's output
+                renderer.finish();
                 
                 // Clean up
                 closeCommandPrompt();
                 
             } catch (error) {
+                if (generatedSpan) {
+                    // Keep whatever text arrived, as plain content
+                    generatedSpan.classList.remove('generating-text');
+                    if (renderer) renderer.finish();
+                }
+                if (error.name === 'AbortError') return;
                 console.error('Error generating content:', error);
                 commandStatus.textContent = 'Error generating content';
                 commandStatus.classList.remove('generating');
                 setTimeout(closeCommandPrompt, 2000);
             } finally {
                 isGenerating = false;
+                inlineAbortController = null;
             }
         }
     });
 
+    // Stop a running generation (keeping the text received so far) and close the prompt
+    function cancelInlineGeneration() {
+        if (inlineAbortController) {
+            inlineAbortController.abort();
+        }
+        closeCommandPrompt();
+    }
+
     function closeCommandPrompt() {
         commandPrompt.classList.remove('active');
         commandInput.value = '';
@@ -971,6 +1017,9 @@ document.addEventListener('DOMContentLoaded', () => {
         markers.forEach(marker => marker.remove());
     }
 
+    // Closing the modal also stops a running generation
+    closeBtn.addEventListener('click', cancelInlineGeneration);
+
     // Close command prompt when clicking outside
     document.addEventListener('click', (e) => {
         if (!commandPrompt.contains(e.target) && !modalContent.contains(e.target)) {
@@ -1008,7 +1057,7 @@ document.addEventListener('DOMContentLoaded', () => {
             const result = await response.json();
             
             if (result.success) {
-                const tagsData = typeof result.tags === 'string' ? JSON.parse(result.tags) : result.tags;
+                const tagsData = result.tags;
                 
                 // Create tags container if it doesn't exist
                 let tagsContainer = tag.closest('.helper-tags');
@@ -1122,17 +1171,6 @@ function handleCustomization() {
     applyCustomization(customPrompt, section);
 }
 
-// Helper function to detect and format content type
-function formatContent(text) {
-    if (!text) return '';
-    
-    // Pre-process markdown to fix common issues
-    text = fixMarkdownPatterns(text);
-    
-    // Use marked to convert markdown to HTML
-    return marked.parse(text);
-}
-
 // Update the existing formatting functions to use the new formatter
 function formatContentObjectives(objectives) {
     if (Array.isArray(objectives)) {
@@ -1327,53 +1365,109 @@ async function applyCustomization(customPrompt, section) {
         return;
     }
     
-    // Show loading state
+    // Show loading state; streamSectionContent hides it once the section's current stream ends
     showSectionLoading(section);
     
     try {
-        const response = await fetch('/generate', {
+        await streamSectionContent(section, {
+            prompt: document.getElementById('prompt-input').value.trim(),
+            section: section,
+            customization: customPrompt,
+            current_activity: getCurrentActivityState()
+        });
+    } catch (error) {
+        if (error.name === 'AbortError') return;
+        console.error('Error in customization:', error);
+        alert('Error applying customization: ' + error.message);
+    }
+}
+
+// Section streams still running, by section key, so they can be cancelled
+const sectionStreamControllers = {};
+
+function cancelSectionStream(sectionKey) {
+    const controller = sectionStreamControllers[sectionKey];
+    if (controller) {
+        controller.abort();
+    }
+}
+
+// Stop reading upstream tokens for sections nobody will see
+window.addEventListener('pagehide', () => {
+    Object.keys(sectionStreamControllers).forEach(cancelSectionStream);
+});
+
+// Stream a section customization into its container as it is generated, then add it as a new version.
+// A newer request for the same section, or leaving the page, cancels it (rejecting with an AbortError).
+// The section's loading state is cleared when it ends, unless a newer stream for the section took over.
+async function streamSectionContent(section, body) {
+    const sectionMap = {
+        '1': 'content',
+        '2': 'language',
+        '3': 'tasks',
+        '4': 'assessment',
+        '5': 'materials'
+    };
+    const sectionKey = sectionMap[section];
+    const container = document.getElementById(`${sectionKey}-container`);
+
+    cancelSectionStream(sectionKey);
+    const controller = new AbortController();
+    sectionStreamControllers[sectionKey] = controller;
+
+    let target = null;
+    let renderer = null;
+
+    try {
+        const response = await fetch('/generate_section_stream', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json'
             },
-            body: JSON.stringify({ 
-                prompt: document.getElementById('prompt-input').value.trim(),
-                section: section,
-                customization: customPrompt,
-                current_activity: getCurrentActivityState()
-            })
+            body: JSON.stringify(body),
+            signal: controller.signal
         });
-        
-        const result = await response.json();
-        
-        if (result.success) {
-            const sectionMap = {
-                '1': 'content',
-                '2': 'language',
-                '3': 'tasks',
-                '4': 'assessment',
-                '5': 'materials'
-            };
-            
-            const sectionKey = sectionMap[section];
-            
-            // Format the response using our improved formatter
-            const formattedContent = formatContent(result.data);
-            generatedSections[sectionKey].push(formattedContent);
-            
-            // Update the current index to point to the new version
-            currentIndices[sectionKey] = generatedSections[sectionKey].length - 1;
-            
-            // Update the display immediately
-            updateSectionDisplay(sectionKey);
-        } else {
-            throw new Error(result.error || 'Failed to apply customization');
+        if (!response.ok) {
+            const result = await response.json().catch(() => ({}));
+            throw new Error(result.error || `Request failed with status ${response.status}`);
+        }
+
+        let finished = false;
+        await readServerSentEvents(response, event => {
+            const payload = JSON.parse(event.data);
+            if (event.event === 'delta') {
+                if (!renderer) {
+                    container.innerHTML = '<div class="section-content streaming"></div>';
+                    target = container.firstElementChild;
+                    renderer = createStreamingMarkdownRenderer(target);
+                }
+                renderer.append(payload.text);
+            } else if (event.event === 'done') {
+                finished = true;
+            } else if (event.event === 'error') {
+                throw new Error(payload.error);
+            }
+        });
+        if (!finished) {
+            throw new Error('The section stream ended early');
         }
+
+        renderer?.cancel();
+        generatedSections[sectionKey].push(formatContent(renderer ? renderer.text : ''));
+        currentIndices[sectionKey] = generatedSections[sectionKey].length - 1;
+        updateSectionDisplay(sectionKey);
     } catch (error) {
-        console.error('Error in customization:', error);
-        alert('Error applying customization: ' + error.message);
+        renderer?.cancel();
+        // Put back the version that was showing before the partial text, unless a newer stream took over
+        if (target && sectionStreamControllers[sectionKey] === controller) {
+            updateSectionDisplay(sectionKey);
+        }
+        throw error;
     } finally {
-        hideSectionLoading(section);
+        if (sectionStreamControllers[sectionKey] === controller) {
+            delete sectionStreamControllers[sectionKey];
+            hideSectionLoading(section);
+        }
     }
 }
 
@@ -1410,28 +1504,6 @@ function formatCustomResponse(text) {
     return marked.parse(text);
 }
 
-// Add a helper function to fix markdown patterns that might be misinterpreted
-function fixMarkdownPatterns(text) {
-    if (!text) return text;
-    
-    // Fix indented lists (4+ spaces followed by a dash or asterisk)
-    text = text.replace(/^(\s{4,})([*-])/gm, '  $2');
-    
-    // Fix blank lines in lists that cause list restart
-    text = text.replace(/^([*-]\s.+)(\n\n)([*-]\s)/gm, '$1\n$3');
-    
-    // Fix mixed list markers
-    text = text.replace(/^([*-]\s.+\n)([*-]\s)/gm, '$1$2');
-    
-    // Fix indented text blocks that get interpreted as code blocks
-    text = text.replace(/^(\s{4,})([^*-\s])/gm, '$2');
-    
-    // Fix multiple consecutive indented lines
-    text = text.replace(/^\s{4,}(.+)$/gm, '$1');
-    
-    return text;
-}
-
 // Add helper content handling
 function createHelperCard(data) {
     const card = document.createElement('div');
@@ -1673,6 +1745,124 @@ function createLoadingInsightCard(tagText) {
     return card;
 }
 
+// Map top-level keys of the lesson JSON to their pillar and formatter
+const LESSON_PILLARS = {
+    content_objectives: { section: 'content', format: data => formatContentObjectives(data) },
+    language_objectives: { section: 'language', format: data => formatLanguageObjectives(data) },
+    learning_tasks: { section: 'tasks', format: data => formatLearningTasks(data) },
+    assessment_criteria: { section: 'assessment', format: data => formatAssessmentCriteria(data) },
+    text_deep_learning_input: { section: 'materials', format: data => formatTextDeepLearning(data) }
+};
+
+// Read a text/event-stream response and call onEvent({ id, event, data }) for every complete event
+async function readServerSentEvents(response, onEvent) {
+    if (!response.body) {
+        throw new Error('ReadableStream not supported');
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+
+    while (true) {
+        const {value, done} = await reader.read();
+        if (done) break;
+
+        buffer += decoder.decode(value, { stream: true });
+
+        // Events are separated by a blank line
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const rawEvent = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+
+            const message = { id: null, event: 'message', data: '' };
+            const dataLines = [];
+            rawEvent.split('\n').forEach(line => {
+                if (line.startsWith('data:')) {
+                    dataLines.push(line.slice(5).replace(/^ /, ''));
+                } else if (line.startsWith('event:')) {
+                    message.event = line.slice(6).trim();
+                } else if (line.startsWith('id:')) {
+                    message.id = line.slice(3).trim();
+                }
+            });
+            if (dataLines.length === 0) continue; // Comment or heartbeat
+
+            message.data = dataLines.join('\n');
+            onEvent(message);
+        }
+    }
+}
+
+// Show a freshly generated pillar and stop its generating effect
+function displayLessonPillar(key, value) {
+    const pillar = LESSON_PILLARS[key];
+    if (!pillar) return;
+
+    generatedSections[pillar.section] = [pillar.format(value)];
+    currentIndices[pillar.section] = 0;
+    updateSectionDisplay(pillar.section);
+
+    document.getElementById(`${pillar.section}-container`)
+        .closest('.section')?.classList.remove('generating');
+}
+
+// Replace the helper column with a newly generated helper card
+function displayHelperCard(helperData) {
+    const helperCard = createHelperCard(helperData);
+
+    const helperContent = document.querySelector('.helper-content');
+    helperContent.innerHTML = ''; // Clear existing content
+    helperContent.appendChild(helperCard);
+
+    // Trigger animation
+    setTimeout(() => helperCard.classList.add('visible'), 100);
+}
+
+// Generate the main lesson and the helper card through /generate_lesson.
+// Each part succeeds or fails on its own, like the old Promise.allSettled pair.
+async function streamLesson(requestBody) {
+    const headers = {
+        'Content-Type': 'application/json'
+    };
+    // Insight prefetching for the helper card counts against the signed-in teacher's budget
+    if (window.auth?.currentUser) {
+        headers['Authorization'] = `Bearer ${await window.auth.currentUser.getIdToken()}`;
+    }
+    const response = await fetch('/generate_lesson', {
+        method: 'POST',
+        headers,
+        body: JSON.stringify(requestBody)
+    });
+    if (!response.ok) {
+        const result = await response.json().catch(() => ({}));
+        throw new Error(result.error || `Request failed with status ${response.status}`);
+    }
+
+    let finished = false;
+    await readServerSentEvents(response, message => {
+        const payload = JSON.parse(message.data);
+
+        if (message.event === 'pillar') {
+            displayLessonPillar(payload.key, payload.value);
+        } else if (message.event === 'part') {
+            if (!payload.success) {
+                console.error(`Error generating ${payload.part} content:`, payload.error);
+            } else if (payload.part === 'helper') {
+                // Already validated against the helper schema on the server
+                displayHelperCard(payload.data);
+            }
+        } else if (message.event === 'done') {
+            finished = true;
+        }
+    });
+    // A dropped connection ends the body without an error, so only 'done' means every part reported back
+    if (!finished) {
+        throw new Error('The lesson stream ended early');
+    }
+}
+
 // Update generateActivity function
 async function generateActivity() {
     const promptInput = document.getElementById('prompt-input');
@@ -1747,64 +1937,13 @@ async function generateActivity() {
     setTimeout(() => loadingHelperCard.classList.add('visible'), 100);
     
     try {
-        // Make both API calls in parallel
-        const [mainResponse, helperResponse] = await Promise.allSettled([
-            // Main content generation
-            fetch('/generate', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json'
-                },
-                body: JSON.stringify({ 
-                    prompt,
-                    modifiers: currentModifiers,
-                    custom_theme_text: customThemeText // Add custom theme text here
-                })
-            }).then(r => r.json()),
-            
-            // Helper content generation
-            fetch('/generate_helper', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json'
-                },
-                body: JSON.stringify({ prompt })
-            }).then(r => r.json())
-        ]);
-
-        // Handle main content if it succeeded
-        if (mainResponse.status === 'fulfilled' && mainResponse.value.success) {
-            const data = JSON.parse(mainResponse.value.data);
-            generatedSections.content = [formatContentObjectives(data.content_objectives)];
-            generatedSections.language = [formatLanguageObjectives(data.language_objectives)];
-            generatedSections.tasks = [formatLearningTasks(data.learning_tasks)];
-            generatedSections.assessment = [formatAssessmentCriteria(data.assessment_criteria)];
-            generatedSections.materials = [formatTextDeepLearning(data.text_deep_learning_input)];
-            
-            // Reset indices and update displays
-            Object.keys(currentIndices).forEach(section => {
-                currentIndices[section] = 0;
-                updateSectionDisplay(section);
-            });
-        } else if (mainResponse.status === 'rejected' || !mainResponse.value.success) {
-            console.error('Error generating main content:', mainResponse.reason || mainResponse.value.error);
-        }
-
-        // Handle helper content if it succeeded
-        if (helperResponse.status === 'fulfilled' && helperResponse.value.success) {
-            const helperData = JSON.parse(helperResponse.value.helper_data);
-            const helperCard = createHelperCard(helperData);
-            
-            // Add to helper column
-            const helperContent = document.querySelector('.helper-content');
-            helperContent.innerHTML = ''; // Clear existing content
-            helperContent.appendChild(helperCard);
-            
-            // Trigger animation
-            setTimeout(() => helperCard.classList.add('visible'), 100);
-        } else if (helperResponse.status === 'rejected' || !helperResponse.value.success) {
-            console.error('Error generating helper content:', helperResponse.reason || helperResponse.value.error);
-        }
+        // Main lesson and helper card are generated concurrently on the server and
+        // arrive over one connection; pillars and the helper card render as they finish
+        await streamLesson({
+            prompt,
+            modifiers: currentModifiers,
+            custom_theme_text: customThemeText // Add custom theme text here
+        });
 
     } catch (error) {
         console.error('Error in generation:', error);
@@ -1829,15 +1968,6 @@ async function regenerateSection(sectionNumber) {
         return;
     }
     
-    const sectionMap = {
-        '1': 'content',
-        '2': 'language',
-        '3': 'tasks',
-        '4': 'assessment',
-        '5': 'materials'
-    };
-    
-    const sectionKey = sectionMap[sectionNumber];
     const btn = document.querySelector(`[data-section="${sectionNumber}"]`);
     
     // Show loading state
@@ -1845,52 +1975,17 @@ async function regenerateSection(sectionNumber) {
     btn.textContent = '⌛';
     
     try {
-        const response = await fetch('/generate', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({ 
-                prompt,
-                section: sectionNumber,
-                modifiers: currentModifiers
-            })
+        // Section output is free text, streamed into the section and added as a new version
+        await streamSectionContent(sectionNumber, {
+            prompt,
+            section: sectionNumber,
+            modifiers: currentModifiers,
+            fresh: true // A regeneration should never be served from the response cache
         });
-        
-        const result = await response.json();
-        
-        if (result.success) {
-            const data = JSON.parse(result.data);
-            let formattedContent;
-            
-            // Format based on section type
-            switch(sectionNumber) {
-                case '1':
-                    formattedContent = formatContentObjectives(data.content_objectives);
-                    break;
-                case '2':
-                    formattedContent = formatLanguageObjectives(data.language_objectives);
-                    break;
-                case '3':
-                    formattedContent = formatLearningTasks(data.learning_tasks);
-                    break;
-                case '4':
-                    formattedContent = formatAssessmentCriteria(data.assessment_criteria);
-                    break;
-                case '5':
-                    formattedContent = formatTextDeepLearning(data.text_deep_learning_input);
-                    break;
-            }
-            
-            // Add new version to the section's array
-            generatedSections[sectionKey].push(formattedContent);
-            currentIndices[sectionKey] = generatedSections[sectionKey].length - 1;
-            updateSectionDisplay(sectionKey);
-        } else {
-            throw new Error(result.error || 'Failed to regenerate section');
-        }
     } catch (error) {
-        alert('Error regenerating section: ' + error.message);
+        if (error.name !== 'AbortError') {
+            alert('Error regenerating section: ' + error.message);
+        }
     } finally {
         // Reset button state
         btn.disabled = false;
@@ -1899,14 +1994,46 @@ async function regenerateSection(sectionNumber) {
 }
 
 // Change displayed version of a section
-function changePart(section, direction) {
+async function changePart(section, direction) {
     const versions = generatedSections[section];
     if (!versions || versions.length === 0) return;
     
-    currentIndices[section] = (currentIndices[section] + direction + versions.length) % versions.length;
+    // Browsing versions abandons a section that is still streaming in
+    cancelSectionStream(section);
+    const index = (currentIndices[section] + direction + versions.length) % versions.length;
+    currentIndices[section] = index;
+    // A saved lesson arrives with only its current versions; fetch the others on first view
+    if (versions[index] == null && lessonId) {
+        document.getElementById(`${section}-container`).innerHTML = '<p class="empty-message">Loading version…</p>';
+        await loadPillarVersions(section, index);
+        if (currentIndices[section] !== index) return; // Moved on while loading
+    }
     updateSectionDisplay(section);
 }
 
+// Fill in the chunk of stored versions around index, in the editor and in the saved snapshot
+async function loadPillarVersions(section, index) {
+    try {
+        const idToken = await window.auth.currentUser.getIdToken();
+        const response = await fetch(`/lesson_versions/${lessonId}/${section}/${index}`, {
+            headers: {
+                'Authorization': `Bearer ${idToken}`
+            }
+        });
+        const result = await response.json();
+        if (!result.success) {
+            throw new Error(result.error || "Failed to load version.");
+        }
+        const savedVersions = savedLessonBlueprint?.pillars?.[section]?.versions;
+        Object.entries(result.versions).forEach(([position, body]) => {
+            if (generatedSections[section][position] == null) generatedSections[section][position] = body;
+            if (savedVersions && savedVersions[position] == null) savedVersions[position] = body;
+        });
+    } catch (error) {
+        console.error('Error loading version:', section, index, error);
+    }
+}
+
 // Update the display of a section
 function updateSectionDisplay(section) {
     const container = document.getElementById(`${section}-container`);
@@ -2410,7 +2537,7 @@ function initializeModalSelectionHandling(modal) {
             const result = await response.json();
             
             if (result.success) {
-                const tagsData = typeof result.tags === 'string' ? JSON.parse(result.tags) : result.tags;
+                const tagsData = result.tags;
                 
                 // Create tags container if it doesn't exist
                 let tagsContainer = range.endContainer.parentElement.nextElementSibling;
@@ -2587,7 +2714,7 @@ function copyContent() {
 }
 
 // Chatbot functionality
-function addChatMessage(message, isUser = false) {
+function createChatBubble(isUser = false) {
     const messagesContainer = document.getElementById('chatbot-messages');
     const messageDiv = document.createElement('div');
     messageDiv.className = `chat-message ${isUser ? 'user' : ''}`;
@@ -2598,13 +2725,19 @@ function addChatMessage(message, isUser = false) {
     
     const bubble = document.createElement('div');
     bubble.className = 'chat-bubble';
-    // Use formatContent instead of textContent to properly format the message
-    // This will convert markdown to HTML and handle lists, tables, etc.
-    bubble.innerHTML = isUser ? message : formatContent(message);
     
     messageDiv.appendChild(avatar);
     messageDiv.appendChild(bubble);
     messagesContainer.appendChild(messageDiv);
+    return bubble;
+}
+
+function addChatMessage(message, isUser = false) {
+    const messagesContainer = document.getElementById('chatbot-messages');
+    const bubble = createChatBubble(isUser);
+    // Use formatContent instead of textContent to properly format the message
+    // This will convert markdown to HTML and handle lists, tables, etc.
+    bubble.innerHTML = isUser ? message : formatContent(message);
     
     // Add message to conversation history
     conversationHistory.push({
@@ -2616,44 +2749,158 @@ function addChatMessage(message, isUser = false) {
     messagesContainer.scrollTop = messagesContainer.scrollHeight;
 }
 
+// Start a server-side chat session seeded with the local history (minus the pending message)
+async function startChatSession(context) {
+    const response = await fetch('/conversations', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify({
+            context: context,
+            history: conversationHistory.slice(0, -1)
+        })
+    });
+    const result = await response.json();
+    if (!result.success) {
+        throw new Error(result.error || 'Could not start chat session');
+    }
+    chatConversationId = result.conversation_id;
+    lastSentChatContext = context;
+}
+
+// Top-level context fields that changed since the server last saw them
+function changedChatContext(context) {
+    const changes = {};
+    Object.keys(context).forEach(key => {
+        if (JSON.stringify(context[key]) !== JSON.stringify(lastSentChatContext?.[key])) {
+            changes[key] = context[key];
+        }
+    });
+    return changes;
+}
+
+function postChatMessage(body, signal) {
+    return fetch('/chat_stream', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify(body),
+        signal
+    });
+}
+
+// Send a chat message and return the streaming response. With a server-side session only the message
+// and changed context fields are uploaded; if no session can be used, fall back to the stateless full upload.
+async function sendChatMessage(message, context, signal) {
+    try {
+        if (!chatConversationId) {
+            await startChatSession(context);
+        }
+
+        let response = await postChatMessage({
+            message,
+            conversation_id: chatConversationId,
+            context: changedChatContext(context)
+        }, signal);
+
+        if (response.status === 404) {
+            // The session expired on the server: start a new one from the local history and retry
+            await startChatSession(context);
+            response = await postChatMessage({ message, conversation_id: chatConversationId, context: {} }, signal);
+        }
+        if (!response.ok) {
+            throw new Error(`Chat request failed with status ${response.status}`);
+        }
+        return response;
+    } catch (error) {
+        if (error.name === 'AbortError') throw error;
+        console.warn('Chat session unavailable, sending full history instead:', error);
+        chatConversationId = null;
+        return postChatMessage({
+            message,
+            context: context,
+            history: conversationHistory.slice(0, -1)
+        }, signal);
+    }
+}
+
+// Aborts the reply that is still streaming in when the teacher sends another message
+let chatAbortController = null;
+
 async function handleChatSubmit() {
     const input = document.getElementById('chat-input');
     const message = input.value.trim();
     
     if (!message) return;
     
+    if (chatAbortController) {
+        chatAbortController.abort();
+    }
+    const controller = new AbortController();
+    chatAbortController = controller;
+    
     // Get context using the updated getContext function
     const context = getContext();
     
     // Add user message
     addChatMessage(message, true);
+    const userEntry = conversationHistory[conversationHistory.length - 1];
     input.value = '';
     
+    const messagesContainer = document.getElementById('chatbot-messages');
+    const bubble = createChatBubble();
+    bubble.classList.add('streaming');
+    // Formats the reply incrementally as it arrives, at most once per frame
+    const renderer = createStreamingMarkdownRenderer(bubble, {
+        onRender: () => { messagesContainer.scrollTop = messagesContainer.scrollHeight; }
+    });
+    
     try {
-        const response = await fetch('/chat', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({ 
-                message,
-                context: context,
-                history: conversationHistory.slice(0, -1)
-            })
+        const response = await sendChatMessage(message, context, controller.signal);
+        let finished = false;
+        await readServerSentEvents(response, event => {
+            const payload = JSON.parse(event.data);
+            if (event.event === 'delta') {
+                renderer.append(payload.text);
+            } else if (event.event === 'done') {
+                finished = true;
+                if (chatConversationId) {
+                    lastSentChatContext = context;
+                }
+                if (payload.history_tokens?.tokens_saved) {
+                    console.log(`Chat history compacted on the server: ${payload.history_tokens.tokens_saved} tokens saved`);
+                }
+            } else if (event.event === 'error') {
+                throw new Error(payload.error);
+            }
         });
-        
-        const data = await response.json();
-        
-        if (data.success) {
-            addChatMessage(data.message);
-        } else {
-            addChatMessage('Sorry, I encountered an error. Please try again.');
-            conversationHistory.pop();
+        if (!finished) {
+            throw new Error('The chat reply ended early');
         }
+        renderer.finish();
+        conversationHistory.push({ role: "assistant", content: renderer.text });
     } catch (error) {
-        console.error('Chat error:', error);
-        addChatMessage('Sorry, I encountered an error. Please try again.');
-        conversationHistory.pop();
+        renderer.cancel();
+        if (error.name === 'AbortError') {
+            // Superseded by a newer message; the server did not record this turn either
+            conversationHistory.splice(conversationHistory.indexOf(userEntry), 1);
+            if (renderer.text) {
+                renderer.finish();
+                bubble.classList.add('stopped');
+            } else {
+                bubble.parentElement.remove();
+            }
+        } else {
+            console.error('Chat error:', error);
+            bubble.innerHTML = formatContent('Sorry, I encountered an error. Please try again.');
+        }
+    } finally {
+        bubble.classList.remove('streaming');
+        if (chatAbortController === controller) {
+            chatAbortController = null;
+        }
     }
 }
 
@@ -3274,10 +3521,94 @@ function initializeTooltips() {
     }
 }
 
+// The "digital blueprint" of the lesson
+function buildLessonBlueprint() {
+    const pillars = {};
+    Object.keys(generatedSections).forEach(key => {
+        pillars[key] = {
+            versions: generatedSections[key],
+            currentIndex: currentIndices[key]
+        };
+    });
+    return {
+        title: document.getElementById('lesson-title').value || 'Untitled Lesson',
+        pillars,
+        sideCards: Array.from(document.querySelectorAll('.helper-content .helper-card, .tips-overlay .insight-card'))
+            .map(card => card._cardData)
+            .filter(Boolean), // Filter out any cards that failed to have data
+        chatHistory: conversationHistory,
+        chatContext: {
+            // Future: capture settings from the chatbot UI
+            systemPrompt: document.getElementById('system-prompt-input')?.value || "You are a helpful assistant for lesson planning.",
+            temperature: document.getElementById('temperature-slider')?.value || 0.7
+        }
+    };
+}
+
+// Describe what changed between two blueprints as /patch_lesson ops
+function diffLessonBlueprints(saved, current) {
+    const ops = [];
+    const same = (a, b) => JSON.stringify(a) === JSON.stringify(b);
+
+    // Pillar versions not loaded yet are holes (null) on both sides and are left alone;
+    // edited versions are set one by one and new ones appended
+    const diffVersions = (path, before = [], after = []) => {
+        if (after.length < before.length) {
+            ops.push({ op: 'set', path, value: after });
+            return;
+        }
+        before.forEach((item, i) => {
+            if (after[i] != null && !same(item, after[i])) {
+                ops.push({ op: 'set', path: `${path}.${i}`, value: after[i] });
+            }
+        });
+        after.slice(before.length).forEach(value => ops.push({ op: 'append', path, value }));
+    };
+
+    // Arrays that only grew (new chat messages) are sent as appends
+    const diffArray = (path, before = [], after = []) => {
+        if (after.length >= before.length && before.every((item, i) => same(item, after[i]))) {
+            after.slice(before.length).forEach(value => ops.push({ op: 'append', path, value }));
+        } else {
+            ops.push({ op: 'set', path, value: after });
+        }
+    };
+
+    if (saved.title !== current.title) {
+        ops.push({ op: 'set', path: 'title', value: current.title });
+    }
+    Object.entries(current.pillars).forEach(([key, pillar]) => {
+        const savedPillar = saved.pillars?.[key] || {};
+        diffVersions(`pillars.${key}.versions`, savedPillar.versions, pillar.versions);
+        if (savedPillar.currentIndex !== pillar.currentIndex) {
+            ops.push({ op: 'set', path: `pillars.${key}.currentIndex`, value: pillar.currentIndex });
+        }
+    });
+    if (!same(saved.sideCards, current.sideCards)) {
+        ops.push({ op: 'set', path: 'sideCards', value: current.sideCards });
+    }
+    diffArray('chatHistory', saved.chatHistory, current.chatHistory);
+    if (!same(saved.chatContext, current.chatContext)) {
+        ops.push({ op: 'set', path: 'chatContext', value: current.chatContext });
+    }
+    return ops;
+}
+
+async function postLessonRequest(url, idToken, body) {
+    const response = await fetch(url, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+            'Authorization': `Bearer ${idToken}`
+        },
+        body: JSON.stringify(body)
+    });
+    return { status: response.status, result: await response.json() };
+}
+
 // Function to save the lesson
 async function saveLesson() {
     console.log("Saving lesson...");
-    const saveButton = document.getElementById('save-lesson-btn');
 
     try {
         const user = window.auth.currentUser;
@@ -3286,57 +3617,39 @@ async function saveLesson() {
             return;
         }
         const idToken = await user.getIdToken();
-
-        // The "digital blueprint" of the lesson
-        const lessonBlueprint = {
+        const lessonBlueprint = buildLessonBlueprint();
+        const fullSave = (baseVersion) => postLessonRequest('/save_lesson', idToken, {
             lessonId: lessonId || null,
-            title: document.getElementById('lesson-title').value || 'Untitled Lesson',
-            pillars: {
-                content: {
-                    versions: generatedSections.content,
-                    currentIndex: currentIndices.content
-                },
-                language: {
-                    versions: generatedSections.language,
-                    currentIndex: currentIndices.language
-                },
-                tasks: {
-                    versions: generatedSections.tasks,
-                    currentIndex: currentIndices.tasks
-                },
-                assessment: {
-                    versions: generatedSections.assessment,
-                    currentIndex: currentIndices.assessment
-                },
-                materials: {
-                    versions: generatedSections.materials,
-                    currentIndex: currentIndices.materials
-                }
-            },
-            sideCards: Array.from(document.querySelectorAll('.helper-content .helper-card, .tips-overlay .insight-card'))
-                .map(card => card._cardData)
-                .filter(Boolean), // Filter out any cards that failed to have data
-            chatHistory: conversationHistory,
-            chatContext: {
-                // Future: capture settings from the chatbot UI
-                systemPrompt: document.getElementById('system-prompt-input')?.value || "You are a helpful assistant for lesson planning.",
-                temperature: document.getElementById('temperature-slider')?.value || 0.7
-            }
-        };
-
-        const response = await fetch('/save_lesson', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json',
-                'Authorization': `Bearer ${idToken}`
-            },
-            body: JSON.stringify(lessonBlueprint)
+            baseVersion,
+            ...lessonBlueprint
         });
 
-        const result = await response.json();
+        let saved;
+        if (lessonId && savedLessonBlueprint) {
+            // Existing lesson: send only the changed paths
+            const ops = diffLessonBlueprints(savedLessonBlueprint, lessonBlueprint);
+            if (ops.length === 0) {
+                console.log("No changes to save.");
+                alert("Lesson saved!");
+                return;
+            }
+            saved = await postLessonRequest(`/patch_lesson/${lessonId}`, idToken, { baseVersion: lessonVersion, ops });
+            if (saved.status === 409 && saved.result.currentVersion !== undefined) {
+                if (!confirm("This lesson was changed elsewhere since you opened it. Overwrite it with your version?")) {
+                    return;
+                }
+                // Resend just the changes: a full save would overwrite versions this editor never loaded
+                saved = await postLessonRequest(`/patch_lesson/${lessonId}`, idToken, { baseVersion: null, ops });
+            }
+        } else {
+            saved = await fullSave(lessonVersion);
+        }
 
+        const result = saved.result;
         if (result.success) {
-            console.log("Lesson saved successfully:", result.lessonId);
+            console.log("Lesson saved successfully:", result.lessonId, "version", result.version);
+            lessonVersion = result.version;
+            savedLessonBlueprint = JSON.parse(JSON.stringify(lessonBlueprint));
             alert("Lesson saved!");
             // If it was a new lesson, update the current lessonId and URL
             if (!lessonId && result.lessonId) {
@@ -3362,6 +3675,45 @@ function waitForAuth(callback) {
     }
 }
 
+// Fetch some top-level fields of a saved lesson
+async function fetchLessonFields(id, idToken, fields) {
+    const response = await fetch(`/load_lesson/${id}?fields=${fields.join(',')}`, {
+        headers: {
+            'Authorization': `Bearer ${idToken}`
+        }
+    });
+    const result = await response.json();
+    if (!result.success) {
+        throw new Error(result.error || "Failed to load lesson.");
+    }
+    return result.lesson;
+}
+
+// Recreate side cards using their original creation functions
+function renderSideCards(sideCards) {
+    const helperContent = document.querySelector('.helper-content');
+    const tipsOverlay = document.querySelector('.tips-overlay');
+
+    sideCards.forEach(cardInfo => {
+        let cardElement = null;
+        if (cardInfo.type === 'helper') {
+            cardElement = createHelperCard(cardInfo.recipe);
+            if(cardElement) helperContent.appendChild(cardElement);
+        } else if (cardInfo.type === 'insight') {
+            cardElement = createInsightCard(cardInfo.recipe);
+            if(cardElement) tipsOverlay.appendChild(cardElement);
+        } else if (cardInfo.type === 'pillar_copy') {
+            cardElement = createPillarCopyCard(cardInfo.recipe);
+            if(cardElement) helperContent.appendChild(cardElement);
+        }
+
+        if (cardElement) {
+            // Make the card visible with an animation
+            setTimeout(() => cardElement.classList.add('visible'), 100);
+        }
+    });
+}
+
 // Function to load a lesson
 async function loadLesson(id) {
     console.log("Loading lesson:", id);
@@ -3374,86 +3726,73 @@ async function loadLesson(id) {
         }
         const idToken = await user.getIdToken();
 
-        const response = await fetch(`/load_lesson/${id}`, {
-            headers: {
-                'Authorization': `Bearer ${idToken}`
+        // The editor is usable once the title and current pillars are in;
+        // side cards and chat history are requested at the same time and filled in as they arrive
+        const sideCardsRequest = fetchLessonFields(id, idToken, ['sideCards']);
+        const chatHistoryRequest = fetchLessonFields(id, idToken, ['chatHistory']);
+        const lesson = await fetchLessonFields(id, idToken, ['title', 'pillars', 'chatContext']);
+        console.log("Lesson data received:", lesson);
+
+        // 1. Populate Title
+        document.getElementById('lesson-title').value = lesson.title;
+
+        // 2. Populate Pillars: only the current version of each comes with the lesson,
+        // the rest are holes filled by changePart when shown
+        Object.keys(generatedSections).forEach(sectionKey => {
+            const pillar = lesson.pillars[sectionKey] || {};
+            let versions = pillar.versions;
+            if (!versions) {
+                versions = new Array(pillar.versionCount || 0);
+                if (versions.length > 0) versions[pillar.currentIndex] = pillar.current;
             }
+            generatedSections[sectionKey] = versions;
+            currentIndices[sectionKey] = pillar.currentIndex || 0;
+            updateSectionDisplay(sectionKey);
         });
 
-        const result = await response.json();
-
-        if (result.success) {
-            const lesson = result.lesson;
-            console.log("Lesson data received:", lesson);
-
-            // 1. Populate Title
-            document.getElementById('lesson-title').value = lesson.title;
-
-            // 2. Populate Pillars
-            generatedSections.content = lesson.pillars.content.versions;
-            currentIndices.content = lesson.pillars.content.currentIndex;
-
-            generatedSections.language = lesson.pillars.language.versions;
-            currentIndices.language = lesson.pillars.language.currentIndex;
-
-            generatedSections.tasks = lesson.pillars.tasks.versions;
-            currentIndices.tasks = lesson.pillars.tasks.currentIndex;
-
-            generatedSections.assessment = lesson.pillars.assessment.versions;
-            currentIndices.assessment = lesson.pillars.assessment.currentIndex;
-
-            generatedSections.materials = lesson.pillars.materials.versions;
-            currentIndices.materials = lesson.pillars.materials.currentIndex;
-
-            Object.keys(generatedSections).forEach(sectionKey => {
-                updateSectionDisplay(sectionKey);
-            });
-
-            // 3. Recreate Side Cards using their original creation functions
-            const helperContent = document.querySelector('.helper-content');
-            const tipsOverlay = document.querySelector('.tips-overlay');
-            helperContent.innerHTML = ''; // Clear existing left-column cards
-            tipsOverlay.innerHTML = ''; // Clear existing right-column cards
-
-            if (lesson.sideCards) {
-                lesson.sideCards.forEach(cardInfo => {
-                    let cardElement = null;
-                    if (cardInfo.type === 'helper') {
-                        cardElement = createHelperCard(cardInfo.recipe);
-                        if(cardElement) helperContent.appendChild(cardElement);
-                    } else if (cardInfo.type === 'insight') {
-                        cardElement = createInsightCard(cardInfo.recipe);
-                        if(cardElement) tipsOverlay.appendChild(cardElement);
-                    } else if (cardInfo.type === 'pillar_copy') {
-                        cardElement = createPillarCopyCard(cardInfo.recipe);
-                        if(cardElement) helperContent.appendChild(cardElement);
-                    }
-
-                    if (cardElement) {
-                        // Make the card visible with an animation
-                        setTimeout(() => cardElement.classList.add('visible'), 100);
-                    }
-                });
-            }
-
-            // 4. Populate Chat
-            conversationHistory = lesson.chatHistory || [];
-            const messagesContainer = document.getElementById('chatbot-messages');
-            messagesContainer.innerHTML = '';
-            conversationHistory.forEach(msg => addChatMessage(msg.content, msg.role === 'user'));
-            
-            // 5. Populate Chat Context (Bonus)
-            // This part can be expanded to fully restore the settings UI
-            if(lesson.chatContext) {
-                 // For now, just log it
-                 console.log("Restoring chat context:", lesson.chatContext);
-            }
-
-
-        } else {
-            throw new Error(result.error || "Failed to load lesson.");
+        document.querySelector('.helper-content').innerHTML = ''; // Clear existing left-column cards
+        document.querySelector('.tips-overlay').innerHTML = ''; // Clear existing right-column cards
+        conversationHistory = [];
+        chatConversationId = null; // The next message starts a session from the loaded history
+        document.getElementById('chatbot-messages').innerHTML = '';
+
+        // 3. Remember what the server has, so the next save sends only the changes.
+        // Side cards and chat history count as empty until they arrive, so a save in between leaves them alone.
+        lessonVersion = lesson.version || 0;
+        const savedPillars = {};
+        Object.keys(generatedSections).forEach(key => {
+            savedPillars[key] = { versions: generatedSections[key], currentIndex: currentIndices[key] };
+        });
+        savedLessonBlueprint = JSON.parse(JSON.stringify({
+            title: lesson.title,
+            pillars: savedPillars,
+            sideCards: [],
+            chatHistory: [],
+            chatContext: lesson.chatContext
+        }));
+
+        // 4. Populate Chat Context (Bonus)
+        // This part can be expanded to fully restore the settings UI
+        if(lesson.chatContext) {
+             // For now, just log it
+             console.log("Restoring chat context:", lesson.chatContext);
         }
 
+        // 5. Side cards and chat history, whichever arrives first
+        sideCardsRequest.then(({ sideCards = [] }) => {
+            renderSideCards(sideCards);
+            savedLessonBlueprint.sideCards = JSON.parse(JSON.stringify(sideCards));
+        }).catch(error => console.error("Error loading side cards:", error));
+
+        chatHistoryRequest.then(({ chatHistory = [] }) => {
+            // Messages typed while the history was loading stay after it
+            const typed = conversationHistory;
+            conversationHistory = [];
+            document.getElementById('chatbot-messages').innerHTML = '';
+            [...chatHistory, ...typed].forEach(msg => addChatMessage(msg.content, msg.role === 'user'));
+            savedLessonBlueprint.chatHistory = JSON.parse(JSON.stringify(chatHistory));
+        }).catch(error => console.error("Error loading chat history:", error));
+
     } catch (error) {
         console.error("Error loading lesson:", error);
         alert("Could not load lesson: " + error.message);
@@ -0,0 +1,186 @@
+"""Helpers for streaming LLM output to the browser.
+
+- sse_event: frames a payload as a server-sent event
+- sse_comment: an SSE comment line, used as a heartbeat
+- heartbeats / aheartbeats: pass a stream through, yielding None whenever it
+  has been quiet for a while so the caller can send a heartbeat; a heartbeat
+  write is also how a WSGI server notices that the client has gone
+- TopLevelJSONStreamParser: incrementally parses a streamed JSON object and
+  reports each top-level key as soon as its value is complete
+"""
+import asyncio
+import contextvars
+import json
+import queue
+import threading
+
+_END = object()
+
+
+def sse_event(data, event=None, event_id=None):
+    """Format one server-sent event. Non-string data is JSON encoded."""
+    if not isinstance(data, str):
+        data = json.dumps(data)
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    if event:
+        lines.append(f"event: {event}")
+    # Multi-line payloads need one data: field per line
+    lines.extend(f"data: {line}" for line in data.split('\n'))
+    return '\n'.join(lines) + '\n\n'
+
+
+def sse_comment(text=''):
+    """An SSE comment: ignored by EventSource and SSE readers, but keeps the connection alive."""
+    return f": {text}\n\n"
+
+
+def heartbeats(items, interval, abandon=None):
+    """Yield the items of a blocking iterable, and None after every interval seconds without one.
+
+    The iterable is read on its own thread (in a copy of the current context). When this generator
+    is closed the reader stops at the next item and closes the iterable, which ends an upstream stream.
+    The reader may be blocked for as long as the upstream stays silent, so if the items have not run
+    out yet, abandon() (if given) is called on close to interrupt that read.
+    """
+    pending = queue.Queue()
+    stopped = threading.Event()
+    finished = threading.Event()
+
+    def read():
+        iterator = iter(items)
+        try:
+            for item in iterator:
+                if stopped.is_set():
+                    break
+                pending.put((item, None))
+            pending.put((_END, None))
+        except Exception as e:
+            pending.put((_END, e))
+        finally:
+            finished.set()
+            if hasattr(iterator, 'close'):
+                iterator.close()
+
+    threading.Thread(target=contextvars.copy_context().run, args=(read,), daemon=True).start()
+    try:
+        while True:
+            try:
+                item, error = pending.get(timeout=interval)
+            except queue.Empty:
+                yield None
+                continue
+            if item is _END:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stopped.set()
+        if abandon is not None and not finished.is_set():
+            abandon()
+
+
+async def aheartbeats(items, interval):
+    """Async heartbeats(): yields the items of an async iterable, and None after every quiet interval.
+
+    Closing or cancelling this generator cancels the pending read and closes the iterable.
+    """
+    iterator = items.__aiter__()
+    next_item = None
+    try:
+        while True:
+            if next_item is None:
+                next_item = asyncio.ensure_future(iterator.__anext__())
+            done, _ = await asyncio.wait({next_item}, timeout=interval)
+            if not done:
+                yield None
+                continue
+            try:
+                item = next_item.result()
+            except StopAsyncIteration:
+                return
+            next_item = None
+            yield item
+    finally:
+        if next_item is not None and not next_item.done():
+            next_item.cancel()
+            await asyncio.gather(next_item, return_exceptions=True)
+        if hasattr(iterator, 'aclose'):
+            await iterator.aclose()
+
+
+class TopLevelJSONStreamParser:
+    """Parse a JSON object that arrives in arbitrary chunks.
+
+    feed() returns the (key, value) pairs of the top-level object whose values
+    were completed by that chunk, in document order. Text before the opening
+    brace (e.g. stray whitespace) is ignored.
+    """
+
+    def __init__(self):
+        self._buffer = ''
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._expecting_key = False
+        self._key_start = None
+        self._key = None
+        self._value_start = None
+        self.finished = False
+
+    def feed(self, chunk):
+        completed = []
+        self._buffer += chunk
+        buffer = self._buffer
+
+        for i in range(self._pos, len(buffer)):
+            if self.finished:
+                break
+            char = buffer[i]
+
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._key_start is not None:
+                        self._key = json.loads(buffer[self._key_start:i + 1])
+                        self._key_start = None
+                continue
+
+            if char == '"':
+                self._in_string = True
+                if self._depth == 1 and self._expecting_key:
+                    self._key_start = i
+                    self._expecting_key = False
+            elif char in '{[':
+                self._depth += 1
+                if self._depth == 1:
+                    self._expecting_key = True
+            elif char in '}]':
+                self._depth -= 1
+                if self._depth == 0:
+                    self._complete_value(buffer, i, completed)
+                    self.finished = True
+            elif self._depth == 1 and char == ':':
+                self._value_start = i + 1
+            elif self._depth == 1 and char == ',':
+                self._complete_value(buffer, i, completed)
+                self._expecting_key = True
+
+        self._pos = len(buffer)
+        return completed
+
+    def _complete_value(self, buffer, end, completed):
+        if self._key is None or self._value_start is None:
+            return
+        raw_value = buffer[self._value_start:end].strip()
+        if raw_value:
+            completed.append((self._key, json.loads(raw_value)))
+        self._key = None
+        self._value_start = None
@@ -0,0 +1,152 @@
+"""JSON schemas, validation and repair for the JSON-producing LLM routes.
+
+The lesson, helper, insight and related-tags prompts each describe a JSON
+object. The schemas below mirror those descriptions and are sent as strict
+structured-output response formats, so the model is constrained to them.
+The server still parses and validates every output before it is cached or
+returned: an output that fails gets one targeted repair request listing what
+was wrong, instead of the browser finding out in JSON.parse and the teacher
+retrying by hand. Routes return the parsed objects.
+"""
+import json
+
+from prompts import build_structured_repair_message
+
+STRING = {"type": "string"}
+
+
+def _object(**properties):
+    # Strict structured outputs require every property and no others
+    return {"type": "object", "properties": properties, "required": list(properties), "additionalProperties": False}
+
+
+def _array(items):
+    return {"type": "array", "items": items}
+
+
+STRINGS = _array(STRING)
+_ELEMENTS = _array(_object(name=STRING, details=STRINGS))
+_STEP = _object(name=STRING, description=STRING, elements=_ELEMENTS)
+
+LESSON_SCHEMA = _object(
+    content_objectives=STRINGS,
+    language_objectives=_object(key_vocabulary=STRINGS, language_structures=STRINGS, example_phrases=STRINGS),
+    learning_tasks=_array(_object(
+        title=STRING,
+        description=STRING,
+        duration=STRING,
+        step_1_requirements=_STEP,
+        step_2_execution=_STEP,
+        step_3_wrap_up=_STEP
+    )),
+    assessment_criteria=_array(_object(criterion=STRING, method=STRING)),
+    text_deep_learning_input=_object(
+        pareto_printable=_object(title=STRING, points=_array(_object(point=STRING, explanation=STRING))),
+        socratic_questions=_object(question_types=STRINGS, example_questions=STRINGS),
+        extended_writing_exercises=_object(
+            writing_types=STRINGS, example_tasks=_array(_object(task=STRING, description=STRING))
+        )
+    )
+)
+
+HELPER_SCHEMA = _object(
+    topic_overview=_object(title=STRING, description=STRING, key_concepts=STRINGS),
+    teaching_aspects=_array(_object(title=STRING, description=STRING, tags=STRINGS)),
+    suggested_resources=_array(_object(type=STRING, description=STRING, examples=STRINGS))
+)
+
+INSIGHT_SCHEMA = _object(
+    title=STRING,
+    summary=STRING,
+    practical_tips=STRINGS,
+    example=_object(scenario=STRING, application=STRING)
+)
+
+RELATED_TAGS_SCHEMA = _object(related_tags=STRINGS)
+
+
+class StructuredOutputError(ValueError):
+    """The model output is not valid JSON for the expected schema."""
+
+    def __init__(self, name, problems):
+        super().__init__(f"Model output did not match the {name} schema: {'; '.join(problems[:5])}")
+        self.problems = problems
+
+
+_TYPES = {"object": dict, "array": list, "string": str}
+
+
+def schema_problems(value, schema, path='$'):
+    """List where value breaks schema (the object/array/string subset used above).
+
+    Properties the schema does not know are dropped from value instead of being reported.
+    """
+    expected = _TYPES[schema['type']]
+    if not isinstance(value, expected):
+        article = 'an' if schema['type'] in ('object', 'array') else 'a'
+        return [f"{path} should be {article} {schema['type']}"]
+    problems = []
+    if expected is dict:
+        for key in list(value):
+            if key not in schema['properties']:
+                del value[key]
+        for key in schema['required']:
+            if key not in value:
+                problems.append(f"{path}.{key} is missing")
+            else:
+                problems.extend(schema_problems(value[key], schema['properties'][key], f"{path}.{key}"))
+    elif expected is list:
+        for index, item in enumerate(value):
+            problems.extend(schema_problems(item, schema['items'], f"{path}[{index}]"))
+    return problems
+
+
+def _json_text(text):
+    """The JSON object in text, without markdown fences or chatter around it."""
+    text = text.strip()
+    if text.startswith('```'):
+        text = text.split('\n', 1)[1] if '\n' in text else ''
+        text = text.rsplit('```', 1)[0]
+    start, end = text.find('{'), text.rfind('}')
+    return text[start:end + 1] if start != -1 and end > start else text
+
+
+class StructuredOutput:
+    """A named schema with its response_format, parser and repair prompt."""
+
+    def __init__(self, name, schema):
+        self.name = name
+        self.schema = schema
+        self.response_format = {
+            "type": "json_schema",
+            "json_schema": {"name": name, "strict": True, "schema": schema}
+        }
+
+    def parse(self, text):
+        """Return the validated object in text, or raise StructuredOutputError."""
+        if not text:
+            raise StructuredOutputError(self.name, ["the response was empty"])
+        try:
+            value = json.loads(text)
+        except ValueError:
+            try:
+                value = json.loads(_json_text(text))
+            except ValueError as e:
+                raise StructuredOutputError(self.name, [f"invalid JSON ({e})"]) from None
+        problems = schema_problems(value, self.schema)
+        if problems:
+            raise StructuredOutputError(self.name, problems)
+        return value
+
+    def repair_messages(self, messages, text, error):
+        """messages plus the invalid answer and a request to fix exactly what was wrong."""
+        return messages + [
+            {"role": "assistant", "content": text or ""},
+            {"role": "user", "content": build_structured_repair_message(error.problems)}
+        ]
+
+
+LESSON_OUTPUT = StructuredOutput('lesson', LESSON_SCHEMA)
+HELPER_OUTPUT = StructuredOutput('helper', HELPER_SCHEMA)
+INSIGHT_OUTPUT = StructuredOutput('insight', INSIGHT_SCHEMA)
+RELATED_TAGS_OUTPUT = StructuredOutput('related_tags', RELATED_TAGS_SCHEMA)